@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+# backtest.py
+
+"""
+Value of a wallet at every step (a second by default) of a recorded session,
+computed in parallel:
+
+    python backtest.py ~/exchange_data --amounts BTC=4.2 ETH=17.7 --investment 41500 \
+        --checkpoints ~/exchange_data/checkpoints --output week.npz
+
+The time range is cut into chunks which a process pool works on. Each chunk
+needs the books as they were at its start: it restores the latest checkpoint
+taken before that (see checkpoint.py) or, without one, replays from the last
+snapshots recorded before it. Recordings are scanned once for their
+snapshots without parsing the frames, binary ones record by record, JSON
+ones with a regular expression over the files, and a chunk reads only from
+where it starts replaying, see replay.read_recording. The results of all
+chunks are merged into columns, written as .npz: time, value, gain and
+value_<currency> per currency.
+"""
+
+import argparse
+import bisect
+import concurrent.futures
+import dataclasses
+import json
+import logging
+import mmap
+import os
+import pathlib
+import re
+import time
+from typing import Dict
+from typing import List
+from typing import Mapping
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+import numpy
+
+#Own modules:
+import checkpoint
+import classes
+import recording
+import replay
+
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT = re.compile(rb'"event"\s*:\s*"snapshot"')
+SYMBOL = re.compile(rb'"symbol"\s*:\s*"([^"]*)"')
+
+
+@dataclasses.dataclass
+class Chunk:
+    """
+    Steps in [start, end); books are seeded from the checkpoint or by replaying from `replay_from`
+    """
+    start: float
+    end: float
+    replay_from: Optional[float] = None
+    seed: Optional[pathlib.Path] = None
+
+
+def mapped(path: pathlib.Path) -> Optional[mmap.mmap]:
+    """
+    the file at path mapped read-only, None if it is empty
+    """
+    with open(path, mode="rb") as fd:
+        try:
+            return mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return None
+
+
+def timestamp_before(mm: mmap.mmap, end: int, window: int = 65536) -> Optional[re.Match]:
+    """
+    the last timestamp line of a JSON recording which starts before end, searched backwards
+    """
+    while end > 0:
+        begin = max(0, end - window)
+        found = None
+        for found in replay.TIMESTAMP.finditer(mm, begin, end):
+            pass
+        if found is not None:
+            return found
+        # the windows overlap by more than a timestamp line
+        end = begin + 32 if begin else 0
+    return None
+
+
+def recording_bounds(path: pathlib.Path) -> Tuple[float, float]:
+    """
+    time of the first and the last record, read from the index of a binary
+    recording or the timestamp lines of JSON files
+    """
+    binary = replay.binary_recording(path)
+    if binary is not None:
+        reader = recording.Recording_Reader(*binary)
+        segments = reader.segments()
+        first = reader.read_index(segments[0])[0][0]
+        last = reader.read_index(segments[-1])[-1][0]
+        for received, seqnum, frame in reader.records(start=last):
+            last = received
+        return first, last
+    first = last = None
+    files = replay.json_files(path)
+    for file in files:
+        mm = mapped(file)
+        if mm is None:
+            continue
+        with mm:
+            found = replay.TIMESTAMP.search(mm)
+            first = replay.parse_timestamp(found.group()) if found is not None else None
+        if first is not None:
+            break
+    for file in reversed(files):
+        mm = mapped(file)
+        if mm is None:
+            continue
+        with mm:
+            found = timestamp_before(mm, len(mm))
+            last = replay.parse_timestamp(found.group()) if found is not None else None
+        if last is not None:
+            break
+    if first is None or last is None:
+        raise ValueError(f"No timestamps in {path}")
+    return first, last
+
+
+def snapshot_times(path: pathlib.Path) -> Dict[str, List[float]]:
+    """
+    times of the snapshots per symbol, found without parsing frames
+    """
+    binary = replay.binary_recording(path)
+    times = dict()
+    if binary is not None:
+        for received, seqnum, frame in recording.Recording_Reader(*binary).records():
+            if SNAPSHOT.search(frame, 0, 256):
+                symbol = SYMBOL.search(frame, 0, 256)
+                if symbol:
+                    times.setdefault(symbol.group(1).decode("utf-8"), list()).append(received)
+        return times
+    for file in replay.json_files(path):
+        mm = mapped(file)
+        if mm is None:
+            continue
+        with mm:
+            for found in SNAPSHOT.finditer(mm):
+                # a record is its timestamp line and the message, with \n or \r\n line ends
+                stamp = timestamp_before(mm, found.start(), 4096)
+                if stamp is None:
+                    continue
+                symbol = SYMBOL.search(mm, stamp.end(), found.end() + 256)
+                if symbol:
+                    times.setdefault(symbol.group(1).decode("utf-8"), list()).append(replay.parse_timestamp(stamp.group()))
+    return times
+
+
+def wallet_values(exchange: classes.Exchange, amounts: Mapping[str, float], target: str) -> List[float]:
+    values = list()
+    for source, amount in amounts.items():
+        try:
+            values.append(exchange.convert(amount, source, target)[0])
+        except KeyError:
+            values.append(0.0)
+    return values
+
+
+def run_chunk(path: pathlib.Path, symbols: Sequence[str], amounts: Mapping[str, float], target: str, step: float, chunk: Chunk, depth_limit: Optional[int] = None) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    returns the step times of the chunk and the value of every currency at each of them
+    """
+    if chunk.seed is not None:
+        exchange, taken = checkpoint.restore(chunk.seed, symbols, depth_limit)
+        # the recorded timestamps have whole seconds, seqnums drop what is already in the books
+        replay_from = taken - 1
+        waiting = set()
+    else:
+        exchange = classes.Exchange(symbols, depth_limit=depth_limit)
+        replay_from = chunk.replay_from
+        # the books start with their snapshots, updates before those are of books not built yet
+        waiting = set(symbols)
+    times = numpy.arange(chunk.start, chunk.end, step)
+    values = numpy.zeros((len(times), len(amounts)))
+    position = 0
+    for received, message in replay.read_recording(path, start=replay_from):
+        if received is not None:
+            while position < len(times) and received >= times[position]:
+                values[position] = wallet_values(exchange, amounts, target)
+                position = position + 1
+            if position >= len(times):
+                break
+        symbol = message.get("symbol")
+        if symbol is not None and symbol not in exchange.order_books:
+            continue
+        if symbol in waiting:
+            if message.get("event") != "snapshot":
+                continue
+            waiting.discard(symbol)
+        exchange.process(message)
+    while position < len(times):
+        values[position] = wallet_values(exchange, amounts, target)
+        position = position + 1
+    return times, values
+
+
+class Backtest:
+    """
+    Values the wallet given by amounts every step seconds between start and
+    end of the recording at path, in chunks of chunk_seconds on workers processes
+    """
+    def __init__(self,
+                 path: pathlib.Path,
+                 symbols: Sequence[str],
+                 amounts: Mapping[str, float],
+                 investment: float = 0.0,
+                 target: str = "EUR",
+                 step: float = 1.0,
+                 chunk_seconds: float = 3600,
+                 workers: Optional[int] = None,
+                 checkpoints: Optional[pathlib.Path] = None,
+                 depth_limit: Optional[int] = None,
+                 ):
+        self.path = path.expanduser()
+        self.symbols = list(symbols)
+        self.amounts = {source: amount for source, amount in amounts.items() if source != target}
+        self.investment = investment
+        self.target = target
+        self.step = step
+        self.chunk_seconds = chunk_seconds
+        self.workers = workers or os.cpu_count() or 1
+        self.checkpoints = checkpoints.expanduser() if checkpoints is not None else None
+        self.depth_limit = depth_limit
+    def seeds(self) -> List[Tuple[float, pathlib.Path]]:
+        """
+        (taken, path) of the checkpoints, oldest first
+        """
+        if self.checkpoints is None:
+            return list()
+        seeds = list()
+        for path in sorted(self.checkpoints.glob(f"*{checkpoint.SUFFIX}")):
+            with numpy.load(path) as data:
+                seeds.append((json.loads(data["meta"].tobytes())["taken"], path))
+        return sorted(seeds)
+    def chunks(self, start: float, end: float) -> List[Chunk]:
+        seeds = self.seeds()
+        taken = [seed[0] for seed in seeds]
+        snapshots = snapshot_times(self.path) if not seeds else dict()
+        chunks = list()
+        chunk_start = start
+        while chunk_start < end:
+            chunk = Chunk(start=chunk_start, end=min(chunk_start + self.chunk_seconds, end), replay_from=start)
+            position = bisect.bisect_right(taken, chunk_start)
+            if position:
+                chunk.seed = seeds[position - 1][1]
+            elif snapshots and all(symbol in snapshots for symbol in self.symbols):
+                # snapshots strictly before the chunk, its first step is valued before the records of that time
+                latest = [times[bisect.bisect_left(times, chunk_start) - 1] for times in (snapshots[symbol] for symbol in self.symbols) if times[0] < chunk_start]
+                if len(latest) == len(self.symbols):
+                    chunk.replay_from = min(latest)
+            chunks.append(chunk)
+            chunk_start = chunk.end
+        return chunks
+    def run(self, start: Optional[float] = None, end: Optional[float] = None) -> Dict[str, numpy.ndarray]:
+        """
+        returns the columns time, value, gain and value_<currency>
+        """
+        if start is None or end is None:
+            first, last = recording_bounds(self.path)
+            start = first if start is None else start
+            end = last + self.step if end is None else end
+        chunks = self.chunks(start, end)
+        started = time.perf_counter()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as pool:
+            futures = [pool.submit(run_chunk, self.path, self.symbols, self.amounts, self.target, self.step, chunk, self.depth_limit) for chunk in chunks]
+            results = [future.result() for future in futures]
+        times = numpy.concatenate([times for times, values in results])
+        values = numpy.concatenate([values for times, values in results]) if results else numpy.zeros((0, len(self.amounts)))
+        columns = {"time": times, "value": values.sum(axis=1)}
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            columns["gain"] = columns["value"] / self.investment - 1 if self.investment else numpy.full(len(times), numpy.nan)
+        for position, source in enumerate(self.amounts):
+            columns[f"value_{source}"] = values[:, position]
+        logger.info(f"Valued {len(times)} steps in {len(chunks)} chunks on {self.workers} workers in {time.perf_counter() - started:.1f} s")
+        return columns
+
+
+def write_columns(path: pathlib.Path, columns: Mapping[str, numpy.ndarray]):
+    numpy.savez_compressed(path.expanduser(), **columns)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Values a wallet over a recorded session")
+    parser.add_argument("path", type=pathlib.Path, help="JSON file, binary recording folder or Saver folder")
+    parser.add_argument("--symbols", nargs="+", default=("BTC-EUR", "ETH-EUR", "LTC-EUR"))
+    parser.add_argument("--amounts", nargs="+", required=True, help="currency amounts, e.g. BTC=4.2")
+    parser.add_argument("--investment", type=float, default=0.0)
+    parser.add_argument("--target", default="EUR")
+    parser.add_argument("--start", type=float, help="unix time, default the first record")
+    parser.add_argument("--end", type=float, help="unix time, default after the last record")
+    parser.add_argument("--step", type=float, default=1.0)
+    parser.add_argument("--chunk", type=float, default=3600, help="seconds per chunk")
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--checkpoints", type=pathlib.Path)
+    parser.add_argument("--depth-limit", type=int, help="keep only this many price levels sorted, see classes.Bounded_Levels")
+    parser.add_argument("--output", type=pathlib.Path, default=pathlib.Path("backtest.npz"))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("liquidation").setLevel(logging.CRITICAL)
+    amounts = {currency: float(amount) for currency, amount in (item.split("=") for item in args.amounts)}
+    backtest = Backtest(args.path, args.symbols, amounts, args.investment, args.target, args.step, args.chunk, args.workers, args.checkpoints, args.depth_limit)
+    write_columns(args.output, backtest.run(args.start, args.end))
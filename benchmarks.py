@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+# benchmarks.py
+
+"""
+Reproducible benchmarks of the order book and valuation hot paths.
+Everything runs on synthetic level 3 messages, no network needed:
+
+    python benchmarks.py --output results.json
+    python benchmarks.py --baseline results.json --tolerance 0.2
+
+With --baseline the run fails when the throughput of any benchmark dropped
+by more than the tolerance.
+"""
+
+import argparse
+import dataclasses
+import heapq
+import json
+import logging
+import logging.config
+import os
+import pathlib
+import platform
+import random
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+from collections import OrderedDict
+from typing import Callable
+from typing import Iterator
+from typing import List
+from typing import Mapping
+from typing import Optional
+from typing import Sequence
+
+#Own modules:
+import classes
+import liquidation
+import logging_conf
+import sharding
+
+
+logger = logging.getLogger(__name__)
+
+SYMBOLS = ("BTC-EUR", "ETH-EUR", "LTC-EUR")
+MID_PRICES = {"BTC-EUR": 10000.0, "ETH-EUR": 300.0, "LTC-EUR": 50.0}
+
+
+def synthetic_messages(symbol: str, count: int, depth: int = 1000, seed: int = 0, mix: Sequence[float] = (0.5, 0.3, 0.2), tick: float = 0.01) -> Iterator[Mapping]:
+    """
+    Yields a snapshot with depth orders per side followed by count update
+    messages. Updates add, modify and cancel random orders in the proportions
+    of mix, at prices spread geometrically around a slowly drifting mid price.
+    Orders the mid price moves through are cancelled in the same message, so
+    the books never cross.
+    """
+    rnd = random.Random(seed)
+    mid = MID_PRICES.get(symbol, 100.0)
+    live = {"bids": dict(), "asks": dict()}
+    # ids of the live orders in a list, so that picking a random one and removing it are O(1)
+    listed = {"bids": list(), "asks": list()}
+    positions = {"bids": dict(), "asks": dict()}
+    # (key, id) with the best price first; entries of removed orders are skipped when they surface
+    best = {"bids": list(), "asks": list()}
+    ids = iter(range(1, sys.maxsize))
+    def new_order(side):
+        distance = int(rnd.expovariate(1 / max(depth / 10, 1))) + 1
+        px = round(mid - distance * tick if side == "bids" else mid + distance * tick, 2)
+        order = {"id": next(ids), "px": px, "qty": round(rnd.uniform(0.0001, 2), 8)}
+        live[side][order["id"]] = order
+        positions[side][order["id"]] = len(listed[side])
+        listed[side].append(order["id"])
+        heapq.heappush(best[side], (-px if side == "bids" else px, order["id"]))
+        return order
+    def remove(side, id):
+        position = positions[side].pop(id)
+        last = listed[side].pop()
+        if last != id:
+            listed[side][position] = last
+            positions[side][last] = position
+        return dict(live[side].pop(id), qty=0)
+    def crossed(side):
+        """
+        cancels of the orders at or beyond the mid price
+        """
+        heap = best[side]
+        cancels = list()
+        while heap:
+            key, id = heap[0]
+            if id in live[side] and (key > -mid if side == "bids" else key > mid):
+                break
+            heapq.heappop(heap)
+            if id in live[side]:
+                cancels.append(remove(side, id))
+        return cancels
+    snapshot = {side: [new_order(side) for _ in range(depth)] for side in ("bids", "asks")}
+    yield {"seqnum": 0, "event": "snapshot", "channel": "l3", "symbol": symbol, **snapshot}
+    add, modify, cancel = mix
+    for seqnum in range(1, count + 1):
+        side = rnd.choice(("bids", "asks"))
+        action = rnd.random() * (add + modify + cancel)
+        if action < add or not live[side]:
+            entry = new_order(side)
+        else:
+            id = listed[side][rnd.randrange(len(listed[side]))]
+            if action < add + modify:
+                entry = dict(live[side][id], qty=round(rnd.uniform(0.0001, 2), 8))
+                live[side][id] = entry
+            else:
+                entry = remove(side, id)
+        mid = mid + rnd.gauss(0, tick / 10)
+        message = {"seqnum": seqnum, "event": "updated", "channel": "l3", "symbol": symbol, "bids": list(), "asks": list()}
+        message[side].append(entry)
+        for crossing in ("bids", "asks"):
+            message[crossing].extend(crossed(crossing))
+        yield message
+
+
+def interleaved_messages(count: int, depth: int, seed: int) -> List[Mapping]:
+    streams = [synthetic_messages(symbol, count, depth, seed + position) for position, symbol in enumerate(SYMBOLS)]
+    return [message for messages in zip(*streams) for message in messages]
+
+
+def benchmark_wallet() -> classes.Wallet:
+    return classes.Wallet(name="benchmark", curr_amounts={"BTC": 4.2, "ETH": 17.7, "LTC": 104.2}, investments={"EUR": 41500})
+
+
+@dataclasses.dataclass
+class Result:
+    name: str
+    calls: int
+    total_s: float
+    throughput: float
+    p50_us: float
+    p99_us: float
+    peak_kib: float = 0.0
+
+
+def measure(name: str, calls: Sequence[Callable[[], object]], memory: bool = True, setups: Optional[Sequence[Callable[[], object]]] = None) -> Result:
+    """
+    Times every call separately, then runs them all again under tracemalloc
+    for the peak memory. The calls should leave the state as they found it
+    or be cheap to repeat. setups, if given, are run untimed before the call
+    of the same position, in the timed run only.
+    """
+    timer = time.perf_counter_ns
+    latencies = list()
+    for position, call in enumerate(calls):
+        if setups is not None:
+            setups[position]()
+        started = timer()
+        call()
+        latencies.append(timer() - started)
+    latencies.sort()
+    total = sum(latencies) / 1e9
+    peak = 0.0
+    if memory:
+        tracemalloc.start()
+        for call in calls:
+            call()
+        peak = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+    return Result(
+        name=name,
+        calls=len(latencies),
+        total_s=total,
+        throughput=len(latencies) / total if total else 0.0,
+        p50_us=latencies[len(latencies) // 2] / 1000,
+        p99_us=latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] / 1000,
+        peak_kib=peak,
+    )
+
+
+def run_suite(count: int = 20000, depth: int = 1000, seed: int = 0) -> List[Result]:
+    results = list()
+    wallet = benchmark_wallet()
+    messages = interleaved_messages(count, depth, seed)
+    snapshots, updates = messages[:len(SYMBOLS)], messages[len(SYMBOLS):]
+
+    exchange = classes.Exchange(SYMBOLS)
+    for message in snapshots:
+        exchange.process(message)
+    results.append(measure("process_update", [lambda message=message: exchange.process_update(message) for message in updates], memory=False))
+
+    tracemalloc.start()
+    exchange = classes.Exchange(SYMBOLS)
+    for message in messages:
+        exchange.process(message)
+    book_peak = tracemalloc.get_traced_memory()[1] / 1024
+    tracemalloc.stop()
+    results[-1].peak_kib = book_peak
+
+    books = list(exchange.order_books.values())
+    results.append(measure("make_l2", [book.make_l2 for book in books for _ in range(10)]))
+
+    amounts = {"BTC-EUR": wallet.amounts["BTC"], "ETH-EUR": wallet.amounts["ETH"], "LTC-EUR": wallet.amounts["LTC"]}
+    results.append(measure("cascaded_trade", [lambda book=book: exchange.cascaded_trade(amounts[book.symbol], book.l2bids, True, book.symbol) for book in books for _ in range(100)]))
+    results.append(measure("liquidation_curve", [lambda book=book: liquidation.Liquidation_Curve(book.l2bids, True).trade(amounts[book.symbol]) for book in books for _ in range(100)]))
+
+    # a book update before every valuation, so that memoized trades are only reused as far as the books allow
+    evaluated = min(1000, len(updates))
+    exchange = classes.Exchange(SYMBOLS)
+    for message in messages[:len(messages) - evaluated]:
+        exchange.process(message)
+    results.append(measure("evaluate", [lambda: exchange.evaluate(wallet)] * evaluated, memory=False, setups=[lambda message=message: exchange.process(message) for message in messages[len(messages) - evaluated:]]))
+
+    def process_and_evaluate(exchange, message):
+        exchange.process(message)
+        exchange.evaluate(wallet)
+    exchange = classes.Exchange(SYMBOLS)
+    results.append(measure("end_to_end", [lambda message=message, exchange=exchange: process_and_evaluate(exchange, message) for message in messages], memory=False))
+    tracemalloc.start()
+    exchange = classes.Exchange(SYMBOLS)
+    for message in messages:
+        process_and_evaluate(exchange, message)
+    results[-1].peak_kib = tracemalloc.get_traced_memory()[1] / 1024
+    tracemalloc.stop()
+    return results
+
+
+def synthetic_levels(count: int, descending: bool, best_px: float = 10000.0, tick: float = 0.01, seed: int = 0) -> classes.Price_Levels:
+    """
+    Creates one side of an order book with count price levels
+    """
+    rnd = random.Random(seed)
+    levels = classes.Price_Levels(descending=descending)
+    step = -tick if descending else tick
+    for level in range(count):
+        levels.add(round(best_px + level * step, 2), rnd.uniform(0.001, 2))
+    return levels
+
+
+def bench_cascaded_trade(levels: int = 10000, sizes: int = 100, repeat: int = 5):
+    """
+    Compares Exchange.cascaded_trade with Liquidation_Curve on the same book
+    """
+    exchange = classes.Exchange(("BTC-EUR",))
+    results = dict()
+    for direction in (True, False):
+        side = synthetic_levels(levels, descending=direction)
+        curve = liquidation.Liquidation_Curve(side, direction)
+        depth = curve.spent[-1]
+        amounts = [depth * (size + 1) / (sizes + 1) for size in range(sizes)]
+        loop = min(timeit.repeat(lambda: [exchange.cascaded_trade(amount, side, direction, "BTC-EUR") for amount in amounts], number=1, repeat=repeat))
+        build = min(timeit.repeat(lambda: liquidation.Liquidation_Curve(side, direction), number=1, repeat=repeat))
+        vectorized = min(timeit.repeat(lambda: curve.trade_many(amounts), number=1, repeat=repeat))
+        results["bids" if direction else "asks"] = {
+            "levels": levels,
+            "sizes": sizes,
+            "cascaded_trade_s": loop,
+            "curve_build_s": build,
+            "curve_trade_many_s": vectorized,
+            "speedup": loop / (build + vectorized),
+        }
+    return results
+
+
+def bench_order_storage(orders: int = 200000, updates: int = 200000, seed: int = 0):
+    """
+    Compares memory per order and update throughput of an OrderedDict of
+    Order instances with classes.Order_Store
+    """
+    rnd = random.Random(seed)
+    entries = [(10 ** 10 + position, round(10000 + rnd.randint(-500, 500) * 0.01, 2), rnd.random()) for position in range(orders)]
+    picks = [entries[rnd.randrange(orders)][0] for _ in range(updates)]
+    def fill_dict(store):
+        for id, px, qty in entries:
+            store[id] = classes.Order(id=id, px=px, qty=qty)
+    def update_dict(store):
+        for position, id in enumerate(picks):
+            if position % 3 == 2:
+                del(store[id])
+                store[id] = classes.Order(id=id, px=10000.0, qty=0.5)
+            else:
+                store[id] = classes.Order(id=id, px=store[id].px, qty=0.25)
+    def fill_store(store):
+        for id, px, qty in entries:
+            store.set(id, px, qty)
+    def update_store(store):
+        for position, id in enumerate(picks):
+            if position % 3 == 2:
+                store.remove(id)
+                store.set(id, 10000.0, 0.5)
+            else:
+                store.set(id, store.pxs[store.slots[id]], 0.25)
+    results = dict()
+    for name, factory, fill, update in (("OrderedDict[Order]", OrderedDict, fill_dict, update_dict), ("Order_Store", classes.Order_Store, fill_store, update_store)):
+        store = factory()
+        tracemalloc.start()
+        fill(store)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        started = time.perf_counter()
+        update(store)
+        elapsed = time.perf_counter() - started
+        results[name] = {"bytes_per_order": size / orders, "updates_per_s": updates / elapsed}
+    return results
+
+
+def bench_sharding(workers: Sequence[int] = (1, 2, 4), symbols: int = 8, count: int = 5000, depth: int = 1000, seed: int = 0, collect_intervals: Sequence[float] = (0.1, 0.0)):
+    """
+    Messages per second of the loop sharding documents, processing an
+    undecoded frame and evaluating a wallet for each, with a single
+    classes.Exchange and with sharding.Sharded_Exchange per number of
+    workers and collect_interval
+    """
+    names = [f"S{position:02d}-EUR" for position in range(symbols)]
+    streams = [synthetic_messages(name, count, depth, seed + position) for position, name in enumerate(names)]
+    frames = [json.dumps(message) for messages in zip(*streams) for message in messages]
+    wallet = classes.Wallet(name="sharding", curr_amounts={name.split("-")[0]: 1.0 for name in names}, investments={"EUR": 1000})
+    exchange = classes.Exchange(names)
+    started = time.perf_counter()
+    for frame in frames:
+        exchange.process(json.loads(frame))
+        exchange.evaluate(wallet)
+    results = {"single": len(frames) / (time.perf_counter() - started)}
+    for count in workers:
+        for interval in collect_intervals:
+            with sharding.Sharded_Exchange(names, workers=count, collect_interval=interval) as sharded:
+                started = time.perf_counter()
+                for frame in frames:
+                    sharded.process_frame(frame)
+                    sharded.evaluate(wallet)
+                results[f"{count} workers, collect every {interval} s"] = len(frames) / (time.perf_counter() - started)
+    return results
+
+
+def bench_logging(count: int = 5000, depth: int = 1000, seed: int = 0):
+    """
+    Messages per second of processing, evaluating and a cascaded_trade every
+    tenth message, with the configuration of logging_conf writing to files:
+    at DEBUG synchronously, at DEBUG through queue_handlers, and at INFO,
+    where the guarded debug messages are not built at all
+    """
+    messages = interleaved_messages(count, depth, seed)
+    wallet = benchmark_wallet()
+    results = dict()
+    root = logging.getLogger()
+    quiet = {name: logging.getLogger(name).level for name in ("classes", "liquidation")}
+    for name, level, queued in (("DEBUG, synchronous", "DEBUG", False), ("DEBUG, queued", "DEBUG", True), ("INFO, queued", "INFO", True)):
+        saved = list(root.handlers)
+        for logger_name in quiet:
+            logging.getLogger(logger_name).setLevel(logging.NOTSET)
+        with tempfile.TemporaryDirectory() as directory, open(os.devnull, mode="w") as devnull:
+            logging.config.dictConfig(logging_conf.create_dict_config(pathlib.Path(directory), "all.log", "errors.log", level=level))
+            for handler in root.handlers:
+                if not isinstance(handler, logging.FileHandler):
+                    handler.setStream(devnull)
+            listeners = logging_conf.queue_handlers() if queued else list()
+            exchange = classes.Exchange(SYMBOLS)
+            started = time.perf_counter()
+            for position, message in enumerate(messages):
+                exchange.process(message)
+                exchange.evaluate(wallet)
+                if not position % 10:
+                    book = exchange.order_books[message["symbol"]]
+                    exchange.cascaded_trade(1.0, book.l2bids, True, book.symbol)
+            logging_conf.stop_queue_handlers(listeners)
+            results[name] = len(messages) / (time.perf_counter() - started)
+            for logger_name in ("", "custom_logger"):
+                for handler in list(logging.getLogger(logger_name).handlers):
+                    logging.getLogger(logger_name).removeHandler(handler)
+                    handler.close()
+        for handler in saved:
+            root.addHandler(handler)
+        for logger_name, logger_level in quiet.items():
+            logging.getLogger(logger_name).setLevel(logger_level)
+    return results
+
+
+def bench_depth_limit(limits: Sequence[Optional[int]] = (None, 32), count: int = 5000, depth: int = 20000, seed: int = 0):
+    """
+    Messages per second of processing deep books and evaluating every tenth
+    message, with full books and with depth-limited ones
+    """
+    messages = interleaved_messages(count, depth, seed)
+    wallet = benchmark_wallet()
+    results = dict()
+    for limit in limits:
+        exchange = classes.Exchange(SYMBOLS, depth_limit=limit)
+        started = time.perf_counter()
+        for position, message in enumerate(messages):
+            exchange.process(message)
+            if not position % 10:
+                exchange.evaluate(wallet)
+        results["full book" if limit is None else f"depth_limit {limit}"] = len(messages) / (time.perf_counter() - started)
+    return results
+
+
+def compare(results: Sequence[Result], baseline: Mapping, tolerance: float) -> List[str]:
+    """
+    returns a description of every benchmark whose throughput fell below
+    the baseline by more than tolerance
+    """
+    regressions = list()
+    previous = {result["name"]: result for result in baseline["results"]}
+    for result in results:
+        if result.name not in previous:
+            continue
+        before = previous[result.name]["throughput"]
+        if before and result.throughput < before * (1 - tolerance):
+            regressions.append(f"{result.name}: {result.throughput:.0f}/s, baseline {before:.0f}/s ({result.throughput / before - 1:+.0%})")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the order book and valuation hot paths")
+    parser.add_argument("--messages", type=int, default=20000, help="update messages per symbol")
+    parser.add_argument("--depth", type=int, default=1000, help="orders per side in the snapshot")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=pathlib.Path, help="save the results as JSON")
+    parser.add_argument("--baseline", type=pathlib.Path, help="compare with results saved earlier")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative throughput loss")
+    parser.add_argument("--levels", type=int, default=0, help="only compare cascaded_trade with Liquidation_Curve on books of this many levels")
+    parser.add_argument("--sizes", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--orders", type=int, default=0, help="only compare order storage with this many resting orders")
+    parser.add_argument("--workers", type=int, nargs="+", help="only compare sharding over these numbers of worker processes")
+    parser.add_argument("--logging", action="store_true", help="only compare logging configurations end to end")
+    parser.add_argument("--depth-limit", type=int, help="only compare full books with depth-limited ones on deep snapshots")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger("classes").setLevel(logging.CRITICAL)
+    logging.getLogger("liquidation").setLevel(logging.CRITICAL)
+    if args.levels:
+        for side, result in bench_cascaded_trade(args.levels, args.sizes, args.repeat).items():
+            print(f"{side}: {result['levels']} levels, {result['sizes']} sizes, "
+                  f"cascaded_trade {result['cascaded_trade_s'] * 1000:.1f} ms, "
+                  f"curve build {result['curve_build_s'] * 1000:.2f} ms + trade_many {result['curve_trade_many_s'] * 1000:.3f} ms, "
+                  f"{result['speedup']:.0f}x")
+        sys.exit(0)
+    if args.orders:
+        for name, result in bench_order_storage(args.orders).items():
+            print(f"{name}: {result['bytes_per_order']:.0f} bytes per order, {result['updates_per_s']:.0f} updates/s")
+        sys.exit(0)
+    if args.logging:
+        for name, rate in bench_logging(args.messages // 4, depth=args.depth, seed=args.seed).items():
+            print(f"{name}: {rate:.0f} messages/s")
+        sys.exit(0)
+    if args.depth_limit:
+        for name, rate in bench_depth_limit((None, args.depth_limit), args.messages // 4, depth=max(args.depth, 20000), seed=args.seed).items():
+            print(f"{name}: {rate:.0f} messages/s")
+        sys.exit(0)
+    if args.workers:
+        for name, rate in bench_sharding(args.workers, depth=args.depth, seed=args.seed).items():
+            print(f"{name}: {rate:.0f} messages/s")
+        sys.exit(0)
+    results = run_suite(args.messages, args.depth, args.seed)
+    print(f"{'benchmark':<18} {'calls':>8} {'per s':>12} {'p50 us':>10} {'p99 us':>10} {'peak KiB':>10}")
+    for result in results:
+        print(f"{result.name:<18} {result.calls:>8} {result.throughput:>12.0f} {result.p50_us:>10.2f} {result.p99_us:>10.2f} {result.peak_kib:>10.0f}")
+    report = {
+        "parameters": {"messages": args.messages, "depth": args.depth, "seed": args.seed},
+        "python": platform.python_version(),
+        "results": [dataclasses.asdict(result) for result in results],
+    }
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=4))
+    if args.baseline:
+        regressions = compare(results, json.loads(args.baseline.read_text()), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# checkpoint.py
+
+"""
+Checkpoints of all order books of a classes.Exchange, for warm restarts.
+
+    checkpointer = Checkpointer(exchange, pathlib.Path("~/exchange_data/checkpoints"))
+    for message in server.listen():
+        exchange.process(message)
+        checkpointer.maybe_checkpoint()
+
+Taking a checkpoint only copies the order arrays of every book on the
+calling thread; packing and writing the file happens on a background thread,
+so message processing does not pause. A checkpoint is one .npz file holding
+the live orders of every book side plus the last seqnums of the sequencer and
+the time it was taken.
+
+    exchange = warm_start(symbols, checkpoints, recording=pathlib.Path("~/exchange_data"))
+
+restores the latest checkpoint and replays the part of the Saver recording
+that came after it; messages the checkpoint already contains are dropped by
+their seqnum.
+"""
+
+import concurrent.futures
+import json
+import logging
+import os
+import pathlib
+import time
+from typing import Mapping
+from typing import Optional
+from typing import Tuple
+
+import numpy
+
+#Own modules:
+import classes
+import replay
+
+
+logger = logging.getLogger(__name__)
+
+SUFFIX = ".npz"
+
+
+def capture_side(store: classes.Order_Store) -> Tuple[bytes, bytes, bytes, list]:
+    """
+    copies the arrays of an Order_Store, quick enough for the processing thread
+    """
+    return store.ids.tobytes(), store.pxs.tobytes(), store.qtys.tobytes(), list(store.free)
+
+
+def pack_side(captured: Tuple[bytes, bytes, bytes, list], typecode: str) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """
+    drops the free slots of a captured side, leaving ids, pxs and qtys of the live orders
+    """
+    ids, pxs, qtys, free = captured
+    dtype = numpy.int64 if typecode == "q" else numpy.float64
+    ids = numpy.frombuffer(ids, dtype=numpy.int64)
+    live = numpy.ones(len(ids), dtype=bool)
+    live[free] = False
+    return ids[live], numpy.frombuffer(pxs, dtype=dtype)[live], numpy.frombuffer(qtys, dtype=dtype)[live]
+
+
+class Checkpointer:
+    """
+    Writes a checkpoint of the exchange every `interval` seconds into folder
+    and keeps the latest `keep` of them. Checkpoints are written to a .tmp
+    file first; those left by a crash are removed on start.
+    """
+    def __init__(self, exchange: classes.Exchange, folder: pathlib.Path, interval: float = 60, keep: int = 3):
+        self.exchange = exchange
+        self.folder = folder.expanduser()
+        self.folder.mkdir(parents=True, exist_ok=True)
+        for temporary in self.folder.glob("*.tmp"):
+            logger.info(f"Removing unfinished checkpoint {temporary}")
+            temporary.unlink(missing_ok=True)
+        self.interval = interval
+        self.keep = keep
+        self.last = time.monotonic()
+        self.pending = None
+        self.written = 0
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint")
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        self.close()
+        return False
+    def maybe_checkpoint(self) -> bool:
+        """
+        takes a checkpoint when the interval passed and the previous one is written
+        """
+        if time.monotonic() - self.last < self.interval:
+            return False
+        if self.pending is not None and not self.pending.done():
+            return False
+        self.checkpoint()
+        return True
+    def checkpoint(self) -> concurrent.futures.Future:
+        """
+        captures the books now and writes them in the background
+        """
+        self.last = time.monotonic()
+        books = dict()
+        for symbol, book in self.exchange.order_books.items():
+            books[symbol] = (book.bids.typecode, capture_side(book.bids), capture_side(book.asks), book.instrument)
+        sequences = [[key[0], key[1], seqnum] if key is not None else [None, None, seqnum] for key, seqnum in self.exchange.sequencer.last.items()]
+        meta = {
+            "taken": time.time(),
+            "symbols": list(books),
+            "per_symbol": self.exchange.sequencer.per_symbol,
+            "contiguous": self.exchange.sequencer.contiguous,
+            "sequences": sequences,
+            "stale": list(self.exchange.sequencer.stale),
+            "depth_limit": self.exchange.depth_limit,
+            "instruments": {symbol: [instrument.tick_size, instrument.lot_size] for symbol, (typecode, bids, asks, instrument) in books.items() if instrument is not None},
+        }
+        self.pending = self.executor.submit(self.write, books, meta)
+        return self.pending
+    def write(self, books: Mapping, meta: Mapping) -> pathlib.Path:
+        arrays = {"meta": numpy.frombuffer(json.dumps(meta).encode("utf-8"), dtype=numpy.uint8)}
+        for symbol, (typecode, bids, asks, instrument) in books.items():
+            for side, captured in (("bids", bids), ("asks", asks)):
+                ids, pxs, qtys = pack_side(captured, typecode)
+                arrays[f"{symbol}:{side}:ids"] = ids
+                arrays[f"{symbol}:{side}:pxs"] = pxs
+                arrays[f"{symbol}:{side}:qtys"] = qtys
+        name = time.strftime("%Y%m%dT%H%M%S", time.gmtime(meta["taken"])) + f"-{int(meta['taken'] * 1e6) % 1000000:06d}"
+        path = self.folder / (name + SUFFIX)
+        temporary = self.folder / (name + ".tmp")
+        try:
+            with open(temporary, mode="wb") as fd:
+                numpy.savez(fd, **arrays)
+            os.replace(temporary, path)
+        finally:
+            # left only when writing failed
+            temporary.unlink(missing_ok=True)
+        self.written = self.written + 1
+        logger.debug(f"Wrote checkpoint {path}")
+        for old in sorted(self.folder.glob(f"*{SUFFIX}"))[:-self.keep]:
+            old.unlink()
+        return path
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def latest(folder: pathlib.Path) -> Optional[pathlib.Path]:
+    checkpoints = sorted(folder.expanduser().glob(f"*{SUFFIX}"))
+    return checkpoints[-1] if checkpoints else None
+
+
+def restore(path: pathlib.Path, symbols=None, depth_limit: Optional[int] = None) -> Tuple[classes.Exchange, float]:
+    """
+    builds an exchange from a checkpoint and returns it with the time the checkpoint was taken;
+    the books get depth_limit if given, else the one they had
+    """
+    with numpy.load(path) as data:
+        meta = json.loads(data["meta"].tobytes())
+        instruments = {symbol: classes.Instrument(symbol, *sizes) for symbol, sizes in meta["instruments"].items()}
+        depth_limit = depth_limit if depth_limit is not None else meta.get("depth_limit")
+        exchange = classes.Exchange(tuple(symbols or meta["symbols"]), instruments=instruments, depth_limit=depth_limit)
+        for symbol, book in exchange.order_books.items():
+            if f"{symbol}:bids:ids" not in data:
+                continue
+            for side in ("bids", "asks"):
+                store = getattr(book, side)
+                ids = data[f"{symbol}:{side}:ids"]
+                store.ids.frombytes(ids.tobytes())
+                store.pxs.frombytes(data[f"{symbol}:{side}:pxs"].tobytes())
+                store.qtys.frombytes(data[f"{symbol}:{side}:qtys"].tobytes())
+                store.slots.update(zip(ids.tolist(), range(len(ids))))
+            book.make_l2()
+    sequencer = exchange.sequencer
+    sequencer.per_symbol = meta["per_symbol"]
+    sequencer.contiguous = meta.get("contiguous", sequencer.contiguous)
+    for channel, symbol, seqnum in meta["sequences"]:
+        sequencer.last[(channel, symbol) if sequencer.per_symbol else None] = seqnum
+    for symbol in meta["stale"]:
+        sequencer.stale[symbol] = time.monotonic()
+    logger.info(f"Restored {len(exchange.order_books)} order books from {path}")
+    return exchange, meta["taken"]
+
+
+def warm_start(symbols, folder: pathlib.Path, recording: Optional[pathlib.Path] = None, instruments: Optional[Mapping[str, classes.Instrument]] = None, depth_limit: Optional[int] = None) -> classes.Exchange:
+    """
+    Restores the latest checkpoint in folder and replays what the Saver
+    recorded after it. Without a checkpoint the exchange starts empty;
+    instruments only apply then, a checkpoint brings its own.
+    """
+    path = latest(folder)
+    if path is None:
+        logger.info(f"No checkpoint in {folder}, starting cold")
+        return classes.Exchange(symbols, instruments=instruments, depth_limit=depth_limit)
+    exchange, taken = restore(path, symbols, depth_limit)
+    if recording is not None:
+        # the recorded timestamps have whole seconds, seqnums drop what is already in the books
+        replay.Replayer(exchange).run(replay.read_recording(recording, start=taken - 1))
+    return exchange
+
+
+if __name__ == "__main__":
+    pass
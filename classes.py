@@ -1,213 +1,940 @@
-#!/usr/bin/env python
-# classes.py
-
-import dataclasses
-import logging
-from collections import OrderedDict
-from typing import List
-from typing import Mapping
-from typing import Union
-
-logger = logging.getLogger(__name__)
-
-
-@dataclasses.dataclass
-class Order_Book:
-    """
-    Holds a list of bids and a list of asks for a particular symbol
-    """
-    symbol: str
-    bids: OrderedDict = dataclasses.field(default_factory=OrderedDict)
-    asks: OrderedDict = dataclasses.field(default_factory=OrderedDict)
-    l2bids: OrderedDict = dataclasses.field(default_factory=OrderedDict)
-    l2asks: OrderedDict = dataclasses.field(default_factory=OrderedDict)
-    def sum_orders(self) -> OrderedDict:
-        """
-        outputs bids or asks as level2 (summed to price levels)
-        """
-        for order_type, reverse in zip((self.bids, self.asks), (True, False)):
-            px_qty = OrderedDict()
-            for order in sorted(order_type.values(), reverse=reverse, key=lambda order: order.px):
-                try:
-                    px_qty[order.px] = px_qty[order.px] + order.qty
-                except KeyError:
-                    px_qty[order.px] = order.qty
-            yield px_qty
-    def make_l2(self):
-        self.l2bids, self.l2asks = self.sum_orders()
-
-
-@dataclasses.dataclass(frozen=True)
-class Order:
-    """
-    Holds either a bid or an ask
-    """
-    id: int
-    px: float
-    qty: float
-
-
-@dataclasses.dataclass
-class Currency:
-    name: str
-    symbol: str
-    unit: str
-
-
-@dataclasses.dataclass
-class Wallet:
-    name: str
-    curr_amounts: dataclasses.InitVar[Mapping[str, float]]
-    investments: Mapping[str, float] = dataclasses.field(default_factory=dict)
-    currencies: Mapping[str, Currency] = dataclasses.field(init=False)
-    amounts: Mapping[str, float] = dataclasses.field(init=False)
-    values: Mapping[str, float] = dataclasses.field(init=False)
-    def __post_init__(self, curr_amounts):
-        dollar = Currency(name="dollar", symbol="USD", unit="$")
-        euro = Currency(name="euro", symbol="EUR", unit="€")
-        bitcoin = Currency(name="bitcoin", symbol="BTC", unit="₿")
-        ether = Currency(name="ether", symbol="ETH", unit="Ξ")
-        litecoin = Currency(name="litecoin", symbol="LTC", unit="Ł")
-        symbols = ("USD", "EUR", "BTC", "ETH", "LTC")
-        curr = (dollar, euro, bitcoin, ether, litecoin)
-        possible_currencies = dict(zip(symbols, curr))
-        self.currencies = dict()
-        self.amounts = dict()
-        self.values = dict()
-        for symbol, amount in curr_amounts.items():
-            logger.debug(f"curr_amount: {symbol}: {amount}")
-            try:
-                self.currencies[symbol] = possible_currencies[symbol]
-                self.amounts[symbol] = amount
-                self.values[symbol] = 0
-            except KeyError:
-                logger.error(f"Currency {symbol} not implemented.")
-        for symbol in symbols:
-            if symbol not in self.investments:
-                self.investments[symbol] = 0
-
-
-@dataclasses.dataclass
-class Message:
-    seqnum: str = ""
-    event: str = ""
-    channel: str = ""
-    timestamp: str = ""
-    symbol: str = ""
-    bids: List[Mapping[str, Union[str, float, int]]] = dataclasses.field(default_factory=list)
-    asks: List[Mapping[str, Union[str, float, int]]] = dataclasses.field(default_factory=list)
-
-
-class Exchange:
-    """
-    Holds the Order Books for several symbols in a stock exchange.
-    A stock exchange in this case is one particular exchange server, 
-    e.g. `exchange.blockchain.com`
-    """
-    def __init__(self, symbols):
-        self.symbols = symbols
-        self.order_books = dict(zip((symbol for symbol in self.symbols), (Order_Book(symbol=symbol) for symbol in self.symbols)))
-    def cascaded_trade(self, to_sell: float, orders: Mapping[float, float], direction: bool, ob_symbol: str):
-        if direction:
-            selling_currency = ob_symbol.split("-")[0]
-            buying_currency = ob_symbol.split("-")[1]
-        else:
-            selling_currency = ob_symbol.split("-")[0]
-            buying_currency = ob_symbol.split("-")[1]
-        offers = sorted(orders.items(), reverse=not direction)
-        still_to_sell = to_sell
-        sold_value = 0
-        while still_to_sell > 0:
-            if direction:
-                try:
-                    price, available = offers.pop()
-                    logger.debug(f"Best offer is buying {available} {selling_currency} at a price of {price} {buying_currency} per 1 {selling_currency}.")
-                    selling = min(still_to_sell, available)
-                    logger.debug(f"Can sell {selling} {selling_currency}")
-                    trade_value = price * selling
-                    logger.debug(f"Selling {selling} {selling_currency} for {trade_value} {buying_currency}.")
-                    still_to_sell = still_to_sell - selling
-                    sold_value = sold_value + trade_value
-                    logger.debug(f"Total sold {to_sell - still_to_sell} {selling_currency}, for {sold_value} {buying_currency}")
-                    logger.debug(f"Still to sell {still_to_sell} {selling_currency}.")
-                except IndexError:
-                    logger.error(f"Cannot trade remaining {still_to_sell} {selling_currency}. No more bids.")
-                    break
-            else:
-                try:
-                    price, available = offers.pop()
-                    logger.debug(f"Best offer is selling {available} {selling_currency} at a price of {price} {buying_currency} per 1 {selling_currency}")
-                    logger.debug(f"{still_to_sell} {buying_currency} could buy me {still_to_sell / price} {selling_currency}.")
-                    selling = min(available, still_to_sell / price)
-                    logger.debug(f"min({available}, {still_to_sell / price})")
-                    logger.debug(f"Can buy some {selling_currency} for {still_to_sell} {buying_currency} at a price of {price} {buying_currency} per 1 {selling_currency}.")
-                    trade_value = selling / price
-                    logger.debug(f"Buying {selling} {selling_currency} for ?.")
-                    still_to_sell = still_to_sell - selling
-                    sold_value = sold_value + trade_value
-                    logger.debug(f"Total sold {to_sell - still_to_sell} {buying_currency}, for {sold_value} {selling_currency}")
-                    logger.debug(f"Still to sell {still_to_sell} {buying_currency}.")
-                except IndexError:
-                    logger.error(f"Cannot trade remaining {still_to_sell} {buying_currency}. No more asks.")
-                    break
-        return sold_value, still_to_sell
-    def change_currency (self, wallet: Wallet, source: str, target: str):
-        """
-        Changes currency from one to another using an orderbook
-        """
-        try:
-            ob_symbol = "-".join((source, target))
-            ob = self.order_books[ob_symbol]
-            direction = True
-        except KeyError:
-            ob_symbol = "-".join((target, source))
-            ob = self.order_books[ob_symbol]
-            direction = False
-        ob.make_l2()
-        if direction:
-            logger.debug(f"Bids would buy this much {source}, give this much {target} per 1 {source}.")
-            orders = ob.l2bids
-        else:
-            logger.debug(f"Asks would sell this much {target}, give this much {source} per 1 {target}.")
-            orders = ob.l2asks
-        sold_value, still_to_sell = self.cascaded_trade(wallet.amounts[source], orders, direction, ob_symbol)
-        wallet.values[target] = sold_value
-        return sold_value
-    def evaluate(self, wallet: Wallet):
-        # logger.debug(f"Evaluating wallet by buying EUR")
-        sold_value_BTC = self.change_currency(wallet, "BTC", "EUR")
-        sold_value_ETH = self.change_currency(wallet, "ETH", "EUR")
-        sold_value_LTC = self.change_currency(wallet, "LTC", "EUR")
-        total_value = sold_value_BTC + sold_value_ETH + sold_value_LTC
-        gain = total_value / wallet.investments["EUR"] - 1
-        logger.info("Invested: €{:.2f}, current value: €{:.2f}, {:.2%} gain.".format(wallet.investments["EUR"], total_value, gain))
-    def process_update(self, message):
-        symbol = message["symbol"]
-        bids = message["bids"]
-        asks = message["asks"]
-        for bid in bids:
-            if bid["qty"] == 0:
-                del(self.order_books[symbol].bids[bid["id"]])
-            else:
-                self.order_books[symbol].bids[bid["id"]] = Order(**bid)
-        for ask in asks:
-            if ask["qty"] == 0:
-                del(self.order_books[symbol].asks[ask["id"]])
-            else:
-                self.order_books[symbol].asks[ask["id"]] = Order(**ask)
-    def process_subscribed(self, message):
-        logger.debug(f"Subscribed to {message['symbol']}")
-    def process_unknown(self, message):
-        logger.debug("Unknown message:")
-        logger.debug(message)
-    def process(self, message):
-        if message.get("event") in ("updated", "snapshot"):
-            self.process_update(message)
-        elif message.get("event") == "subscribed":
-            self.process_subscribed(message)
-        else:
-            process_unknown(message)
-
-
-if __name__ == "__main__":
-    pass
+#!/usr/bin/env python
+# classes.py
+
+import array
+import bisect
+import dataclasses
+import functools
+import heapq
+import itertools
+import logging
+import math
+import time
+from collections import deque
+from collections import OrderedDict
+from collections.abc import Mapping as Mapping_ABC
+from collections.abc import MutableMapping as MutableMapping_ABC
+from typing import List
+from typing import Mapping
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Union
+
+import numpy
+
+#Own modules:
+import liquidation
+import metrics
+import sequencing
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(frozen=True)
+class Order:
+    """
+    Holds either a bid or an ask
+    """
+    id: int
+    px: float
+    qty: float
+
+
+@dataclasses.dataclass(frozen=True)
+class Instrument:
+    """
+    Tick and lot size of a symbol, for order books in fixed-point mode.
+    Prices are stored as integer ticks and quantities as integer lots;
+    these methods convert at the edges.
+    """
+    symbol: str
+    tick_size: float = 0.01
+    lot_size: float = 1e-8
+    def to_ticks(self, px: float) -> int:
+        return round(px / self.tick_size)
+    def to_lots(self, qty: float) -> int:
+        return round(qty / self.lot_size)
+    def price(self, ticks: int) -> float:
+        return ticks * self.tick_size
+    def quantity(self, lots: int) -> float:
+        return lots * self.lot_size
+
+
+class Order_Store(MutableMapping_ABC):
+    """
+    Compact storage of the level 3 orders of one side of an order book.
+    Maps order id to Order like a dict, but keeps prices and quantities in
+    parallel arrays: `slots` maps each id to its position in the arrays and
+    positions of deleted orders are reused. Order instances are only created
+    when an order is looked up.
+    With integral True prices and quantities are stored as integers (ticks and lots).
+    """
+    def __init__(self, integral: bool = False):
+        self.typecode = "q" if integral else "d"
+        self.slots = dict()
+        self.ids = array.array("q")
+        self.pxs = array.array(self.typecode)
+        self.qtys = array.array(self.typecode)
+        self.free = list()
+    def __getitem__(self, id: int) -> Order:
+        slot = self.slots[id]
+        return Order(id=id, px=self.pxs[slot], qty=self.qtys[slot])
+    def __setitem__(self, id: int, order: Order):
+        self.set(id, order.px, order.qty)
+    def __delitem__(self, id: int):
+        self.free.append(self.slots.pop(id))
+    def __contains__(self, id: int) -> bool:
+        return id in self.slots
+    def __iter__(self):
+        return iter(self.slots)
+    def __len__(self) -> int:
+        return len(self.slots)
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({list(self.values())})"
+    def set(self, id: int, px: float, qty: float) -> Optional[Tuple[float, float]]:
+        """
+        stores the order and returns the price and quantity it replaced, if any
+        """
+        slot = self.slots.get(id)
+        if slot is not None:
+            old = (self.pxs[slot], self.qtys[slot])
+            self.pxs[slot] = px
+            self.qtys[slot] = qty
+            return old
+        if self.free:
+            slot = self.free.pop()
+            self.ids[slot] = id
+            self.pxs[slot] = px
+            self.qtys[slot] = qty
+        else:
+            slot = len(self.pxs)
+            self.ids.append(id)
+            self.pxs.append(px)
+            self.qtys.append(qty)
+        self.slots[id] = slot
+        return None
+    def remove(self, id: int) -> Tuple[float, float]:
+        """
+        deletes the order and returns its price and quantity
+        """
+        slot = self.slots.pop(id)
+        self.free.append(slot)
+        return self.pxs[slot], self.qtys[slot]
+    def clear(self):
+        self.slots.clear()
+        self.ids = array.array("q")
+        self.pxs = array.array(self.typecode)
+        self.qtys = array.array(self.typecode)
+        self.free.clear()
+
+
+class Price_Levels(Mapping_ABC):
+    """
+    Level 2 view of one side of an order book.
+    Maps price to the aggregated quantity resting at that price and keeps
+    the prices sorted, so iteration runs from the best price outwards.
+    `version` grows with every change; the prices touched by the most recent
+    changes are kept in `changes` to tell how deep into the book they reached.
+    """
+    def __init__(self, descending: bool = False, history: int = 256):
+        self.descending = descending
+        self.version = 0
+        self.changes = deque(maxlen=history)
+        self.prices = list()
+        self.quantities = dict()
+        self.counts = dict()
+    def __getitem__(self, px: float) -> float:
+        return self.quantities[px]
+    def __iter__(self):
+        if self.descending:
+            return reversed(self.prices)
+        return iter(self.prices)
+    def __len__(self) -> int:
+        return len(self.prices)
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({dict(self.items())})"
+    def add(self, px: float, qty: float):
+        """
+        adds one order of qty at px
+        """
+        self.touch(px)
+        try:
+            self.quantities[px] = self.quantities[px] + qty
+            self.counts[px] = self.counts[px] + 1
+        except KeyError:
+            bisect.insort(self.prices, px)
+            self.quantities[px] = qty
+            self.counts[px] = 1
+    def change(self, px: float, qty_delta: float):
+        """
+        changes the quantity of one order resting at px
+        """
+        self.touch(px)
+        self.quantities[px] = self.quantities[px] + qty_delta
+    def remove(self, px: float, qty: float):
+        """
+        removes one order of qty from px, drops the level with its last order
+        """
+        self.touch(px)
+        count = self.counts[px] - 1
+        if count:
+            self.counts[px] = count
+            self.quantities[px] = self.quantities[px] - qty
+        else:
+            del(self.counts[px])
+            del(self.quantities[px])
+            del(self.prices[bisect.bisect_left(self.prices, px)])
+    def clear(self):
+        self.touch(math.inf if self.descending else -math.inf)
+        self.prices.clear()
+        self.quantities.clear()
+        self.counts.clear()
+    def touch(self, px: float):
+        self.version = self.version + 1
+        self.changes.append(px)
+    def changed_within(self, version: int, px: float) -> bool:
+        """
+        tells whether any change after version touched a price at px or better;
+        px None stands for the whole book
+        """
+        changes = self.version - version
+        if not changes:
+            return False
+        if px is None or changes > len(self.changes):
+            return True
+        touched = itertools.islice(reversed(self.changes), changes)
+        if self.descending:
+            return max(touched) >= px
+        return min(touched) <= px
+
+
+class Bounded_Levels(Price_Levels):
+    """
+    Price_Levels which keep only the best levels sorted: at least `limit`
+    of them while there are more, at most twice as many. Levels worse than
+    `boundary` rest unsorted in `overflow` until cancellations or a deeper
+    trade promote them. Iteration and len cover the sorted levels only,
+    look-ups cover all of them.
+    """
+    def __init__(self, descending: bool = False, history: int = 256, limit: int = 64):
+        super().__init__(descending, history)
+        self.minimum = limit
+        self.limit = limit
+        self.overflow = set()
+        self.boundary = None
+    def inside(self, px: float) -> bool:
+        if self.boundary is None:
+            return True
+        return px >= self.boundary if self.descending else px <= self.boundary
+    def add(self, px: float, qty: float):
+        self.touch(px)
+        try:
+            self.quantities[px] = self.quantities[px] + qty
+            self.counts[px] = self.counts[px] + 1
+            return
+        except KeyError:
+            self.quantities[px] = qty
+            self.counts[px] = 1
+        if not self.inside(px):
+            self.overflow.add(px)
+            return
+        bisect.insort(self.prices, px)
+        if len(self.prices) > 2 * self.limit:
+            self.demote()
+    def remove(self, px: float, qty: float):
+        self.touch(px)
+        count = self.counts[px] - 1
+        if count:
+            self.counts[px] = count
+            self.quantities[px] = self.quantities[px] - qty
+            return
+        del(self.counts[px])
+        del(self.quantities[px])
+        if px in self.overflow:
+            self.overflow.discard(px)
+            if not self.overflow:
+                self.boundary = None
+            return
+        del(self.prices[bisect.bisect_left(self.prices, px)])
+        if len(self.prices) < self.limit and self.overflow:
+            self.promote(self.limit - len(self.prices))
+    def clear(self):
+        super().clear()
+        self.overflow.clear()
+        self.boundary = None
+    def demote(self):
+        """
+        moves the sorted levels past the best limit into the overflow;
+        the book does not change, so neither does the version
+        """
+        if self.descending:
+            moved = self.prices[:-self.limit]
+            del(self.prices[:-self.limit])
+            self.boundary = self.prices[0]
+        else:
+            moved = self.prices[self.limit:]
+            del(self.prices[self.limit:])
+            self.boundary = self.prices[-1]
+        self.overflow.update(moved)
+    def promote(self, count: int):
+        """
+        sorts the best count levels of the overflow in behind the sorted ones
+        """
+        best = sorted(heapq.nlargest(count, self.overflow) if self.descending else heapq.nsmallest(count, self.overflow))
+        self.overflow.difference_update(best)
+        # iteration now reaches further, curves built before must not be reused
+        self.touch(self.boundary)
+        if self.descending:
+            self.prices[:0] = best
+        else:
+            self.prices.extend(best)
+        if not self.overflow:
+            self.boundary = None
+        elif self.prices:
+            self.boundary = self.prices[0] if self.descending else self.prices[-1]
+    def require(self, levels: int):
+        """
+        adapts limit to trades consuming that many levels, with a margin of as many again;
+        a lower limit only takes effect once it is a quarter of the current one
+        """
+        limit = max(self.minimum, 2 * levels)
+        if limit > self.limit:
+            self.limit = limit
+            if len(self.prices) < limit and self.overflow:
+                self.promote(limit - len(self.prices))
+        elif 4 * limit <= self.limit:
+            self.limit = limit
+
+
+@dataclasses.dataclass
+class Order_Book:
+    """
+    Holds a list of bids and a list of asks for a particular symbol.
+    The level 2 views `l2bids` and `l2asks` are kept current by
+    `update_order` and `delete_order`.
+    Trade results are memoized per side and amount and stay valid until
+    a change reaches the depth the trade consumed.
+    With an instrument the book is in fixed-point mode: orders and levels
+    hold integer ticks and lots, so level 2 aggregation is exact.
+    Prices and quantities are converted in `set_order`, `sum_orders` and
+    the liquidation curves; amounts and proceeds of trades stay floats.
+    With depth_limit the level 2 views are Bounded_Levels which keep at
+    least that many levels sorted, and more as trades need them; curves
+    only cover the sorted levels, `curve_for` sorts in what a trade needs
+    and `curve_levels` what a number of levels needs.
+    """
+    symbol: str
+    bids: Order_Store = dataclasses.field(default_factory=Order_Store)
+    asks: Order_Store = dataclasses.field(default_factory=Order_Store)
+    l2bids: Price_Levels = dataclasses.field(default_factory=functools.partial(Price_Levels, descending=True))
+    l2asks: Price_Levels = dataclasses.field(default_factory=Price_Levels)
+    curves: dict = dataclasses.field(default_factory=dict, repr=False, compare=False)
+    memos: dict = dataclasses.field(default_factory=dict, repr=False, compare=False)
+    memo_size: int = dataclasses.field(default=1024, repr=False)
+    instrument: Optional[Instrument] = None
+    depth_limit: Optional[int] = None
+    def __post_init__(self):
+        if self.instrument is not None and not (self.bids or self.asks):
+            self.bids = Order_Store(integral=True)
+            self.asks = Order_Store(integral=True)
+        if self.depth_limit is not None and not (self.l2bids or self.l2asks):
+            self.l2bids = Bounded_Levels(descending=True, limit=self.depth_limit)
+            self.l2asks = Bounded_Levels(limit=self.depth_limit)
+    @property
+    def version(self) -> int:
+        return self.l2bids.version + self.l2asks.version
+    def sum_orders(self) -> OrderedDict:
+        """
+        outputs bids or asks as level2 (summed to price levels)
+        """
+        for order_type, reverse in zip((self.bids, self.asks), (True, False)):
+            px_qty = OrderedDict()
+            for order in sorted(order_type.values(), reverse=reverse, key=lambda order: order.px):
+                try:
+                    px_qty[order.px] = px_qty[order.px] + order.qty
+                except KeyError:
+                    px_qty[order.px] = order.qty
+            if self.instrument is not None:
+                px_qty = OrderedDict((self.instrument.price(px), self.instrument.quantity(qty)) for px, qty in px_qty.items())
+            yield px_qty
+    def clear(self):
+        """
+        drops all orders, e.g. before a snapshot rebuilds the book
+        """
+        self.bids.clear()
+        self.asks.clear()
+        self.l2bids.clear()
+        self.l2asks.clear()
+        self.memos.clear()
+    def make_l2(self):
+        """
+        rebuilds the level 2 views from scratch out of the level 3 orders
+        """
+        for orders, levels in zip((self.bids, self.asks), (self.l2bids, self.l2asks)):
+            levels.clear()
+            for order in orders.values():
+                levels.add(order.px, order.qty)
+    def update_order(self, side: str, order: Order):
+        """
+        inserts or modifies an order on side "bids" or "asks"
+        """
+        self.set_order(side, order.id, order.px, order.qty)
+    def set_order(self, side: str, id: int, px: float, qty: float):
+        """
+        inserts or modifies an order on side "bids" or "asks"
+        without creating an Order
+        """
+        if self.instrument is not None:
+            px = self.instrument.to_ticks(px)
+            qty = self.instrument.to_lots(qty)
+        levels = getattr(self, "l2" + side)
+        old = getattr(self, side).set(id, px, qty)
+        if old is None:
+            levels.add(px, qty)
+        elif old[0] == px:
+            levels.change(px, qty - old[1])
+        else:
+            levels.remove(*old)
+            levels.add(px, qty)
+    def delete_order(self, side: str, id: int):
+        """
+        deletes an order from side "bids" or "asks"
+        """
+        px, qty = getattr(self, side).remove(id)
+        getattr(self, "l2" + side).remove(px, qty)
+    def top_of_book(self) -> Tuple[Optional[float], Optional[float]]:
+        """
+        best bid and best ask, None for an empty side
+        """
+        bid = self.l2bids.prices[-1] if self.l2bids.prices else None
+        ask = self.l2asks.prices[0] if self.l2asks.prices else None
+        if self.instrument is not None:
+            bid = self.instrument.price(bid) if bid is not None else None
+            ask = self.instrument.price(ask) if ask is not None else None
+        return bid, ask
+    def levels(self, direction: bool) -> Price_Levels:
+        """
+        returns the bids for direction True, the asks otherwise
+        """
+        return self.l2bids if direction else self.l2asks
+    def curve(self, direction: bool) -> liquidation.Liquidation_Curve:
+        """
+        returns the liquidation curve of the bids (direction True) or asks,
+        built at most once per version of that side
+        """
+        levels = self.levels(direction)
+        try:
+            version, curve = self.curves[direction]
+            if version == levels.version:
+                return curve
+        except KeyError:
+            pass
+        if self.instrument is None:
+            curve = liquidation.Liquidation_Curve(levels, direction)
+        else:
+            curve = liquidation.Liquidation_Curve(levels, direction, tick_size=self.instrument.tick_size, lot_size=self.instrument.lot_size)
+        self.curves[direction] = (levels.version, curve)
+        return curve
+    def curve_for(self, direction: bool, amount: float) -> liquidation.Liquidation_Curve:
+        """
+        like curve, deep enough for a trade of amount; with depth_limit it
+        promotes overflow levels until the curve covers amount or the book
+        """
+        curve = self.curve(direction)
+        if self.depth_limit is None:
+            return curve
+        levels = self.levels(direction)
+        while levels.overflow and curve.spent[-1] < amount:
+            levels.require(len(levels))
+            curve = self.curve(direction)
+        levels.require(int(numpy.searchsorted(curve.spent, amount, side="left")))
+        return curve
+    def curve_levels(self, direction: bool, count: Optional[int] = None) -> liquidation.Liquidation_Curve:
+        """
+        like curve, over at least the best count levels, all without count,
+        where the side has them; with depth_limit they stay sorted from then on
+        """
+        levels = self.levels(direction)
+        if self.depth_limit is not None:
+            count = len(levels) + len(levels.overflow) if count is None else count
+            levels.require((count + 1) // 2)
+        return self.curve(direction)
+    def whole_curve(self, direction: bool) -> liquidation.Liquidation_Curve:
+        """
+        like curve, over all levels; with depth_limit it is built from a sorted
+        copy of them, the levels kept sorted and the limit stay as they are
+        """
+        if self.depth_limit is None:
+            return self.curve(direction)
+        levels = self.levels(direction)
+        quantities = levels.quantities
+        ordered = {px: quantities[px] for px in sorted(quantities, reverse=levels.descending)}
+        if self.instrument is None:
+            return liquidation.Liquidation_Curve(ordered, direction)
+        return liquidation.Liquidation_Curve(ordered, direction, tick_size=self.instrument.tick_size, lot_size=self.instrument.lot_size)
+    def trade(self, direction: bool, amount: float) -> Tuple[float, float]:
+        """
+        trades amount into the bids (direction True) or asks, see Liquidation_Curve.trade
+        """
+        levels = self.levels(direction)
+        memo = self.memos.setdefault(direction, dict())
+        try:
+            version, worst_px, proceeds, remaining = memo[amount]
+            if not levels.changed_within(version, worst_px):
+                memo[amount] = (levels.version, worst_px, proceeds, remaining)
+                return proceeds, remaining
+        except KeyError:
+            if len(memo) >= self.memo_size:
+                memo.clear()
+        curve = self.curve_for(direction, amount)
+        proceeds, remaining = curve.trade(amount)
+        memo[amount] = (levels.version, curve.worst_price(amount), proceeds, remaining)
+        return proceeds, remaining
+
+
+@dataclasses.dataclass
+class Currency:
+    name: str
+    symbol: str
+    unit: str
+
+
+@dataclasses.dataclass
+class Wallet:
+    name: str
+    curr_amounts: dataclasses.InitVar[Mapping[str, float]]
+    investments: Mapping[str, float] = dataclasses.field(default_factory=dict)
+    currencies: Mapping[str, Currency] = dataclasses.field(init=False)
+    amounts: Mapping[str, float] = dataclasses.field(init=False)
+    values: Mapping[str, float] = dataclasses.field(init=False)
+    def __post_init__(self, curr_amounts):
+        dollar = Currency(name="dollar", symbol="USD", unit="$")
+        euro = Currency(name="euro", symbol="EUR", unit="€")
+        bitcoin = Currency(name="bitcoin", symbol="BTC", unit="₿")
+        ether = Currency(name="ether", symbol="ETH", unit="Ξ")
+        litecoin = Currency(name="litecoin", symbol="LTC", unit="Ł")
+        symbols = ("USD", "EUR", "BTC", "ETH", "LTC")
+        curr = (dollar, euro, bitcoin, ether, litecoin)
+        possible_currencies = dict(zip(symbols, curr))
+        self.currencies = dict()
+        self.amounts = dict()
+        self.values = dict()
+        for symbol, amount in curr_amounts.items():
+            logger.debug(f"curr_amount: {symbol}: {amount}")
+            try:
+                self.currencies[symbol] = possible_currencies[symbol]
+                self.amounts[symbol] = amount
+                self.values[symbol] = 0
+            except KeyError:
+                logger.error(f"Currency {symbol} not implemented.")
+        for symbol in symbols:
+            if symbol not in self.investments:
+                self.investments[symbol] = 0
+    def log_value(self, total_value: float, target: str, stale: Sequence[str] = ()):
+        """
+        logs the value of the wallet in target, as every evaluate does
+        """
+        unit = self.currencies[target].unit if target in self.currencies else target + " "
+        gain = total_value / self.investments[target] - 1 if self.investments.get(target) else 0.0
+        if stale:
+            logger.warning("Invested: {}{:.2f}, current value: {}{:.2f}, {:.2%} gain, stale: {}.".format(unit, self.investments.get(target, 0), unit, total_value, gain, ", ".join(stale)))
+        else:
+            logger.info("Invested: {}{:.2f}, current value: {}{:.2f}, {:.2%} gain.".format(unit, self.investments.get(target, 0), unit, total_value, gain))
+
+
+@dataclasses.dataclass
+class Wallet_Batch:
+    """
+    Many wallets valued together in one target currency.
+    Holds one array of amounts per currency, so that a book side prices
+    all wallets in a single call, and the last proceeds per currency
+    together with the book side version and the depth they reached.
+    """
+    wallets: Sequence[Wallet]
+    target: str = "EUR"
+    names: List[str] = dataclasses.field(init=False)
+    amounts: Mapping[str, numpy.ndarray] = dataclasses.field(init=False)
+    investments: numpy.ndarray = dataclasses.field(init=False)
+    proceeds: Mapping[str, Tuple[int, float, numpy.ndarray]] = dataclasses.field(init=False, repr=False)
+    def __post_init__(self):
+        count = len(self.wallets)
+        self.names = [wallet.name for wallet in self.wallets]
+        self.proceeds = dict()
+        currencies = sorted({symbol for wallet in self.wallets for symbol in wallet.amounts})
+        self.amounts = dict()
+        for symbol in currencies:
+            self.amounts[symbol] = numpy.fromiter((wallet.amounts.get(symbol, 0) for wallet in self.wallets), dtype=float, count=count)
+        self.investments = numpy.fromiter((wallet.investments.get(self.target, 0) for wallet in self.wallets), dtype=float, count=count)
+
+
+@dataclasses.dataclass
+class Valuation_Table:
+    """
+    Values and gains of all wallets of a Wallet_Batch.
+    `values` holds the proceeds per source currency, one entry per wallet.
+    """
+    names: List[str]
+    target: str
+    values: Mapping[str, numpy.ndarray]
+    totals: numpy.ndarray
+    gains: numpy.ndarray
+    stale: List[str] = dataclasses.field(default_factory=list)
+    def rows(self):
+        """
+        yields name, total value and gain of each wallet
+        """
+        yield from zip(self.names, self.totals.tolist(), self.gains.tolist())
+
+
+@dataclasses.dataclass
+class Message:
+    seqnum: str = ""
+    event: str = ""
+    channel: str = ""
+    timestamp: str = ""
+    symbol: str = ""
+    bids: List[Mapping[str, Union[str, float, int]]] = dataclasses.field(default_factory=list)
+    asks: List[Mapping[str, Union[str, float, int]]] = dataclasses.field(default_factory=list)
+
+
+class Exchange:
+    """
+    Holds the Order Books for several symbols in a stock exchange.
+    A stock exchange in this case is one particular exchange server, 
+    e.g. `exchange.blockchain.com`
+    Pass instruments, a mapping of symbol to Instrument, to keep the order
+    books of those symbols in fixed-point mode.
+    With depth_limit the order books only keep the levels sorted which
+    valuations reach, see Bounded_Levels.
+    `sequencer` drops level 3 messages out of order and the updates of stale
+    symbols until their next snapshot. It sees only the level 3 frames, whose
+    seqnums skip those of other channels and symbols, so it does not look for
+    gaps; the receive layer does and marks the symbols stale, see sequencing.py.
+    """
+    def __init__(self, symbols, instruments: Optional[Mapping[str, Instrument]] = None, depth_limit: Optional[int] = None):
+        self.symbols = symbols
+        self.instruments = dict(instruments or dict())
+        self.depth_limit = depth_limit
+        self.order_books = dict(zip((symbol for symbol in self.symbols), (Order_Book(symbol=symbol, instrument=self.instruments.get(symbol), depth_limit=depth_limit) for symbol in self.symbols)))
+        self.last_values = dict()
+        self.sequencer = sequencing.Sequence_Tracker(self.symbols, per_symbol=True, contiguous=False)
+        self.routes = dict()
+        self.best_routes = dict()
+        self.max_hops = 3
+        self.route_cache_size = 1024
+        self.impact_curves = OrderedDict()
+        self.impact_cache_size = 64
+    def cascaded_trade(self, to_sell: float, orders: Mapping[float, float], direction: bool, ob_symbol: str):
+        if direction:
+            selling_currency = ob_symbol.split("-")[0]
+            buying_currency = ob_symbol.split("-")[1]
+        else:
+            selling_currency = ob_symbol.split("-")[0]
+            buying_currency = ob_symbol.split("-")[1]
+        offers = sorted(orders.items(), reverse=not direction)
+        still_to_sell = to_sell
+        sold_value = 0
+        # the messages below are built per price level, only when they are wanted
+        debug = logger.isEnabledFor(logging.DEBUG)
+        while still_to_sell > 0:
+            if direction:
+                try:
+                    price, available = offers.pop()
+                    if debug:
+                        logger.debug(f"Best offer is buying {available} {selling_currency} at a price of {price} {buying_currency} per 1 {selling_currency}.")
+                    selling = min(still_to_sell, available)
+                    if debug:
+                        logger.debug(f"Can sell {selling} {selling_currency}")
+                    trade_value = price * selling
+                    if debug:
+                        logger.debug(f"Selling {selling} {selling_currency} for {trade_value} {buying_currency}.")
+                    still_to_sell = still_to_sell - selling
+                    sold_value = sold_value + trade_value
+                    if debug:
+                        logger.debug(f"Total sold {to_sell - still_to_sell} {selling_currency}, for {sold_value} {buying_currency}")
+                        logger.debug(f"Still to sell {still_to_sell} {selling_currency}.")
+                except IndexError:
+                    logger.error(f"Cannot trade remaining {still_to_sell} {selling_currency}. No more bids.")
+                    break
+            else:
+                try:
+                    price, available = offers.pop()
+                    if debug:
+                        logger.debug(f"Best offer is selling {available} {selling_currency} at a price of {price} {buying_currency} per 1 {selling_currency}")
+                        logger.debug(f"{still_to_sell} {buying_currency} could buy me {still_to_sell / price} {selling_currency}.")
+                    selling = min(available, still_to_sell / price)
+                    if debug:
+                        logger.debug(f"min({available}, {still_to_sell / price})")
+                        logger.debug(f"Can buy some {selling_currency} for {still_to_sell} {buying_currency} at a price of {price} {buying_currency} per 1 {selling_currency}.")
+                    trade_value = selling
+                    if debug:
+                        logger.debug(f"Buying {selling} {selling_currency} for {selling * price} {buying_currency}.")
+                    still_to_sell = still_to_sell - selling * price
+                    sold_value = sold_value + trade_value
+                    if debug:
+                        logger.debug(f"Total sold {to_sell - still_to_sell} {buying_currency}, for {sold_value} {selling_currency}")
+                        logger.debug(f"Still to sell {still_to_sell} {buying_currency}.")
+                except IndexError:
+                    logger.error(f"Cannot trade remaining {still_to_sell} {buying_currency}. No more asks.")
+                    break
+        return sold_value, still_to_sell
+    def find_order_book(self, source: str, target: str) -> Tuple[Order_Book, bool]:
+        """
+        Returns the order book trading source against target and the direction:
+        True if source is its base currency (sell into bids), False otherwise
+        """
+        try:
+            return self.order_books["-".join((source, target))], True
+        except KeyError:
+            return self.order_books["-".join((target, source))], False
+    def conversion_routes(self, source: str, target: str) -> List[List[Tuple[Order_Book, bool]]]:
+        """
+        Returns all routes from source to target over the order books of the
+        exchange with at most max_hops books, each a list of (order book, direction)
+        """
+        key = (source, target)
+        if key in self.routes:
+            return self.routes[key]
+        edges = dict()
+        for symbol, ob in self.order_books.items():
+            base, quote = symbol.split("-")
+            edges.setdefault(base, list()).append((quote, ob, True))
+            edges.setdefault(quote, list()).append((base, ob, False))
+        routes = list()
+        def extend(currency, route, visited):
+            if currency == target:
+                routes.append(route)
+                return
+            if len(route) >= self.max_hops:
+                return
+            for next_currency, ob, direction in edges.get(currency, ()):
+                if next_currency not in visited:
+                    extend(next_currency, route + [(ob, direction)], visited | {next_currency})
+        extend(source, list(), {source})
+        routes.sort(key=len)
+        self.routes[key] = routes
+        return routes
+    def trade_route(self, route: Sequence[Tuple[Order_Book, bool]], amount: float) -> float:
+        """
+        trades amount along the route and returns what arrives at its end
+        """
+        for ob, direction in route:
+            amount = ob.trade(direction, amount)[0]
+        return amount
+    def convert(self, amount: float, source: str, target: str) -> Tuple[float, List[Tuple[Order_Book, bool]]]:
+        """
+        Returns the proceeds of the best route from source to target for
+        amount, and that route. The proceeds of every route are cached per
+        amount with the versions of the book sides it trades on; only the
+        routes on a side which changed are traded again.
+        Raises KeyError when there is no route.
+        """
+        routes = self.conversion_routes(source, target)
+        if not routes:
+            raise KeyError(f"No route from {source} to {target}")
+        key = (source, target, amount)
+        cached = self.best_routes.get(key)
+        if cached is None:
+            if len(self.best_routes) >= self.route_cache_size:
+                self.best_routes.clear()
+            cached = self.best_routes[key] = [None] * len(routes)
+        best_value, best_route = None, None
+        for position, route in enumerate(routes):
+            stamps = tuple(ob.levels(direction).version for ob, direction in route)
+            entry = cached[position]
+            if entry is None or entry[0] != stamps:
+                value = self.trade_route(route, amount)
+                # a depth-limited side moves its version on when the trade sorts in more levels
+                entry = cached[position] = (tuple(ob.levels(direction).version for ob, direction in route), value)
+            if best_value is None or entry[1] > best_value:
+                best_value, best_route = entry[1], route
+        return best_value, best_route
+    def impact_curve(self, symbol: str, direction: bool) -> liquidation.Price_Impact_Curve:
+        """
+        Price impact of selling into the bids (direction True) or buying from the
+        asks of the order book of symbol, over all of its levels.
+        Curves are built once per version of the book side and the latest
+        impact_cache_size of them are kept, the least recently used go first.
+        """
+        ob = self.order_books[symbol]
+        version = ob.levels(direction).version
+        key = (symbol, direction, version)
+        try:
+            self.impact_curves.move_to_end(key)
+            return self.impact_curves[key]
+        except KeyError:
+            pass
+        curve = liquidation.Price_Impact_Curve(ob.whole_curve(direction), symbol, version)
+        self.impact_curves[key] = curve
+        while len(self.impact_curves) > self.impact_cache_size:
+            self.impact_curves.popitem(last=False)
+        return curve
+    def change_currency (self, wallet: Wallet, source: str, target: str):
+        """
+        Changes currency from one to another using the best route over the orderbooks
+        """
+        return self.change_currency_route(wallet, source, target)[0]
+    def change_currency_route(self, wallet: Wallet, source: str, target: str):
+        """
+        change_currency, also returning the route as (order book, direction) pairs
+        """
+        sold_value, route = self.convert(wallet.amounts[source], source, target)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Selling {wallet.amounts[source]} {source} for {sold_value} {target} via {', '.join(ob.symbol for ob, direction in route)}.")
+        wallet.values[target] = sold_value
+        return sold_value, route
+    def evaluate(self, wallet: Wallet, target: str = "EUR"):
+        """
+        Values the wallet in target and logs it when the value changed
+        since the last evaluation of this wallet.
+        Currencies without a route to target are left out.
+        """
+        registry = metrics.registry
+        if registry.enabled:
+            started = time.perf_counter_ns()
+            total_value = self.evaluate_wallet(wallet, target)
+            registry.observe("evaluate", started)
+            return total_value
+        return self.evaluate_wallet(wallet, target)
+    def evaluate_wallet(self, wallet: Wallet, target: str):
+        total_value = 0
+        books = set()
+        for source in wallet.amounts:
+            if source == target:
+                continue
+            try:
+                value, route = self.change_currency_route(wallet, source, target)
+            except KeyError:
+                logger.debug(f"No route from {source} to {target}.")
+                continue
+            total_value = total_value + value
+            books.update(ob.symbol for ob, direction in route)
+        if self.last_values.get(wallet.name) == total_value:
+            return total_value
+        self.last_values[wallet.name] = total_value
+        wallet.log_value(total_value, target, sorted(symbol for symbol in books if self.sequencer.is_stale(symbol)))
+        return total_value
+    def evaluate_many(self, wallets: Union[Wallet_Batch, Sequence[Wallet]], target: str = "EUR") -> Valuation_Table:
+        """
+        Values many wallets in one pass.
+        Every currency held in the wallets which has an order book against
+        target is liquidated in that book; each book side builds its
+        liquidation curve once per version and prices all wallets at once.
+        Pass the same Wallet_Batch on every call to avoid collecting the
+        amounts again and to reuse the proceeds while the book sides did
+        not change within the depth the largest amount consumes.
+        """
+        if not isinstance(wallets, Wallet_Batch):
+            wallets = Wallet_Batch(list(wallets), target=target)
+        values = dict()
+        stale_symbols = list()
+        totals = numpy.zeros(len(wallets.wallets))
+        for source, amounts in wallets.amounts.items():
+            if source == wallets.target:
+                continue
+            try:
+                ob, direction = self.find_order_book(source, wallets.target)
+            except KeyError:
+                continue
+            if self.sequencer.is_stale(ob.symbol):
+                stale_symbols.append(ob.symbol)
+            levels = ob.levels(direction)
+            try:
+                version, worst_px, proceeds = wallets.proceeds[source]
+                stale = levels.changed_within(version, worst_px)
+            except KeyError:
+                stale = True
+            if stale:
+                curve = ob.curve_for(direction, amounts.max(initial=0))
+                proceeds, still_to_sell = curve.trade_many(amounts)
+                worst_px = curve.worst_price(amounts.max(initial=0))
+            wallets.proceeds[source] = (levels.version, worst_px, proceeds)
+            values[source] = proceeds
+            totals = totals + proceeds
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            gains = totals / wallets.investments - 1
+        return Valuation_Table(names=wallets.names, target=wallets.target, values=values, totals=totals, gains=gains, stale=stale_symbols)
+    def process_update(self, message):
+        self.apply_orders(message["symbol"], message["bids"], message["asks"])
+    def apply_orders(self, symbol: str, bids: Sequence[Mapping], asks: Sequence[Mapping]):
+        """
+        Applies level 3 entries to the order book of symbol,
+        an entry with qty 0 deletes the order
+        """
+        order_book = self.order_books[symbol]
+        for bid in bids:
+            if bid["qty"] == 0:
+                order_book.delete_order("bids", bid["id"])
+            else:
+                order_book.set_order("bids", bid["id"], bid["px"], bid["qty"])
+        for ask in asks:
+            if ask["qty"] == 0:
+                order_book.delete_order("asks", ask["id"])
+            else:
+                order_book.set_order("asks", ask["id"], ask["px"], ask["qty"])
+    def apply_entries(self, symbol: str, bids: Sequence[Tuple[int, float, float]], asks: Sequence[Tuple[int, float, float]]):
+        """
+        Like apply_orders, for (id, px, qty) tuples as decoded by decoder.Decoder
+        """
+        order_book = self.order_books[symbol]
+        for id, px, qty in bids:
+            if qty == 0:
+                order_book.delete_order("bids", id)
+            else:
+                order_book.set_order("bids", id, px, qty)
+        for id, px, qty in asks:
+            if qty == 0:
+                order_book.delete_order("asks", id)
+            else:
+                order_book.set_order("asks", id, px, qty)
+    def admit(self, message) -> bool:
+        """
+        tells whether the message is in sequence and its book is not stale
+        """
+        return self.sequencer.admit(message.get("channel"), message.get("symbol"), message.get("event"), message.get("seqnum"))
+    def process_batch(self, batch):
+        """
+        processes a decoder.Update_Batch
+        """
+        if not self.sequencer.admit(batch.channel, batch.symbol, batch.event, batch.seqnum):
+            return
+        if batch.event == "snapshot":
+            self.order_books[batch.symbol].clear()
+        if batch.event in ("updated", "snapshot"):
+            self.apply_entries(batch.symbol, batch.bids, batch.asks)
+        elif batch.event == "subscribed":
+            logger.debug(f"Subscribed to {batch.symbol}")
+        else:
+            logger.debug(f"Unknown message: {batch}")
+    def process_subscribed(self, message):
+        logger.debug(f"Subscribed to {message['symbol']}")
+    def process_unknown(self, message):
+        logger.debug("Unknown message:")
+        logger.debug(message)
+    def process_snapshot(self, message):
+        self.order_books[message["symbol"]].clear()
+        self.process_update(message)
+    def process(self, message):
+        registry = metrics.registry
+        if registry.enabled:
+            started = time.perf_counter_ns()
+            self.process_message(message)
+            registry.observe("process", started)
+        else:
+            self.process_message(message)
+    def process_message(self, message):
+        if not self.admit(message):
+            return
+        if message.get("event") == "updated":
+            self.process_update(message)
+        elif message.get("event") == "snapshot":
+            self.process_snapshot(message)
+        elif message.get("event") == "subscribed":
+            self.process_subscribed(message)
+        else:
+            self.process_unknown(message)
+
+
+if __name__ == "__main__":
+    pass
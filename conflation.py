@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# conflation.py
+
+"""
+Conflation of level 3 updates for consumers which fall behind the feed.
+Instead of processing and valuing message by message, everything that queued
+up since the last batch is applied at once: the deltas of all update messages
+of a symbol are merged per order id, applied in one go, and valuation runs
+once per batch for the symbols which changed.
+
+    for batch in conflation.batches(server.listen()):
+        conflator.process_batch(batch)
+"""
+
+import collections
+import logging
+import queue
+import threading
+from typing import Callable
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Mapping
+from typing import Optional
+
+#Own modules:
+import classes
+
+
+logger = logging.getLogger(__name__)
+
+
+class Conflator:
+    """
+    Applies batches of messages to an exchange.
+    `evaluate` is called once per batch with the symbols whose books changed.
+    """
+    def __init__(self, exchange: classes.Exchange, evaluate: Optional[Callable[[List[str]], object]] = None):
+        self.exchange = exchange
+        self.evaluate = evaluate
+        self.messages = 0
+        self.batches = 0
+        self.entries = 0
+        self.applied = 0
+        self.coalesced = collections.Counter()
+    def counters(self) -> dict:
+        """
+        messages and order entries received versus applied,
+        and how many update messages were merged into others per symbol
+        """
+        return {
+            "messages": self.messages,
+            "batches": self.batches,
+            "entries": self.entries,
+            "applied": self.applied,
+            "coalesced": dict(self.coalesced),
+        }
+    def apply(self, symbol: str, sides: Mapping[str, Mapping[int, Mapping]]):
+        order_book = self.exchange.order_books[symbol]
+        # an order added and deleted within the batch never reaches the book
+        bids, asks = ([entry for id, entry in sides[side].items() if entry["qty"] != 0 or id in getattr(order_book, side)] for side in ("bids", "asks"))
+        self.applied = self.applied + len(bids) + len(asks)
+        self.exchange.apply_orders(symbol, bids, asks)
+    def process_batch(self, messages: Iterable[Mapping]) -> List[str]:
+        """
+        processes the messages and returns the symbols whose books changed
+        """
+        pending = dict()
+        updates = collections.Counter()
+        for message in messages:
+            self.messages = self.messages + 1
+            symbol = message.get("symbol")
+            if message.get("channel") == "l3" and message.get("event") == "updated":
+                if not self.exchange.admit(message):
+                    continue
+                sides = pending.setdefault(symbol, {"bids": dict(), "asks": dict()})
+                for side in ("bids", "asks"):
+                    merged = sides[side]
+                    for entry in message[side]:
+                        merged[entry["id"]] = entry
+                    self.entries = self.entries + len(message[side])
+                updates[symbol] = updates[symbol] + 1
+                continue
+            if symbol in pending:
+                sides = pending.pop(symbol)
+                # a snapshot replaces the book anyway
+                if message.get("event") != "snapshot":
+                    self.apply(symbol, sides)
+            self.exchange.process(message)
+            if message.get("channel") == "l3" and message.get("event") == "snapshot":
+                updates[symbol] = updates[symbol] + 1
+        for symbol, sides in pending.items():
+            self.apply(symbol, sides)
+        for symbol, count in updates.items():
+            self.coalesced[symbol] = self.coalesced[symbol] + count - 1
+        self.batches = self.batches + 1
+        changed = list(updates)
+        if changed and self.evaluate is not None:
+            self.evaluate(changed)
+        return changed
+
+
+def batches(messages: Iterable[Mapping], max_batch: int = 10000, maxsize: int = 100000) -> Iterator[List[Mapping]]:
+    """
+    Reads messages on a background thread and yields everything that queued
+    up while the previous batch was being processed, at most max_batch at once
+    """
+    backlog = queue.Queue(maxsize=maxsize)
+    done = object()
+    def read():
+        try:
+            for message in messages:
+                backlog.put(message)
+        finally:
+            backlog.put(done)
+    threading.Thread(target=read, name="conflation", daemon=True).start()
+    while True:
+        message = backlog.get()
+        if message is done:
+            return
+        batch = [message]
+        while len(batch) < max_batch:
+            try:
+                message = backlog.get_nowait()
+            except queue.Empty:
+                break
+            if message is done:
+                yield batch
+                return
+            batch.append(message)
+        yield batch
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# decoder.py
+
+"""
+Decodes raw websocket frames once, into compact typed objects, and routes
+them by channel through a table:
+
+    decoder = Decoder(routes={"l3": exchange.process_batch})
+    for frame in server.frames():
+        channel, seqnum = decoder.dispatch(frame)
+        svr.save_frame(channel, frame, seqnum)
+
+Level 3 frames become Update_Batch tuples whose bids and asks are
+(id, px, qty) tuples. Frames of channels which are not materialized are only
+peeked at for their channel and seqnum and passed on as Raw_Frame, so that a
+saver can store them without a full JSON parse.
+orjson is used for parsing when it is installed, json otherwise.
+"""
+
+import json
+import logging
+import re
+from typing import Callable
+from typing import Iterable
+from typing import List
+from typing import Mapping
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    orjson = None
+    loads = json.loads
+
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = re.compile(r'"channel"\s*:\s*"([^"]*)"')
+SEQNUM = re.compile(r'"seqnum"\s*:\s*(\d+)')
+SYMBOL = re.compile(r'"symbol"\s*:\s*"([^"]*)"')
+
+
+class Update_Batch(NamedTuple):
+    """
+    A level 3 message with its orders as (id, px, qty) tuples
+    """
+    seqnum: int
+    event: str
+    channel: str
+    symbol: str
+    timestamp: str
+    bids: List[Tuple[int, float, float]]
+    asks: List[Tuple[int, float, float]]
+
+
+class Raw_Frame(NamedTuple):
+    """
+    A frame which was not parsed
+    """
+    seqnum: int
+    channel: str
+    frame: str
+
+
+def peek(frame: str, head: int = 256) -> Tuple[str, int]:
+    """
+    returns channel and seqnum of a frame without parsing it;
+    the exchange sends them first, so only the head is searched unless
+    they are not found there
+    """
+    channel = CHANNEL.search(frame, 0, head) or CHANNEL.search(frame)
+    seqnum = peek_seqnum(frame, head)
+    return (channel.group(1) if channel else ""), (seqnum if seqnum is not None else 0)
+
+
+def peek_seqnum(frame: str, head: int = 256) -> Optional[int]:
+    """
+    returns the seqnum of a frame without parsing it, None if it has none
+    """
+    seqnum = SEQNUM.search(frame, 0, head) or SEQNUM.search(frame)
+    return int(seqnum.group(1)) if seqnum else None
+
+
+def peek_symbol(frame: str, head: int = 256) -> Optional[str]:
+    """
+    returns the symbol of a frame without parsing it, None if it has none
+    """
+    symbol = SYMBOL.search(frame, 0, head) or SYMBOL.search(frame)
+    return symbol.group(1) if symbol else None
+
+
+def decode_l3(message: Mapping) -> Update_Batch:
+    return Update_Batch(
+        seqnum=message.get("seqnum", 0),
+        event=message.get("event", ""),
+        channel=message.get("channel", "l3"),
+        symbol=message.get("symbol", ""),
+        timestamp=message.get("timestamp", ""),
+        bids=[(entry["id"], entry["px"], entry["qty"]) for entry in message.get("bids", ())],
+        asks=[(entry["id"], entry["px"], entry["qty"]) for entry in message.get("asks", ())],
+    )
+
+
+class Decoder:
+    """
+    Decodes frames by channel: channels with an entry in `decoders` are parsed
+    and converted, other channels in `materialize` are parsed into dicts and
+    all remaining channels are passed on as Raw_Frame.
+    `routes` maps channel to the callable that receives the decoded frame.
+    """
+    decoders = {"l3": decode_l3}
+    def __init__(self, routes: Optional[Mapping[str, Callable]] = None, materialize: Iterable[str] = ("l3",)):
+        self.routes = dict(routes or dict())
+        self.materialize = set(materialize)
+        self.decoded = 0
+        self.raw = 0
+    def decode_frame(self, frame: Union[str, bytes]) -> Tuple[str, int, Union[Update_Batch, Mapping, Raw_Frame]]:
+        if isinstance(frame, bytes):
+            frame = frame.decode("utf-8")
+        channel, seqnum = peek(frame)
+        if channel not in self.materialize:
+            self.raw = self.raw + 1
+            return channel, seqnum, Raw_Frame(seqnum=seqnum, channel=channel, frame=frame)
+        self.decoded = self.decoded + 1
+        message = loads(frame)
+        convert = self.decoders.get(channel)
+        if convert is None:
+            return channel, seqnum, message
+        return channel, seqnum, convert(message)
+    def decode(self, frame: Union[str, bytes]) -> Union[Update_Batch, Mapping, Raw_Frame]:
+        return self.decode_frame(frame)[2]
+    def dispatch(self, frame: Union[str, bytes]) -> Tuple[str, int]:
+        """
+        decodes the frame, hands it to the route of its channel
+        and returns channel and seqnum
+        """
+        channel, seqnum, decoded = self.decode_frame(frame)
+        route = self.routes.get(channel)
+        if route is not None:
+            route(decoded)
+        return channel, seqnum
+
+
+if __name__ == "__main__":
+    pass
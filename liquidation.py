@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# liquidation.py
+
+import logging
+from typing import Mapping
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+import numpy
+
+
+logger = logging.getLogger(__name__)
+
+
+class Liquidation_Curve:
+    """
+    Cumulative depth of one side of an order book.
+    Answers what a trade of a given size fetches with a binary search and
+    one interpolation instead of walking the price levels one by one.
+
+    With direction True the curve is built from bids: amounts are in the base
+    currency of the order book and proceeds in the quote currency.
+    With direction False it is built from asks: amounts are in the quote
+    currency and proceeds in the base currency.
+
+    Levels of a book in fixed-point mode hold integer ticks and lots; with
+    tick_size and lot_size given they are summed as integers and scaled to
+    prices and quantities once. `keys` keeps the prices as the levels hold them.
+    """
+    def __init__(self, levels: Mapping[float, float], direction: bool, tick_size: Optional[float] = None, lot_size: Optional[float] = None):
+        """
+        levels must iterate from the best price outwards, as Price_Levels does
+        """
+        self.direction = direction
+        count = len(levels)
+        if tick_size is None:
+            self.keys = self.prices = numpy.fromiter(levels.keys(), dtype=float, count=count)
+            self.quantities = numpy.fromiter(levels.values(), dtype=float, count=count)
+            self.cum_qty = numpy.concatenate(((0.0,), numpy.cumsum(self.quantities)))
+        else:
+            self.keys = numpy.fromiter(levels.keys(), dtype=numpy.int64, count=count)
+            lots = numpy.fromiter(levels.values(), dtype=numpy.int64, count=count)
+            self.prices = self.keys * tick_size
+            self.quantities = lots * lot_size
+            self.cum_qty = numpy.concatenate(((0,), numpy.cumsum(lots))) * lot_size
+        self.cum_notional = numpy.concatenate(((0.0,), numpy.cumsum(self.prices * self.quantities)))
+        if direction:
+            self.spent, self.fetched, rates = self.cum_qty, self.cum_notional, self.prices
+        else:
+            self.spent, self.fetched, rates = self.cum_notional, self.cum_qty, 1 / self.prices
+        # proceeds are piecewise linear in the amount: within level k they are
+        # intercepts[k] + amount * slopes[k]; the extra last piece is flat
+        self.slopes = numpy.concatenate((rates, (0.0,)))
+        self.intercepts = self.fetched - self.spent * self.slopes
+    @classmethod
+    def from_arrays(cls, prices: numpy.ndarray, spent: numpy.ndarray, intercepts: numpy.ndarray, slopes: numpy.ndarray, direction: bool) -> "Liquidation_Curve":
+        """
+        a curve over arrays built elsewhere, e.g. views into shared memory, without copying them
+        """
+        curve = cls.__new__(cls)
+        curve.direction = direction
+        curve.keys = curve.prices = prices
+        curve.spent = spent
+        curve.intercepts = intercepts
+        curve.slopes = slopes
+        return curve
+    def arrays(self, depth: Optional[int] = None) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        """
+        prices, spent, intercepts and slopes, as from_arrays takes them,
+        cut to the best depth levels; past those the proceeds stay flat
+        """
+        levels = len(self.prices) if depth is None else min(len(self.prices), depth)
+        intercepts = numpy.concatenate((self.intercepts[:levels], self.fetched[levels:levels + 1]))
+        slopes = numpy.concatenate((self.slopes[:levels], (0.0,)))
+        return self.prices[:levels], self.spent[:levels + 1], intercepts, slopes
+    def __len__(self) -> int:
+        return len(self.prices)
+    def trade_many(self, amounts: Union[numpy.ndarray, list]) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        returns the proceeds and the part of each amount which could not be traded
+        """
+        amounts = numpy.asarray(amounts, dtype=float)
+        tradable = numpy.maximum(amounts, 0.0)
+        level = numpy.searchsorted(self.spent[1:], tradable, side="left")
+        proceeds = self.intercepts[level] + tradable * self.slopes[level]
+        remaining = amounts - numpy.minimum(tradable, self.spent[-1])
+        return proceeds, remaining
+    def worst_price(self, amount: float) -> Optional[float]:
+        """
+        returns the price of the deepest level a trade of amount reaches,
+        as the levels hold it, None if it exhausts the book
+        """
+        level = int(numpy.searchsorted(self.spent[1:], amount, side="left"))
+        if level < len(self.keys):
+            return self.keys[level].item()
+        return None
+    def trade(self, amount: float) -> Tuple[float, float]:
+        """
+        returns the proceeds of trading amount and the part which could not be traded
+        """
+        proceeds, remaining = self.trade_many((amount,))
+        if remaining[0] > 0:
+            logger.error(f"Cannot trade remaining {remaining[0]}. No more {'bids' if self.direction else 'asks'}.")
+        return float(proceeds[0]), float(remaining[0])
+
+
+class Price_Impact_Curve:
+    """
+    Proceeds, average execution price and slippage of one side of an order
+    book as functions of the size traded, over a Liquidation_Curve.
+    Sizes are in the currency the side takes: the base currency for bids,
+    the quote currency for asks. Prices are quote per base on both sides;
+    slippage is how much worse than the best price the average price is,
+    as a fraction. Queries take one size or an array of them and cost a
+    binary search each.
+    """
+    def __init__(self, curve: Liquidation_Curve, symbol: str = "", version: Optional[int] = None):
+        self.curve = curve
+        self.symbol = symbol
+        self.version = version
+        self.direction = curve.direction
+        self.spent = curve.spent
+        # proceeds at the end of every level, also for curves made by from_arrays
+        self.fetched = curve.intercepts + curve.spent * curve.slopes
+        # proceeds per unit of size at the end of every level, never rising
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            self.yields = self.fetched[1:] / self.spent[1:]
+        self.best_yield = float(curve.slopes[0]) if len(curve) else 0.0
+    def __len__(self) -> int:
+        return len(self.curve)
+    @property
+    def depth(self) -> float:
+        """
+        largest size the side takes
+        """
+        return float(self.spent[-1])
+    @property
+    def best_price(self) -> Optional[float]:
+        return float(self.curve.prices[0]) if len(self.curve) else None
+    def proceeds(self, sizes: Union[float, numpy.ndarray, list]) -> Union[float, numpy.ndarray]:
+        """
+        proceeds of trading each size, sizes past the depth only fetch the whole side
+        """
+        proceeds, remaining = self.curve.trade_many(numpy.atleast_1d(sizes))
+        return proceeds if numpy.ndim(sizes) else float(proceeds[0])
+    def average_price(self, sizes: Union[float, numpy.ndarray, list]) -> Union[float, numpy.ndarray]:
+        """
+        average execution price of trading each size, nan for sizes the side cannot take
+        """
+        scalar = not numpy.ndim(sizes)
+        sizes = numpy.atleast_1d(numpy.asarray(sizes, dtype=float))
+        proceeds, remaining = self.curve.trade_many(sizes)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            yields = numpy.where((remaining > 0) | (sizes <= 0), numpy.nan, proceeds / sizes)
+            prices = yields if self.direction else 1 / yields
+        return float(prices[0]) if scalar else prices
+    def slippage(self, sizes: Union[float, numpy.ndarray, list]) -> Union[float, numpy.ndarray]:
+        """
+        fraction by which the average price of each size is worse than the best price
+        """
+        scalar = not numpy.ndim(sizes)
+        prices = self.average_price(numpy.atleast_1d(sizes))
+        best = self.best_price
+        if best is None:
+            slippage = numpy.full(len(prices), numpy.nan)
+        else:
+            slippage = 1 - prices / best if self.direction else prices / best - 1
+        return float(slippage[0]) if scalar else slippage
+    def max_size(self, slippage: Union[float, numpy.ndarray, list]) -> Union[float, numpy.ndarray]:
+        """
+        largest size whose average price is at most slippage worse than the best price
+        """
+        scalar = not numpy.ndim(slippage)
+        slippage = numpy.atleast_1d(numpy.asarray(slippage, dtype=float))
+        if not len(self.curve):
+            sizes = numpy.zeros(len(slippage))
+            return float(sizes[0]) if scalar else sizes
+        # the lowest proceeds per unit of size allowed
+        if self.direction:
+            threshold = self.best_yield * (1 - slippage)
+        else:
+            threshold = self.best_yield / (1 + slippage)
+        # levels which end with a yield at or above threshold are taken whole
+        levels = numpy.searchsorted(-self.yields, -threshold, side="right")
+        whole = levels >= len(self.yields)
+        level = numpy.minimum(levels, len(self.yields) - 1)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            # within the level proceeds are intercept + size * slope, solve for proceeds == threshold * size
+            sizes = self.curve.intercepts[level] / (threshold - self.curve.slopes[level])
+        sizes = numpy.where(whole, self.depth, numpy.clip(sizes, self.spent[level], self.spent[level + 1]))
+        return float(sizes[0]) if scalar else sizes
+    def size_for(self, proceeds: Union[float, numpy.ndarray, list]) -> Union[float, numpy.ndarray]:
+        """
+        size to trade for each amount of proceeds, nan past what the side can fetch
+        """
+        scalar = not numpy.ndim(proceeds)
+        proceeds = numpy.atleast_1d(numpy.asarray(proceeds, dtype=float))
+        level = numpy.searchsorted(self.fetched[1:], proceeds, side="left")
+        inside = level < len(self.curve)
+        level = numpy.minimum(level, max(len(self.curve) - 1, 0))
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            sizes = (proceeds - self.curve.intercepts[level]) / self.curve.slopes[level]
+        sizes = numpy.where(inside & (proceeds >= 0), sizes, numpy.nan)
+        return float(sizes[0]) if scalar else sizes
+
+
+if __name__ == "__main__":
+    pass
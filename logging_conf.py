@@ -26,16 +26,34 @@ The custom logger is configured to propagate its log records to the root logger
 So the only additional thing you get from this custom logger by default is
 an additional log file where only records or error level ERROR and higher are
 written.
+
+To keep file writes off the calling thread, move the handlers behind queues
+right after configuring:
+
+    logging.config.dictConfig(logging_conf.create_dict_config(...))
+    logging_conf.queue_handlers()
+
+Messages on hot paths should only be built when they will be logged:
+
+    debug = logger.isEnabledFor(logging.DEBUG)
+    ...
+    if debug:
+        logger.debug(f"...")
 """
 
 
+import atexit
+import logging
+import logging.handlers
 import pathlib
+import queue
 
 
-def create_dict_config(directory: pathlib.Path, all_log: str, error_log: str) -> dict:
+def create_dict_config(directory: pathlib.Path, all_log: str, error_log: str, level: str = "DEBUG") -> dict:
     """
     Creates a logging configuration with path to logfiles set as
-    given by the arguments
+    given by the arguments. level is the level of the root logger
+    and of the all_log file.
     """
     file_formatter_conf = {
         "format": "{asctime},{msecs:03.0f} {levelname:>9s} {module} {funcName}: {message}",
@@ -64,7 +82,7 @@ def create_dict_config(directory: pathlib.Path, all_log: str, error_log: str) ->
 
     root_file_handler_conf = {
         "class": "logging.FileHandler",
-        "level": "DEBUG",
+        "level": level,
         "formatter": "file_formatter",
         "filename": directory / all_log,
         "mode": "w",
@@ -94,7 +112,7 @@ def create_dict_config(directory: pathlib.Path, all_log: str, error_log: str) ->
 
     root_logger_conf = {
         "handlers": ["root_file_handler", "root_console_handler"],
-        "level": "DEBUG",
+        "level": level,
     }
 
     loggers_dict = {
@@ -111,3 +129,38 @@ def create_dict_config(directory: pathlib.Path, all_log: str, error_log: str) ->
         "incremental": False,
     }
     return dict_config
+
+
+def queue_handlers(names=("", "custom_logger")) -> list:
+    """
+    Replaces the handlers of the named loggers ("" is the root logger) by a
+    QueueHandler each and starts a QueueListener per logger which runs the
+    original handlers on a thread of its own. The listeners are stopped,
+    and their queues drained, at exit. Returns the listeners.
+    """
+    listeners = list()
+    for name in names:
+        logger = logging.getLogger(name)
+        handlers = list(logger.handlers)
+        if not handlers:
+            continue
+        records = queue.SimpleQueue()
+        queue_handler = logging.handlers.QueueHandler(records)
+        queue_handler.setLevel(min(handler.level for handler in handlers))
+        for handler in handlers:
+            logger.removeHandler(handler)
+        logger.addHandler(queue_handler)
+        listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)
+        listeners.append(listener)
+    return listeners
+
+
+def stop_queue_handlers(listeners: list):
+    """
+    stops listeners started by queue_handlers before exit, handling what is queued
+    """
+    for listener in listeners:
+        listener.stop()
+        atexit.unregister(listener.stop)
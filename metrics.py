@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# metrics.py
+
+"""
+Low overhead instrumentation of the pipeline: latency histograms per stage,
+message counts per channel and gauges read when metrics are collected.
+Everything goes into the module level `registry`, which is off until
+enabled; when off, instrumented code only pays for checking a flag:
+
+    metrics.registry.enable()
+    metrics.registry.serve(port=9108)         # Prometheus text on /metrics
+    metrics.registry.start_summary(60)        # one log line a minute
+
+Instrumenting a stage:
+
+    registry = metrics.registry
+    if registry.enabled:
+        started = time.perf_counter_ns()
+    ...
+    if registry.enabled:
+        registry.observe("process", started)
+
+The histograms keep 6 significant bits of every value, like an HDR
+histogram, so percentiles are within about 3% for any latency.
+"""
+
+import array
+import http.server
+import logging
+import threading
+import time
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Tuple
+
+
+logger = logging.getLogger(__name__)
+
+SUB_BITS = 6
+SUB_COUNT = 1 << SUB_BITS
+BUCKETS = 64 * SUB_COUNT
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class Histogram:
+    """
+    Counts of nanosecond values in log-linear buckets
+    """
+    def __init__(self):
+        self.counts = array.array("q", bytes(8 * BUCKETS))
+        self.count = 0
+        self.total = 0
+        self.max = 0
+    @staticmethod
+    def bucket(value: int) -> int:
+        bits = value.bit_length()
+        if bits <= SUB_BITS:
+            return value
+        shift = bits - SUB_BITS
+        return shift * SUB_COUNT + (value >> shift)
+    @staticmethod
+    def upper(bucket: int) -> int:
+        """
+        largest value counted in bucket
+        """
+        shift, mantissa = divmod(bucket, SUB_COUNT)
+        if not shift:
+            return mantissa
+        return ((mantissa + 1) << shift) - 1
+    def record(self, value: int):
+        if value < 0:
+            value = 0
+        self.counts[self.bucket(value)] += 1
+        self.count = self.count + 1
+        self.total = self.total + value
+        if value > self.max:
+            self.max = value
+    def percentile(self, quantile: float) -> int:
+        if not self.count:
+            return 0
+        rank = quantile * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen = seen + count
+            if count and seen >= rank:
+                return min(self.upper(bucket), self.max)
+        return self.max
+
+
+class Registry:
+    """
+    Histograms per stage, counters per (name, label) and gauge callbacks.
+    A gauge callback returns (labels, value) pairs, labels a dict.
+    The label of a counter is exported as channel unless `label_names` names it.
+    """
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.histograms: Dict[str, Histogram] = dict()
+        self.counters: Dict[Tuple[str, str], int] = dict()
+        self.label_names: Dict[str, str] = {"reconnects": "connection"}
+        self.gauges: Dict[str, Callable[[], Iterable[Tuple[dict, float]]]] = dict()
+        self.started = time.monotonic()
+        self.server = None
+        self.summary = None
+    def enable(self):
+        self.enabled = True
+    def disable(self):
+        self.enabled = False
+    def reset(self):
+        self.histograms.clear()
+        self.counters.clear()
+        self.started = time.monotonic()
+    def observe(self, stage: str, started: int):
+        """
+        records the time since started, a time.perf_counter_ns() value, for stage
+        """
+        self.record(stage, time.perf_counter_ns() - started)
+    def record(self, stage: str, elapsed: int):
+        """
+        records elapsed nanoseconds for stage, e.g. measured with another clock
+        """
+        try:
+            self.histograms[stage].record(elapsed)
+        except KeyError:
+            self.histograms[stage] = Histogram()
+            self.histograms[stage].record(elapsed)
+    def count(self, name: str, label: str = "", amount: int = 1):
+        key = (name, label)
+        self.counters[key] = self.counters.get(key, 0) + amount
+    def gauge(self, name: str, collect: Callable[[], Iterable[Tuple[dict, float]]]):
+        self.gauges[name] = collect
+    def exposition(self) -> str:
+        """
+        all metrics in the Prometheus text format
+        """
+        lines = list()
+        # copies, the processing thread may add keys meanwhile
+        histograms = list(self.histograms.items())
+        counters = list(self.counters.items())
+        gauges = list(self.gauges.items())
+        for stage, histogram in sorted(histograms):
+            name = f"cryptoworth_{stage}_seconds"
+            lines.append(f"# TYPE {name} summary")
+            for quantile in QUANTILES:
+                lines.append(f'{name}{{quantile="{quantile}"}} {histogram.percentile(quantile) / 1e9:.9f}')
+            lines.append(f"{name}_sum {histogram.total / 1e9:.9f}")
+            lines.append(f"{name}_count {histogram.count}")
+        names = sorted({name for (name, label), value in counters})
+        for name in names:
+            lines.append(f"# TYPE cryptoworth_{name}_total counter")
+            label_name = self.label_names.get(name, "channel")
+            for (counter, label), value in sorted(counters):
+                if counter == name:
+                    labels = f'{{{label_name}="{label}"}}' if label else ""
+                    lines.append(f"cryptoworth_{name}_total{labels} {value}")
+        for name, collect in sorted(gauges):
+            lines.append(f"# TYPE cryptoworth_{name} gauge")
+            try:
+                for labels, value in collect():
+                    text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+                    lines.append(f"cryptoworth_{name}{{{text}}} {value}" if text else f"cryptoworth_{name} {value}")
+            except Exception as error:
+                logger.error(f"Collecting gauge {name} failed: {error!r}")
+        return "\n".join(lines) + "\n"
+    def summary_line(self) -> str:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        parts = list()
+        for stage, histogram in sorted(list(self.histograms.items())):
+            parts.append(f"{stage} n={histogram.count} p50={histogram.percentile(0.5) / 1000:.1f}us p99={histogram.percentile(0.99) / 1000:.1f}us max={histogram.max / 1000:.1f}us")
+        for (name, label), value in sorted(list(self.counters.items())):
+            parts.append(f"{name}{'[' + label + ']' if label else ''}={value / elapsed:.1f}/s")
+        return "; ".join(parts)
+    def serve(self, port: int = 9108, host: str = "127.0.0.1") -> http.server.ThreadingHTTPServer:
+        """
+        serves the exposition on http://host:port/metrics from a daemon thread
+        """
+        registry = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.exposition().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+        logger.info(f"Serving metrics on http://{host}:{self.server.server_address[1]}/metrics")
+        return self.server
+    def start_summary(self, interval: float = 60) -> threading.Event:
+        """
+        logs summary_line every interval seconds until the returned event is set
+        """
+        stop = threading.Event()
+        def run():
+            while not stop.wait(interval):
+                if self.enabled:
+                    logger.info(self.summary_line())
+        threading.Thread(target=run, name="metrics-summary", daemon=True).start()
+        self.summary = stop
+        return stop
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.summary is not None:
+            self.summary.set()
+            self.summary = None
+
+
+registry = Registry()
+
+
+def book_sizes(exchange) -> Callable[[], Iterable[Tuple[dict, float]]]:
+    """
+    gauge callback with the number of orders and price levels of every book side
+    """
+    def collect():
+        for symbol, book in exchange.order_books.items():
+            for side in ("bids", "asks"):
+                yield {"symbol": symbol, "side": side, "kind": "orders"}, len(getattr(book, side))
+                yield {"symbol": symbol, "side": side, "kind": "levels"}, len(getattr(book, "l2" + side))
+    return collect
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# publication.py
+
+"""
+Publishes the liquidation curves of all order books of an exchange into
+shared memory, so that other local processes can value wallets without a
+feed of their own:
+
+    publisher = Publisher(exchange, "cryptoworth")
+    for message in server.listen():
+        exchange.process(message)
+        publisher.publish()
+
+and in another process
+
+    reader = Book_Reader("cryptoworth")
+    reader.evaluate({"BTC": 4.2, "ETH": 17.7}, target="EUR")
+
+Every book has a slot in the region holding, for bids and asks, the arrays a
+liquidation.Liquidation_Curve trades on, cut to `depth` levels. Each slot is
+guarded by a seqlock: the publisher makes its sequence odd before writing and
+even again after, a reader works straight on views into the region and
+retries when the sequence was odd or changed meanwhile. This relies on the
+stores reaching the other process in program order, as they do on x86-64.
+"""
+
+import logging
+import struct
+import time
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+from typing import Dict
+from typing import Mapping
+from typing import Optional
+from typing import Tuple
+
+import numpy
+
+#Own modules:
+import classes
+import liquidation
+
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"CWPB"
+LAYOUT = 1
+HEADER = struct.Struct("<4sIII")
+SYMBOL_SIZE = 32
+# seq, book version, bid levels, ask levels
+CONTROL = 4
+
+
+def slot_size(depth: int) -> int:
+    """
+    bytes of one book: control words, then prices, spent, intercepts and slopes of both sides
+    """
+    return 8 * (CONTROL + 2 * (4 * depth + 3))
+
+
+def side_arrays(buffer, offset: int, depth: int) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    """
+    views of prices, spent, intercepts and slopes of one side, starting at offset
+    """
+    data = numpy.ndarray((4 * depth + 3,), dtype=numpy.float64, buffer=buffer, offset=offset)
+    return data[:depth], data[depth:2 * depth + 1], data[2 * depth + 1:3 * depth + 2], data[3 * depth + 2:]
+
+
+class Region:
+    """
+    Layout of the shared memory region: a header, the symbol names and one slot per book
+    """
+    def __init__(self, shm: shared_memory.SharedMemory, symbols, depth: int):
+        self.shm = shm
+        self.symbols = list(symbols)
+        self.depth = depth
+        self.slots = dict()
+        start = HEADER.size + SYMBOL_SIZE * len(self.symbols)
+        start = start + (-start) % 8
+        for position, symbol in enumerate(self.symbols):
+            offset = start + position * slot_size(depth)
+            control = numpy.ndarray((CONTROL,), dtype=numpy.uint64, buffer=shm.buf, offset=offset)
+            sides = tuple(side_arrays(shm.buf, offset + 8 * CONTROL + side * 8 * (4 * depth + 3), depth) for side in (0, 1))
+            self.slots[symbol] = (control, sides)
+    @staticmethod
+    def size(symbols, depth: int) -> int:
+        start = HEADER.size + SYMBOL_SIZE * len(symbols)
+        return start + (-start) % 8 + len(symbols) * slot_size(depth)
+
+
+class Publisher:
+    """
+    Creates the shared memory region `name` and writes the curves of every
+    book whose version changed since the last publish.
+    Building a curve costs time linear in the depth of the book; with
+    min_interval calls to publish within that many seconds of the last
+    one are skipped. Books with a depth_limit keep the published depth
+    sorted, see Order_Book.curve_levels.
+    """
+    def __init__(self, exchange: classes.Exchange, name: str, depth: int = 1000, min_interval: float = 0.0):
+        self.exchange = exchange
+        self.min_interval = min_interval
+        self.last = None
+        symbols = list(exchange.order_books)
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=Region.size(symbols, depth))
+        self.shm.buf[:HEADER.size] = HEADER.pack(MAGIC, LAYOUT, len(symbols), depth)
+        for position, symbol in enumerate(symbols):
+            encoded = symbol.encode("utf-8")[:SYMBOL_SIZE]
+            start = HEADER.size + position * SYMBOL_SIZE
+            self.shm.buf[start:start + len(encoded)] = encoded
+        self.region = Region(self.shm, symbols, depth)
+        self.versions = dict()
+        self.published = 0
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        self.close()
+        return False
+    def write_side(self, arrays, curve: liquidation.Liquidation_Curve) -> int:
+        prices, spent, intercepts, slopes = curve.arrays(self.region.depth)
+        levels = len(prices)
+        arrays[0][:levels] = prices
+        arrays[1][:levels + 1] = spent
+        arrays[2][:levels + 1] = intercepts
+        arrays[3][:levels + 1] = slopes
+        return levels
+    def publish_book(self, book: classes.Order_Book):
+        control, sides = self.region.slots[book.symbol]
+        control[0] = control[0] + numpy.uint64(1)
+        control[2] = self.write_side(sides[0], book.curve_levels(True, self.region.depth))
+        control[3] = self.write_side(sides[1], book.curve_levels(False, self.region.depth))
+        # curve_levels may sort levels of a depth-limited book, which bumps its version
+        control[1] = book.version
+        control[0] = control[0] + numpy.uint64(1)
+    def publish(self) -> int:
+        """
+        publishes the books which changed and returns how many
+        """
+        now = time.monotonic()
+        if self.last is not None and now - self.last < self.min_interval:
+            return 0
+        self.last = now
+        count = 0
+        for symbol, book in self.exchange.order_books.items():
+            if self.versions.get(symbol) == book.version:
+                continue
+            self.publish_book(book)
+            self.versions[symbol] = book.version
+            count = count + 1
+        self.published = self.published + count
+        return count
+    def close(self):
+        self.region = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+def attach(name: str) -> shared_memory.SharedMemory:
+    """
+    attaches to a region without letting the resource tracker of this process remove it at exit
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+    # before Python 3.13 attaching registers the region like creating it does
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+class Book_Reader:
+    """
+    Values trades and wallets against the curves published under name.
+    They cover the best `depth` levels of each side the Publisher was
+    created with; a trade past them only fetches what those levels hold.
+    """
+    def __init__(self, name: str, retries: int = 1000):
+        self.shm = attach(name)
+        magic, layout, count, depth = HEADER.unpack_from(self.shm.buf, 0)
+        if magic != MAGIC or layout != LAYOUT:
+            self.shm.close()
+            raise ValueError(f"{name} is not a book publication of layout {LAYOUT}")
+        symbols = list()
+        for position in range(count):
+            start = HEADER.size + position * SYMBOL_SIZE
+            symbols.append(bytes(self.shm.buf[start:start + SYMBOL_SIZE]).rstrip(b"\0").decode("utf-8"))
+        self.region = Region(self.shm, symbols, depth)
+        self.retries = retries
+        self.retried = 0
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        self.close()
+        return False
+    @property
+    def symbols(self):
+        return self.region.symbols
+    def read(self, symbol: str, direction: bool, compute):
+        """
+        calls compute with the curve of one side and returns its result,
+        once a consistent version of the book was read
+        """
+        control, sides = self.region.slots[symbol]
+        prices, spent, intercepts, slopes = sides[0 if direction else 1]
+        for attempt in range(self.retries):
+            seq = int(control[0])
+            if seq % 2:
+                time.sleep(0)
+                continue
+            levels = min(int(control[2 if direction else 3]), self.region.depth)
+            curve = liquidation.Liquidation_Curve.from_arrays(prices[:levels], spent[:levels + 1], intercepts[:levels + 1], slopes[:levels + 1], direction)
+            result = compute(curve)
+            if int(control[0]) == seq:
+                return result
+            self.retried = self.retried + 1
+        raise TimeoutError(f"No consistent read of {symbol} after {self.retries} attempts")
+    def version(self, symbol: str) -> int:
+        return int(self.region.slots[symbol][0][1])
+    def top_of_book(self, symbol: str) -> Tuple[Optional[float], Optional[float]]:
+        """
+        best bid and best ask
+        """
+        best = lambda curve: float(curve.prices[0]) if len(curve) else None
+        return self.read(symbol, True, best), self.read(symbol, False, best)
+    def trade(self, symbol: str, direction: bool, amount: float) -> Tuple[float, float]:
+        """
+        see Order_Book.trade
+        """
+        return self.read(symbol, direction, lambda curve: curve.trade(amount))
+    def trade_many(self, symbol: str, direction: bool, amounts) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        return self.read(symbol, direction, lambda curve: curve.trade_many(amounts))
+    def find_book(self, source: str, target: str) -> Tuple[str, bool]:
+        """
+        see Exchange.find_order_book
+        """
+        symbol = "-".join((source, target))
+        if symbol in self.region.slots:
+            return symbol, True
+        symbol = "-".join((target, source))
+        if symbol in self.region.slots:
+            return symbol, False
+        raise KeyError(f"No book for {source} and {target}")
+    def evaluate(self, amounts: Mapping[str, float], target: str = "EUR") -> Dict[str, float]:
+        """
+        values each currency amount in target; currencies without a book against target are left out
+        """
+        values = dict()
+        for source, amount in amounts.items():
+            if source == target:
+                continue
+            try:
+                symbol, direction = self.find_book(source, target)
+            except KeyError:
+                continue
+            values[source] = self.trade(symbol, direction, amount)[0]
+        return values
+    def close(self):
+        self.region = None
+        self.shm.close()
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# recording.py
+
+"""
+Compact binary recording of raw websocket frames.
+
+A recording is a folder of segment files. Every record in a segment is
+
+    length (uint32) | received (float64, unix time) | seqnum (uint64) | frame bytes
+
+all little endian. Segments rotate by size or age; each one can be gzip
+compressed as a whole. Next to every segment an index file holds a
+(received, seqnum, offset) entry every `index_every` records, with offsets into
+the uncompressed segment, so that a reader can seek straight to a point in
+time or to a sequence number.
+"""
+
+import bisect
+import datetime
+import gzip
+import logging
+import pathlib
+import struct
+import time
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+
+logger = logging.getLogger(__name__)
+
+RECORD_HEADER = struct.Struct("<IdQ")
+INDEX_ENTRY = struct.Struct("<dQQ")
+SEGMENT_SUFFIX = ".rec"
+COMPRESSED_SUFFIX = ".rec.gz"
+INDEX_SUFFIX = ".idx"
+
+
+class Recording_Writer:
+    """
+    Appends records to the current segment of a recording and rotates segments
+    when they reach max_bytes (uncompressed) or max_seconds of age
+    """
+    def __init__(self,
+                 folder: pathlib.Path,
+                 prefix: str = "rec",
+                 max_bytes: int = 256 * 1024 * 1024,
+                 max_seconds: float = 3600,
+                 compress: bool = False,
+                 index_every: int = 1000,
+                 ):
+        self.folder = folder.expanduser()
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.compress = compress
+        self.index_every = index_every
+        self.segment = None
+        self.index = None
+        self.segment_count = 0
+        self.records = 0
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        self.close()
+        return False
+    def open_segment(self, received: float):
+        started = datetime.datetime.fromtimestamp(received, tz=datetime.timezone.utc)
+        name = f"{self.prefix}-{started.strftime('%Y%m%dT%H%M%S')}-{self.segment_count:06d}"
+        suffix = COMPRESSED_SUFFIX if self.compress else SEGMENT_SUFFIX
+        self.segment_path = self.folder / (name + suffix)
+        self.segment = gzip.open(self.segment_path, mode="wb") if self.compress else open(self.segment_path, mode="wb")
+        self.index = open(self.folder / (name + INDEX_SUFFIX), mode="wb")
+        self.segment_started = time.monotonic()
+        self.position = 0
+        self.segment_records = 0
+        self.segment_count = self.segment_count + 1
+        logger.debug(f"Opened segment {self.segment_path}")
+    def close_segment(self):
+        if self.segment is None:
+            return
+        self.segment.close()
+        self.index.close()
+        logger.debug(f"Closed segment {self.segment_path} with {self.segment_records} records")
+        self.segment = None
+        self.index = None
+    def write(self, frame: Union[bytes, str], received: float, seqnum: int = 0):
+        if isinstance(frame, str):
+            frame = frame.encode("utf-8")
+        if self.segment is not None and (self.position >= self.max_bytes or time.monotonic() - self.segment_started >= self.max_seconds):
+            self.close_segment()
+        if self.segment is None:
+            self.open_segment(received)
+        if not self.segment_records % self.index_every:
+            self.index.write(INDEX_ENTRY.pack(received, seqnum, self.position))
+        self.segment.write(RECORD_HEADER.pack(len(frame), received, seqnum))
+        self.segment.write(frame)
+        self.position = self.position + RECORD_HEADER.size + len(frame)
+        self.segment_records = self.segment_records + 1
+        self.records = self.records + 1
+    def flush(self):
+        if self.segment is not None:
+            self.segment.flush()
+            self.index.flush()
+    def fileno(self) -> Optional[int]:
+        if self.segment is None:
+            return None
+        return self.segment.fileno()
+    def close(self):
+        self.close_segment()
+
+
+class Recording_Reader:
+    """
+    Reads the records of a recording in order, optionally from a point in time
+    or a sequence number on, using the segment indexes to skip ahead
+    """
+    def __init__(self, folder: pathlib.Path, prefix: str = "rec"):
+        self.folder = folder.expanduser()
+        self.prefix = prefix
+    def segments(self) -> List[pathlib.Path]:
+        paths = list(self.folder.glob(f"{self.prefix}-*{SEGMENT_SUFFIX}")) + list(self.folder.glob(f"{self.prefix}-*{COMPRESSED_SUFFIX}"))
+        return sorted(paths, key=lambda path: path.name)
+    def index_path(self, segment: pathlib.Path) -> pathlib.Path:
+        name = segment.name
+        return segment.with_name(name[:name.index(SEGMENT_SUFFIX)] + INDEX_SUFFIX)
+    def read_index(self, segment: pathlib.Path) -> List[Tuple[float, int, int]]:
+        try:
+            data = self.index_path(segment).read_bytes()
+        except FileNotFoundError:
+            return [(0.0, 0, 0)]
+        usable = len(data) - len(data) % INDEX_ENTRY.size
+        return list(INDEX_ENTRY.iter_unpack(data[:usable])) or [(0.0, 0, 0)]
+    def open_segment(self, segment: pathlib.Path):
+        if segment.name.endswith(COMPRESSED_SUFFIX):
+            return gzip.open(segment, mode="rb")
+        return open(segment, mode="rb")
+    def start_offset(self, index: List[Tuple[float, int, int]], start: Optional[float], seqnum: Optional[int]) -> int:
+        """
+        offset of the last indexed record before the requested start
+        """
+        if start is not None:
+            position = bisect.bisect_left([entry[0] for entry in index], start)
+        elif seqnum is not None:
+            position = bisect.bisect_left([entry[1] for entry in index], seqnum)
+        else:
+            return 0
+        return index[max(position - 1, 0)][2]
+    def records(self, start: Optional[float] = None, end: Optional[float] = None, seqnum: Optional[int] = None) -> Iterator[Tuple[float, int, bytes]]:
+        """
+        yields (received, seqnum, frame) of all records received in [start, end)
+        or, with seqnum, of all records from that sequence number on
+        """
+        segments = self.segments()
+        indexes = [self.read_index(segment) for segment in segments]
+        first = 0
+        for position, index in enumerate(indexes):
+            if (start is not None and index[0][0] <= start) or (seqnum is not None and index[0][1] <= seqnum):
+                first = position
+        for segment, index in zip(segments[first:], indexes[first:]):
+            if end is not None and index[0][0] >= end:
+                return
+            with self.open_segment(segment) as fd:
+                fd.seek(self.start_offset(index, start, seqnum))
+                while True:
+                    header = fd.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    length, received, record_seqnum = RECORD_HEADER.unpack(header)
+                    frame = fd.read(length)
+                    if len(frame) < length:
+                        logger.error(f"Truncated record at the end of {segment}")
+                        break
+                    if start is not None and received < start:
+                        continue
+                    if seqnum is not None and record_seqnum < seqnum:
+                        continue
+                    if end is not None and received >= end:
+                        return
+                    yield received, record_seqnum, frame
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# replay.py
+
+"""
+Replays what saver.Saver recorded through classes.Exchange.
+Both the pretty printed JSON files (.or, .tk, ...) and binary recordings
+(see recording.py) are read as streams of (received, message) pairs with
+constant memory, whatever the size of the recording:
+
+    python replay.py ~/exchange_data/orders/20201016FR101500.or
+    python replay.py ~/exchange_data --speed 10
+"""
+
+import argparse
+import dataclasses
+import datetime
+import json
+import logging
+import mmap
+import pathlib
+import re
+import time
+from typing import Callable
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Mapping
+from typing import Optional
+from typing import Tuple
+
+#Own modules:
+import classes
+import recording
+
+
+logger = logging.getLogger(__name__)
+
+# the line Saver.format_record writes before every record, e.g. 20201016FR101500
+TIMESTAMP = re.compile(rb"^\d{8}[A-Z]{2}\d{6}\r?$", re.MULTILINE)
+
+
+def parse_timestamp(line: bytes) -> Optional[float]:
+    """
+    parses the timestamp lines written by Saver.format_datetime, e.g. 20201016FR101500
+    """
+    line = line.strip()
+    if len(line) != 16 or not (line[:8].isdigit() and line[10:].isdigit()):
+        return None
+    dt = datetime.datetime.strptime((line[:8] + line[10:]).decode("ascii"), "%Y%m%d%H%M%S")
+    return dt.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def seek_timestamp(mm: mmap.mmap, start: float) -> int:
+    """
+    offset of the first timestamp line of start or later in a JSON file
+    written by Saver, the size of the file without one. The timestamps rise
+    through the file, so it bisects the offsets and parses only the
+    timestamp lines it lands on, never the records.
+    """
+    low, high = 0, len(mm)
+    while low < high:
+        middle = (low + high) // 2
+        found = TIMESTAMP.search(mm, middle)
+        if found is None or parse_timestamp(found.group()) >= start:
+            high = middle
+        else:
+            low = middle + 1
+    found = TIMESTAMP.search(mm, low)
+    return found.start() if found is not None else len(mm)
+
+
+def read_json_recording(path: pathlib.Path, start: Optional[float] = None) -> Iterator[Tuple[float, Mapping]]:
+    """
+    yields (received, message) from a pretty printed JSON file written by Saver;
+    with start it seeks to the first record received then, see seek_timestamp
+    """
+    with open(path.expanduser(), mode="rb") as fd:
+        try:
+            mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            return
+        with mm:
+            if start is not None:
+                mm.seek(seek_timestamp(mm, start))
+            received = None
+            timestamp = None
+            lines = list()
+            for line in iter(mm.readline, b""):
+                if lines:
+                    lines.append(line)
+                    # only the closing brace of the message itself is not indented
+                    if line.rstrip() == b"}":
+                        yield received, json.loads(b"".join(lines))
+                        lines = list()
+                elif line.startswith(b"{"):
+                    lines.append(line)
+                    if line.rstrip().endswith(b"}"):
+                        yield received, json.loads(line)
+                        lines = list()
+                elif line.strip() and line != timestamp:
+                    # records of the same second share the timestamp, parse it once
+                    timestamp = line
+                    received = parse_timestamp(line)
+
+
+def json_files(path: pathlib.Path, start: Optional[float] = None) -> List[pathlib.Path]:
+    """
+    The JSON file at path or the l3 order files of a Saver folder, oldest
+    first. With start the files which end before it are left out: Saver names
+    a file by the time it opened it, so a file ends when the next one begins.
+    """
+    path = path.expanduser()
+    if path.is_file():
+        return [path]
+    if (path / "orders").is_dir():
+        path = path / "orders"
+    files = sorted(path.glob("*.or"))
+    if start is None:
+        return files
+    first = 0
+    for position, file in enumerate(files):
+        begins = parse_timestamp(file.stem.encode("ascii"))
+        if begins is not None and begins < start:
+            first = position
+    return files[first:]
+
+
+def read_binary_recording(folder: pathlib.Path, prefix: str, start: Optional[float] = None, end: Optional[float] = None) -> Iterator[Tuple[float, Mapping]]:
+    """
+    yields (received, message) from a binary recording
+    """
+    for received, seqnum, frame in recording.Recording_Reader(folder, prefix).records(start=start, end=end):
+        yield received, json.loads(frame)
+
+
+def binary_recording(path: pathlib.Path) -> Optional[Tuple[pathlib.Path, str]]:
+    """
+    folder and prefix of the binary recording at path, or of the l3 orders
+    below a Saver folder, None if there is none
+    """
+    path = path.expanduser()
+    if path.is_file():
+        return None
+    if (path / "orders").is_dir():
+        path = path / "orders"
+    segments = sorted(list(path.glob(f"*{recording.SEGMENT_SUFFIX}")) + list(path.glob(f"*{recording.COMPRESSED_SUFFIX}")))
+    if not segments:
+        return None
+    return path, segments[0].name.split("-")[0]
+
+
+def read_recording(path: pathlib.Path, start: Optional[float] = None) -> Iterator[Tuple[float, Mapping]]:
+    """
+    Reads a JSON file written by Saver, a folder holding a binary recording,
+    or the folder given to Saver, of which the l3 orders are read.
+    With start only what was received from then on is read; JSON files
+    are skipped by name and sought by their timestamp lines, without
+    parsing the records before start.
+    """
+    path = path.expanduser()
+    binary = binary_recording(path)
+    if binary is not None:
+        return read_binary_recording(*binary, start=start)
+    return (record for file in json_files(path, start) for record in read_json_recording(file, start))
+
+
+@dataclasses.dataclass
+class Replay_Stats:
+    messages: int = 0
+    skipped: int = 0
+    elapsed: float = 0
+    @property
+    def rate(self) -> float:
+        """
+        messages per second
+        """
+        return self.messages / self.elapsed if self.elapsed else 0.0
+
+
+class Replayer:
+    """
+    Feeds recorded messages into an exchange, as fast as possible or, with
+    speed, at the recorded pace sped up by that factor.
+    `on_message` is called after each processed message, e.g. to evaluate.
+    Messages for symbols the exchange does not hold are skipped.
+    """
+    def __init__(self, exchange: classes.Exchange, speed: Optional[float] = None, on_message: Optional[Callable[[Mapping], object]] = None):
+        self.exchange = exchange
+        self.speed = speed
+        self.on_message = on_message
+        self.stats = Replay_Stats()
+    def run(self, records: Iterable[Tuple[float, Mapping]]) -> Replay_Stats:
+        stats = self.stats
+        started = time.perf_counter()
+        first_received = None
+        for received, message in records:
+            if self.speed and received is not None:
+                if first_received is None:
+                    first_received = received
+                delay = (received - first_received) / self.speed - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            symbol = message.get("symbol")
+            if symbol is not None and symbol not in self.exchange.order_books:
+                stats.skipped = stats.skipped + 1
+                continue
+            self.exchange.process(message)
+            if self.on_message is not None:
+                self.on_message(message)
+            stats.messages = stats.messages + 1
+        stats.elapsed = stats.elapsed + time.perf_counter() - started
+        logger.info(f"Replayed {stats.messages} messages in {stats.elapsed:.3f} s, {stats.rate:.0f} messages/s, skipped {stats.skipped}")
+        return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replays a recording through classes.Exchange")
+    parser.add_argument("path", type=pathlib.Path, help="JSON file, binary recording folder or Saver folder")
+    parser.add_argument("--symbols", nargs="+", default=("BTC-EUR", "ETH-EUR", "LTC-EUR"))
+    parser.add_argument("--speed", type=float, default=None, help="replay at recorded pace times this factor")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    replayer = Replayer(classes.Exchange(args.symbols), speed=args.speed)
+    replayer.run(read_recording(args.path))
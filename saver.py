@@ -1,112 +1,319 @@
-#!/usr/bin/env python
-# saver.py
-
-from __future__ import annotations
-import itertools
-import json
-import logging
-import pathlib
-import datetime
-from typing import Tuple
-
-
-# Setup logging
-logger = logging.getLogger(__name__)
-
-
-class Saver:
-    """
-    Saves messages from the socket for permanent record.
-    """
-    def __init__(self, path_to_folder: pathlib.Path):
-        self.started = datetime.datetime.now(tz=datetime.timezone.utc)
-        self.parent = path_to_folder.expanduser()
-        self.heartbeats = self.parent / pathlib.Path("heartbeats")
-        self.orders = self.parent / pathlib.Path("orders")
-        self.prices = self.parent / pathlib.Path("prices")
-        self.symbols = self.parent / pathlib.Path("symbols")
-        self.ticker = self.parent / pathlib.Path("ticker")
-        self.trades = self.parent / pathlib.Path("trades")
-        self.subfolders = (self.heartbeats, self.orders, self.prices, self.symbols, self.ticker, self.trades)
-        self.create_folders((self.parent, *self.subfolders))
-        self.channels = dict(zip(("heartbeat", "l3", "prices", "symbols", "ticker", "trades"), self.subfolders))
-        self.weekdays = dict(zip(range(7), ("SU", "MO", "TU", "WE", "TH", "FR", "SA")))
-        self.create_file_paths()
-        self.counter = itertools.count()
-        self.now = datetime.datetime.now(tz=datetime.timezone.utc)
-    def __enter__(self) -> Saver:
-        logger.debug("Entering Saver")
-        self.hbf = open(self.heartbeats_file_path, mode="w")
-        logger.debug(f"Opened {self.hbf.name}")
-        self.syf = open(self.symbols_file_path, mode="w")
-        logger.debug(f"Opened {self.syf.name}")
-        self.pxf = open(self.prices_file_path, mode="w")
-        logger.debug(f"Opened {self.pxf.name}")
-        self.tkf = open(self.ticker_file_path, mode="w")
-        logger.debug(f"Opened {self.tkf.name}")
-        self.trf = open(self.trades_file_path, mode="w")
-        logger.debug(f"Opened {self.trf.name}")
-        self.orf = open(self.orders_file_path, mode="w")
-        logger.debug(f"Opened {self.orf.name}")
-        return self
-    def __exit__(self, exc_type, exc_value, traceback) -> bool:
-        for fd in (self.hbf, self.syf, self.pxf, self.tkf, self.trf, self.orf):
-            fd.flush()
-            fd.close()
-            logger.debug(f"Saved {fd.name}")
-        logger.debug("Leaving Saver")
-        return False
-    def format_datetime(self, dt: datetime.datetime):
-        return f"{dt.strftime('%Y%m%d')}{self.weekdays[int(dt.strftime('%w'))]}{dt.strftime('%H%M%S')}"
-    def create_folders(self, folders: Tuple[pathlib.Path]):
-        for folder in folders:
-            folder.mkdir(parents=True, exist_ok=True)
-    def create_file_paths(self):
-            self.heartbeats_file_path = self.heartbeats / (self.format_datetime(self.started) + ".hb")
-            self.symbols_file_path = self.symbols / (self.format_datetime(self.started) + ".sy")
-            self.prices_file_path = self.prices / (self.format_datetime(self.started) + ".px")
-            self.ticker_file_path = self.ticker / (self.format_datetime(self.started) + ".tk")
-            self.trades_file_path = self.trades / (self.format_datetime(self.started) + ".tr")
-            self.orders_file_path = self.orders / (self.format_datetime(self.started) + ".or")
-    def dump_dict_as_json(self, d: Mapping[str, str], fd: io.BufferedWriter):
-        print(self.format_datetime(datetime.datetime.now(tz=datetime.timezone.utc)), file=fd)
-        json.dump(d, fd, indent=4, separators=(",", ": "))
-        print("\n", file=fd)
-    def save_hb(self, msg: Mapping[str, str]):
-        self.dump_dict_as_json(msg, self.hbf)
-    def save_sy(self, msg: Mapping[str, str]):
-        self.dump_dict_as_json(msg, self.syf)
-    def save_px(self, msg: Mapping[str, str]):
-        self.dump_dict_as_json(msg, self.pxf)
-    def save_tk(self, msg: Mapping[str, str]):
-        self.dump_dict_as_json(msg, self.tkf)
-    def save_tr(self, msg: Mapping[str, str]):
-        self.dump_dict_as_json(msg, self.trf)
-    def save_or(self, msg: Mapping[str, str]):
-        self.dump_dict_as_json(msg, self.orf)
-    def save(self, msg):
-        if msg["channel"] == "l3":
-            save_target = self.save_or
-        elif msg["channel"] == "heartbeat":
-            save_target = self.save_hb
-        elif msg["channel"] == "prices":
-            save_target = self.save_px
-        elif msg["channel"] == "ticker":
-            save_target = self.save_tk
-        elif msg["channel"] == "trades":
-            save_target = self.save_tr
-        elif msg["channel"] == "symbols":
-            save_target = self.save_sy
-        save_target(msg)
-        current_message_count = next(self.counter)
-        self.now = datetime.datetime.now(tz=datetime.timezone.utc)
-        delta = self.now - self.started
-        try:
-            if delta.seconds % 53 == 0:
-                logger.debug(f"Message count: {current_message_count}, {msg['seqnum']}")
-        except AttributeError:
-            pass
-
-
-if __name__ == "__main__":
-    pass
+#!/usr/bin/env python
+# saver.py
+
+from __future__ import annotations
+import itertools
+import json
+import logging
+import os
+import pathlib
+import datetime
+import queue
+import threading
+import time
+from typing import Mapping
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+#Own modules:
+import metrics
+import recording
+
+
+# Setup logging
+logger = logging.getLogger(__name__)
+
+
+class Saver:
+    """
+    Saves messages from the socket for permanent record.
+
+    With background=True, save() only puts the message into a buffer of
+    buffer_size messages and a writer thread serializes and writes them in
+    batches. Files are flushed every flush_interval seconds (and after every
+    batch when it is 0), with fsync=True also synced to disk. When the buffer
+    is full, overflow decides: "block" waits for the writer, "drop_newest"
+    discards the new message, "drop_oldest" discards the oldest buffered one.
+    Messages the writer cannot write are logged and skipped. Leaving the
+    context drains the buffer completely, unless the writer has stopped or
+    takes no message for exit_timeout seconds.
+
+    With binary=True, messages are stored as compact records in a
+    recording.Recording_Writer per channel instead of pretty printed JSON;
+    segments rotate after max_bytes or max_seconds and are gzip compressed
+    with compress=True.
+    """
+    overflow_policies = ("block", "drop_newest", "drop_oldest")
+    def __init__(self,
+                 path_to_folder: pathlib.Path,
+                 background: bool = False,
+                 buffer_size: int = 100000,
+                 overflow: str = "block",
+                 flush_interval: float = 1,
+                 fsync: bool = False,
+                 batch_size: int = 1000,
+                 binary: bool = False,
+                 max_bytes: int = 256 * 1024 * 1024,
+                 max_seconds: float = 3600,
+                 compress: bool = False,
+                 exit_timeout: float = 10,
+                 ):
+        if overflow not in self.overflow_policies:
+            raise ValueError(f"Unknown overflow policy {overflow}, choose one of {self.overflow_policies}")
+        self.background = background
+        self.overflow = overflow
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.batch_size = batch_size
+        self.binary = binary
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.compress = compress
+        self.exit_timeout = exit_timeout
+        self.buffer = queue.Queue(maxsize=buffer_size)
+        self.dropped = 0
+        self.writer = None
+        self.started = datetime.datetime.now(tz=datetime.timezone.utc)
+        self.parent = path_to_folder.expanduser()
+        self.heartbeats = self.parent / pathlib.Path("heartbeats")
+        self.orders = self.parent / pathlib.Path("orders")
+        self.prices = self.parent / pathlib.Path("prices")
+        self.symbols = self.parent / pathlib.Path("symbols")
+        self.ticker = self.parent / pathlib.Path("ticker")
+        self.trades = self.parent / pathlib.Path("trades")
+        self.subfolders = (self.heartbeats, self.orders, self.prices, self.symbols, self.ticker, self.trades)
+        self.create_folders((self.parent, *self.subfolders))
+        self.channels = dict(zip(("heartbeat", "l3", "prices", "symbols", "ticker", "trades"), self.subfolders))
+        self.weekdays = dict(zip(range(7), ("SU", "MO", "TU", "WE", "TH", "FR", "SA")))
+        self.create_file_paths()
+        self.counter = itertools.count()
+        self.now = datetime.datetime.now(tz=datetime.timezone.utc)
+    def __enter__(self) -> Saver:
+        logger.debug("Entering Saver")
+        if self.binary:
+            self.files = dict()
+            for channel, folder in self.channels.items():
+                self.files[channel] = recording.Recording_Writer(folder, prefix=channel, max_bytes=self.max_bytes, max_seconds=self.max_seconds, compress=self.compress)
+        else:
+            self.open_files()
+        if self.background:
+            self.writer = threading.Thread(target=self.write_buffered, name="saver", daemon=True)
+            metrics.registry.gauge("saver_buffer", lambda: (({"kind": "depth"}, self.buffer.qsize()), ({"kind": "dropped"}, self.dropped)))
+            self.writer.start()
+        return self
+    def open_files(self):
+        self.hbf = open(self.heartbeats_file_path, mode="w")
+        logger.debug(f"Opened {self.hbf.name}")
+        self.syf = open(self.symbols_file_path, mode="w")
+        logger.debug(f"Opened {self.syf.name}")
+        self.pxf = open(self.prices_file_path, mode="w")
+        logger.debug(f"Opened {self.pxf.name}")
+        self.tkf = open(self.ticker_file_path, mode="w")
+        logger.debug(f"Opened {self.tkf.name}")
+        self.trf = open(self.trades_file_path, mode="w")
+        logger.debug(f"Opened {self.trf.name}")
+        self.orf = open(self.orders_file_path, mode="w")
+        logger.debug(f"Opened {self.orf.name}")
+        self.files = dict(zip(("heartbeat", "l3", "prices", "symbols", "ticker", "trades"), (self.hbf, self.orf, self.pxf, self.syf, self.tkf, self.trf)))
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        if self.writer is not None:
+            try:
+                if not self.writer.is_alive():
+                    raise queue.Full
+                self.buffer.put(None, timeout=self.exit_timeout)
+                self.writer.join()
+            except queue.Full:
+                logger.error(f"Saver writer stopped, {self.buffer.qsize()} buffered messages are not saved")
+            self.writer = None
+            if self.dropped:
+                logger.error(f"Dropped {self.dropped} messages on buffer overflow")
+        if self.binary:
+            for recorder in self.files.values():
+                recorder.close()
+                logger.debug(f"Saved {recorder.records} records to {recorder.folder}")
+        else:
+            for fd in (self.hbf, self.syf, self.pxf, self.tkf, self.trf, self.orf):
+                fd.flush()
+                fd.close()
+                logger.debug(f"Saved {fd.name}")
+        logger.debug("Leaving Saver")
+        return False
+    def format_datetime(self, dt: datetime.datetime):
+        return f"{dt.strftime('%Y%m%d')}{self.weekdays[int(dt.strftime('%w'))]}{dt.strftime('%H%M%S')}"
+    def create_folders(self, folders: Tuple[pathlib.Path]):
+        for folder in folders:
+            folder.mkdir(parents=True, exist_ok=True)
+    def create_file_paths(self):
+            self.heartbeats_file_path = self.heartbeats / (self.format_datetime(self.started) + ".hb")
+            self.symbols_file_path = self.symbols / (self.format_datetime(self.started) + ".sy")
+            self.prices_file_path = self.prices / (self.format_datetime(self.started) + ".px")
+            self.ticker_file_path = self.ticker / (self.format_datetime(self.started) + ".tk")
+            self.trades_file_path = self.trades / (self.format_datetime(self.started) + ".tr")
+            self.orders_file_path = self.orders / (self.format_datetime(self.started) + ".or")
+    def dump_dict_as_json(self, d: Mapping[str, str], fd: io.TextIOWrapper, now: Optional[datetime.datetime] = None):
+        if now is None:
+            now = datetime.datetime.now(tz=datetime.timezone.utc)
+        fd.write(self.format_record(d, now))
+    def format_record(self, d: Mapping[str, str], now: datetime.datetime) -> str:
+        return f"{self.format_datetime(now)}\n{json.dumps(d, indent=4, separators=(',', ': '))}\n\n"
+    def save_hb(self, msg: Mapping[str, str]):
+        self.dump_dict_as_json(msg, self.hbf, self.now)
+    def save_sy(self, msg: Mapping[str, str]):
+        self.dump_dict_as_json(msg, self.syf, self.now)
+    def save_px(self, msg: Mapping[str, str]):
+        self.dump_dict_as_json(msg, self.pxf, self.now)
+    def save_tk(self, msg: Mapping[str, str]):
+        self.dump_dict_as_json(msg, self.tkf, self.now)
+    def save_tr(self, msg: Mapping[str, str]):
+        self.dump_dict_as_json(msg, self.trf, self.now)
+    def save_or(self, msg: Mapping[str, str]):
+        self.dump_dict_as_json(msg, self.orf, self.now)
+    def record(self, channel: str, payload: Union[Mapping, str, bytes], received: float, seqnum: int):
+        """
+        writes a message or an undecoded frame as a binary record
+        """
+        if isinstance(payload, Mapping):
+            payload = json.dumps(payload, separators=(",", ":"))
+        self.files[channel].write(payload, received, seqnum)
+    def save_frame(self, channel: str, frame: Union[str, bytes], seqnum: int = 0):
+        """
+        saves an undecoded frame; binary recordings store it as it is,
+        the JSON files need it parsed, which the background writer does off
+        the receiving thread
+        """
+        received = time.time()
+        if self.writer is not None:
+            self.enqueue((received, channel, frame, seqnum))
+            return
+        self.now = datetime.datetime.fromtimestamp(received, tz=datetime.timezone.utc)
+        if self.binary:
+            self.record(channel, frame, received, seqnum)
+        else:
+            self.files[channel].write(self.format_record(json.loads(frame), self.now))
+        self.count(seqnum)
+    def save(self, msg):
+        registry = metrics.registry
+        if registry.enabled:
+            started = time.perf_counter_ns()
+            self.save_message(msg)
+            registry.observe("save", started)
+        else:
+            self.save_message(msg)
+    def save_message(self, msg):
+        if self.writer is not None:
+            self.enqueue((time.time(), msg["channel"], msg, msg.get("seqnum")))
+            return
+        if self.binary:
+            received = time.time()
+            self.now = datetime.datetime.fromtimestamp(received, tz=datetime.timezone.utc)
+            self.record(msg["channel"], msg, received, int(msg.get("seqnum") or 0))
+            self.count(msg.get("seqnum"))
+            return
+        if msg["channel"] == "l3":
+            save_target = self.save_or
+        elif msg["channel"] == "heartbeat":
+            save_target = self.save_hb
+        elif msg["channel"] == "prices":
+            save_target = self.save_px
+        elif msg["channel"] == "ticker":
+            save_target = self.save_tk
+        elif msg["channel"] == "trades":
+            save_target = self.save_tr
+        elif msg["channel"] == "symbols":
+            save_target = self.save_sy
+        self.now = datetime.datetime.now(tz=datetime.timezone.utc)
+        save_target(msg)
+        self.count(msg.get("seqnum"))
+    def count(self, seqnum: Optional[int]):
+        current_message_count = next(self.counter)
+        delta = self.now - self.started
+        if delta.seconds % 53 == 0 and logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Message count: {current_message_count}, {seqnum}")
+    def enqueue(self, item: Tuple[float, str, Union[Mapping, str, bytes], Optional[int]]):
+        if self.overflow == "block":
+            while True:
+                try:
+                    self.buffer.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    # nobody would take it
+                    if not self.writer.is_alive():
+                        self.dropped = self.dropped + 1
+                        return
+        while True:
+            try:
+                self.buffer.put_nowait(item)
+                return
+            except queue.Full:
+                self.dropped = self.dropped + 1
+                if self.overflow == "drop_newest":
+                    return
+                try:
+                    self.buffer.get_nowait()
+                except queue.Empty:
+                    pass
+    def write_buffered(self):
+        """
+        writer thread: serializes buffered messages and writes them in batches,
+        flushing when flush_interval passed since the last flush, also while nothing arrives
+        """
+        last_flush = time.monotonic()
+        written = False
+        running = True
+        while running:
+            try:
+                # waits without a timeout while everything written is flushed
+                batch = [self.buffer.get(timeout=max(self.flush_interval - (time.monotonic() - last_flush), 0) if written else None)]
+            except queue.Empty:
+                self.flush()
+                last_flush = time.monotonic()
+                written = False
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.buffer.get_nowait())
+                except queue.Empty:
+                    break
+            chunks = dict()
+            for item in batch:
+                if item is None:
+                    running = False
+                    continue
+                received, channel, payload, seqnum = item
+                if channel not in self.files:
+                    logger.error(f"Cannot save message of unknown channel: {payload}")
+                    continue
+                self.now = datetime.datetime.fromtimestamp(received, tz=datetime.timezone.utc)
+                self.count(seqnum)
+                try:
+                    if self.binary:
+                        self.record(channel, payload, received, int(seqnum or 0))
+                        continue
+                    if not isinstance(payload, Mapping):
+                        payload = json.loads(payload)
+                    chunks.setdefault(channel, list()).append(self.format_record(payload, self.now))
+                except (OSError, TypeError, ValueError) as error:
+                    logger.error(f"Cannot save {channel} message {payload!r}: {error!r}")
+            for channel, chunk in chunks.items():
+                try:
+                    self.files[channel].write("".join(chunk))
+                except OSError as error:
+                    logger.error(f"Cannot write {len(chunk)} {channel} messages: {error!r}")
+            written = True
+            if not running or time.monotonic() - last_flush >= self.flush_interval:
+                self.flush()
+                last_flush = time.monotonic()
+                written = False
+    def flush(self):
+        for fd in self.files.values():
+            try:
+                fd.flush()
+                if self.fsync and fd.fileno() is not None:
+                    os.fsync(fd.fileno())
+            except OSError as error:
+                logger.error(f"Cannot flush {getattr(fd, 'name', fd)}: {error!r}")
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# sequencing.py
+
+"""
+Sequence number tracking of the level 3 feed.
+blockchain.com numbers the frames of a websocket in one sequence over all
+its channels and symbols. A gap in it means a frame was lost and the books
+of the symbols on that websocket can no longer be trusted, so only the
+receive layer, which sees every frame before it is routed by channel, can
+tell gaps: servers.py keeps a tracker per websocket and calls `check` with
+the seqnum of every frame. On a gap it resubscribes the symbols and calls its
+`on_gap` with each, e.g. to mark the books stale. A lost connection marks
+them with mark_disconnected instead:
+
+    server = servers.Connection_Pool(subscriptions,
+                                     on_disconnect=exchange.sequencer.mark_disconnected,
+                                     on_gap=exchange.sequencer.mark_stale,
+                                     gap_metrics=exchange.sequencer.metrics)
+
+The tracker of an Exchange only sees the level 3 messages of its symbols.
+Their seqnums rise but skip the frames of other channels and symbols, so it
+drops what is out of order, e.g. frames a warm start replays twice, and the
+updates of stale symbols. The next snapshot of a symbol rebuilds its book and
+ends the stale period. Other symbols keep running meanwhile.
+
+The trackers of one feed share the Gap_Metrics passed as gap_metrics, so
+the gaps the receive layer finds and the recoveries the Exchange sees are
+counted together. Gaps, resyncs and the time to recover also go into
+metrics.registry.
+"""
+
+import dataclasses
+import logging
+import statistics
+import time
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Union
+
+#Own modules:
+import decoder
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+def frame_seqnum(frame: Union[str, bytes]) -> Optional[int]:
+    """
+    seqnum of an undecoded frame, looked up as decoder.peek does
+    """
+    if isinstance(frame, bytes):
+        frame = frame.decode("utf-8")
+    return decoder.peek_seqnum(frame)
+
+
+@dataclasses.dataclass
+class Gap_Metrics:
+    """
+    Gaps detected, messages dropped while stale, and how long it took from
+    detecting a gap until the snapshot arrived. Snapshots after a lost
+    connection are counted in reconnect_resyncs, not as recoveries.
+    """
+    gaps: int = 0
+    duplicates: int = 0
+    dropped: int = 0
+    resyncs: int = 0
+    reconnect_resyncs: int = 0
+    recovery_s: List[float] = dataclasses.field(default_factory=list, repr=False)
+    def summary(self) -> dict:
+        return {
+            "gaps": self.gaps,
+            "duplicates": self.duplicates,
+            "dropped": self.dropped,
+            "resyncs": self.resyncs,
+            "reconnect_resyncs": self.reconnect_resyncs,
+            "last_recovery_s": self.recovery_s[-1] if self.recovery_s else None,
+            "mean_recovery_s": statistics.fmean(self.recovery_s) if self.recovery_s else None,
+            "max_recovery_s": max(self.recovery_s, default=None),
+        }
+
+
+class Sequence_Tracker:
+    """
+    Checks the sequence numbers of messages.
+    With per_symbol False one sequence runs over all frames of a connection,
+    as blockchain.com numbers them; a gap cannot be traced to a symbol then,
+    so all symbols go stale.
+    With per_symbol True every (channel, symbol) has a sequence of its own.
+    With contiguous False numbers may skip, only those not above the last one
+    are dropped, as for the level 3 messages of one symbol out of the
+    connection-wide sequence.
+    Pass gap_metrics to count into the Gap_Metrics of another tracker.
+    """
+    def __init__(self, symbols: Iterable[str] = (), per_symbol: bool = False, contiguous: bool = True, on_gap: Optional[Callable[[str], object]] = None, gap_metrics: Optional[Gap_Metrics] = None):
+        self.symbols = list(symbols)
+        self.per_symbol = per_symbol
+        self.contiguous = contiguous
+        self.on_gap = on_gap
+        self.last = dict()
+        self.stale: Dict[str, float] = dict()
+        # stale symbols of which only the connection was lost
+        self.disconnected = set()
+        self.metrics = gap_metrics if gap_metrics is not None else Gap_Metrics()
+    def is_stale(self, symbol: str) -> bool:
+        return symbol in self.stale
+    def admit(self, channel: str, symbol: Optional[str], event: str, seqnum: Optional[int]) -> bool:
+        """
+        tells whether a message should be applied to its book
+        """
+        if seqnum is None:
+            return True
+        tracked = event in ("updated", "snapshot")
+        if self.per_symbol and not tracked:
+            return True
+        key = (channel, symbol) if self.per_symbol else None
+        last = self.last.get(key)
+        if event == "snapshot" and self.per_symbol:
+            # a resubscription starts the sequence of the symbol afresh
+            self.last[key] = seqnum
+            self.recover(symbol)
+            return True
+        if last is not None and seqnum <= last:
+            self.metrics.duplicates = self.metrics.duplicates + 1
+            return False
+        self.last[key] = seqnum
+        if self.contiguous and last is not None and seqnum > last + 1:
+            self.gap(symbol if self.per_symbol else None, last, seqnum)
+        if event == "snapshot":
+            self.recover(symbol)
+            return True
+        if tracked and symbol in self.stale:
+            self.metrics.dropped = self.metrics.dropped + 1
+            return False
+        return True
+    def check(self, seqnum: Optional[int]) -> bool:
+        """
+        checks the next frame of a connection, whatever its channel, tells
+        whether it is new; a gap calls on_gap with every symbol, also those
+        still stale from an earlier gap, since their snapshot may be lost too
+        """
+        if seqnum is None:
+            return True
+        last = self.last.get(None)
+        if last is not None and seqnum <= last:
+            self.metrics.duplicates = self.metrics.duplicates + 1
+            return False
+        self.last[None] = seqnum
+        if last is not None and seqnum > last + 1:
+            self.stale.clear()
+            self.disconnected.clear()
+            self.gap(None, last, seqnum)
+        return True
+    def reset(self):
+        """
+        forgets the last seqnums, e.g. when a new connection starts its sequence afresh
+        """
+        self.last.clear()
+        self.stale.clear()
+        self.disconnected.clear()
+    def gap(self, symbol: Optional[str], last: int, seqnum: int):
+        self.metrics.gaps = self.metrics.gaps + 1
+        if metrics.registry.enabled:
+            metrics.registry.count("gaps")
+        symbols = [symbol] if symbol is not None else self.symbols
+        logger.warning(f"Sequence gap after {last}, got {seqnum}, resynchronizing {', '.join(symbols)}")
+        detected = time.monotonic()
+        for symbol in symbols:
+            if symbol in self.stale and symbol not in self.disconnected:
+                continue
+            self.stale[symbol] = detected
+            self.disconnected.discard(symbol)
+            if self.on_gap is not None:
+                self.on_gap(symbol)
+    def mark_stale(self, symbol: str):
+        """
+        marks symbol stale after a gap found elsewhere, without asking for a resubscription
+        """
+        if symbol in self.disconnected or symbol not in self.stale:
+            self.stale[symbol] = time.monotonic()
+        self.disconnected.discard(symbol)
+    def mark_disconnected(self, symbol: str):
+        """
+        marks symbol stale while its connection is down, its resync is not counted as a gap recovery
+        """
+        if symbol not in self.stale:
+            self.stale[symbol] = time.monotonic()
+            self.disconnected.add(symbol)
+    def recover(self, symbol: str):
+        detected = self.stale.pop(symbol, None)
+        if detected is None:
+            return
+        elapsed = time.monotonic() - detected
+        if symbol in self.disconnected:
+            self.disconnected.discard(symbol)
+            self.metrics.reconnect_resyncs = self.metrics.reconnect_resyncs + 1
+            logger.info(f"Resynchronized {symbol} after reconnecting in {elapsed:.3f} s")
+            return
+        self.metrics.resyncs = self.metrics.resyncs + 1
+        self.metrics.recovery_s.append(elapsed)
+        if metrics.registry.enabled:
+            metrics.registry.count("resyncs")
+            metrics.registry.record("recovery", int(elapsed * 1e9))
+        logger.info(f"Resynchronized {symbol} in {elapsed:.3f} s")
+
+
+if __name__ == "__main__":
+    pass
@@ -3,31 +3,346 @@
 
 import json
 import logging
+import queue
+import threading
+import time
+from typing import Callable
+from typing import Iterable
+from typing import List
+from typing import Mapping
+from typing import Optional
 # https://github.com/websocket-client/websocket-client
 import websocket
 
+#Own modules:
+import metrics
+import sequencing
+
 
 logger = logging.getLogger(__name__)
 
 
+URL = "wss://ws.prod.blockchain.info/mercury-gateway/v1/ws"
+
+
 class Exchange_Blockchain:
-    def __init__(self, subscriptions):
+    """
+    One websocket with all subscriptions. The seqnum of every frame is checked
+    as it arrives, see sequencing.py: a gap resubscribes every symbol and
+    calls `on_gap` with it. Gaps are counted in `gap_metrics` when given,
+    e.g. those of the Exchange's sequencer.
+    """
+    def __init__(self, subscriptions, url: str = URL, on_gap: Optional[Callable[[str], object]] = None, gap_metrics: Optional[sequencing.Gap_Metrics] = None):
         self.subscriptions = subscriptions
         self.options = dict()
         self.options["origin"] = "https://exchange.blockchain.com"
-        self.url = "wss://ws.prod.blockchain.info/mercury-gateway/v1/ws"
+        self.url = url
+        self.on_gap = on_gap
+        symbols = dict.fromkeys(symbol for symbol in map(subscription_symbol, self.subscriptions) if symbol is not None)
+        self.sequencer = sequencing.Sequence_Tracker(symbols, on_gap=self.gap, gap_metrics=gap_metrics)
         self.ws = websocket.create_connection(self.url, **self.options)
-    def listen(self):
+    def subscribe(self):
         for sub in self.subscriptions:
             self.ws.send(sub)
+    def resubscribe(self, symbol: str, channel: str = "l3"):
+        """
+        unsubscribes and subscribes symbol again to get a fresh snapshot
+        """
+        logger.info(f"Resubscribing {channel} {symbol}")
+        self.ws.send(json.dumps({"action": "unsubscribe", "channel": channel, "symbol": symbol}))
+        self.ws.send(json.dumps({"action": "subscribe", "channel": channel, "symbol": symbol}))
+    def gap(self, symbol: str):
+        self.resubscribe(symbol)
+        if self.on_gap is not None:
+            self.on_gap(symbol)
+    def recv(self) -> str:
+        registry = metrics.registry
+        if registry.enabled:
+            started = time.perf_counter_ns()
+            frame = self.ws.recv()
+            registry.observe("recv", started)
+            return frame
+        return self.ws.recv()
+    def receive(self) -> str:
+        """
+        blocks until the next frame in sequence arrives and returns it undecoded
+        """
+        while True:
+            frame = self.recv()
+            if self.sequencer.check(sequencing.frame_seqnum(frame)):
+                return frame
+    def frames(self):
+        """
+        subscribes and yields the frames undecoded, see decoder.Decoder
+        """
+        self.subscribe()
+        try:
+            while True:
+                yield self.receive()
+        except KeyboardInterrupt:
+            logger.debug("Cought Keyboard Interrupt, closing websocket.")
+            self.ws.close()
+    def listen(self):
+        self.subscribe()
         try:
             while True:
-                result = self.ws.recv()
-                j = json.loads(result)
+                result = self.receive()
+                if metrics.registry.enabled:
+                    started = time.perf_counter_ns()
+                    j = json.loads(result)
+                    metrics.registry.observe("decode", started)
+                    metrics.registry.count("messages", j.get("channel", ""))
+                else:
+                    j = json.loads(result)
                 yield j
         except KeyboardInterrupt:
             logger.debug("Cought Keyboard Interrupt, closing websocket.")
             self.ws.close()
+    def close(self):
+        self.ws.close()
+
+
+def subscription_symbol(subscription: str) -> Optional[str]:
+    return json.loads(subscription).get("symbol")
+
+
+class Connection:
+    """
+    One websocket of a Connection_Pool with the subscriptions sent over it
+    and the tracker of its sequence, which starts afresh with every connect
+    """
+    def __init__(self, number: int, subscriptions: List[str], gap_metrics: Optional[sequencing.Gap_Metrics] = None):
+        self.number = number
+        self.subscriptions = subscriptions
+        self.symbols = list(dict.fromkeys(symbol for symbol in map(subscription_symbol, subscriptions) if symbol is not None))
+        self.sequencer = sequencing.Sequence_Tracker(self.symbols, gap_metrics=gap_metrics)
+        self.ws = None
+        self.lock = threading.Lock()
+        self.connects = 0
+        # seconds to wait before the next attempt, reset once frames arrive
+        self.delay = 0.0
+        self.thread = None
+    def send(self, payload: str) -> bool:
+        """
+        sends payload if the connection is up, tells whether it was
+        """
+        with self.lock:
+            ws = self.ws
+        if ws is None:
+            return False
+        try:
+            ws.send(payload)
+            return True
+        except (websocket.WebSocketException, OSError) as error:
+            logger.warning(f"Connection {self.number} could not send: {error!r}")
+            return False
+
+
+class Connection_Pool:
+    """
+    Spreads the subscriptions over `connections` websockets by symbol and
+    merges what they receive into one stream. All frames of a symbol come
+    over the same connection, so they stay in order.
+    `assignment` maps symbols to connection numbers, the symbols it leaves
+    out are dealt to the connections in turn; subscriptions without a symbol
+    go to the first connection.
+    Every connection has a thread of its own which reconnects when the
+    connection drops or nothing arrives for `timeout` seconds, waiting
+    `backoff` seconds, twice as long after every failed attempt up to
+    `max_backoff`, and subscribes again what went over that connection.
+    receive checks the sequence of every connection, see sequencing.py, and
+    resubscribes the symbols of a connection with a gap. `on_gap` is called
+    with each of them and `on_disconnect` with each symbol of a lost
+    connection, both in order with the frames, e.g. to mark the books stale
+    until the new snapshot. Gaps are counted in `gap_metrics` when given,
+    e.g. those of the Exchange's sequencer.
+    """
+    def __init__(self,
+                 subscriptions: Iterable[str],
+                 connections: int = 2,
+                 url: str = URL,
+                 assignment: Optional[Mapping[str, int]] = None,
+                 backoff: float = 0.5,
+                 max_backoff: float = 30.0,
+                 timeout: Optional[float] = 60.0,
+                 maxsize: int = 100000,
+                 on_disconnect: Optional[Callable[[str], object]] = None,
+                 on_gap: Optional[Callable[[str], object]] = None,
+                 gap_metrics: Optional[sequencing.Gap_Metrics] = None,
+                 ):
+        self.subscriptions = list(subscriptions)
+        self.url = url
+        self.options = dict()
+        self.options["origin"] = "https://exchange.blockchain.com"
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.on_disconnect = on_disconnect
+        self.on_gap = on_gap
+        symbols = list(dict.fromkeys(symbol for symbol in map(subscription_symbol, self.subscriptions) if symbol is not None))
+        connections = max(1, min(connections, len(symbols)))
+        assignment = dict(assignment or dict())
+        for symbol, number in assignment.items():
+            if not 0 <= number < connections:
+                raise ValueError(f"Connection {number} of {symbol} is not one of the {connections} connections")
+        unassigned = [symbol for symbol in symbols if symbol not in assignment]
+        assignment.update((symbol, position % connections) for position, symbol in enumerate(unassigned))
+        self.assignment = assignment
+        shares = [list() for _ in range(connections)]
+        for subscription in self.subscriptions:
+            symbol = subscription_symbol(subscription)
+            shares[self.assignment[symbol] if symbol is not None else 0].append(subscription)
+        self.connections = [Connection(number, share, gap_metrics) for number, share in enumerate(shares)]
+        for connection in self.connections:
+            connection.sequencer.on_gap = self.gap
+        self.queue = queue.Queue(maxsize)
+        self.stopping = threading.Event()
+        self.reconnects = 0
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        self.close()
+        return False
+    def connect(self, connection: Connection) -> Optional[websocket.WebSocket]:
+        """
+        opens the websocket of connection and subscribes, retrying with backoff until it succeeds or the pool closes
+        """
+        while not self.stopping.is_set():
+            if connection.delay:
+                self.stopping.wait(connection.delay)
+                if self.stopping.is_set():
+                    break
+            connection.delay = min(max(connection.delay * 2, self.backoff), self.max_backoff)
+            try:
+                ws = websocket.create_connection(self.url, timeout=self.timeout, **self.options)
+                for subscription in connection.subscriptions:
+                    ws.send(subscription)
+            except (websocket.WebSocketException, OSError) as error:
+                logger.warning(f"Connection {connection.number} to {self.url} failed: {error!r}, retrying in {connection.delay:.1f} s")
+                continue
+            with connection.lock:
+                connection.ws = ws
+            connection.connects = connection.connects + 1
+            if connection.connects > 1:
+                self.reconnects = self.reconnects + 1
+                if metrics.registry.enabled:
+                    metrics.registry.count("reconnects", str(connection.number))
+                logger.info(f"Connection {connection.number} resubscribed {', '.join(connection.symbols) or 'channels without symbol'}")
+            return ws
+        return None
+    def disconnect(self, connection: Connection, error: Exception):
+        with connection.lock:
+            ws = connection.ws
+            connection.ws = None
+        if ws is not None:
+            try:
+                ws.close(timeout=0)
+            except (websocket.WebSocketException, OSError):
+                pass
+        if self.stopping.is_set():
+            return
+        logger.warning(f"Connection {connection.number} lost: {error!r}")
+        # behind the frames still queued, see receive
+        self.queue.put((connection, None))
+    def run(self, connection: Connection):
+        """
+        receives frames of connection into the queue until the pool closes
+        """
+        registry = metrics.registry
+        while True:
+            ws = self.connect(connection)
+            if ws is None:
+                return
+            try:
+                while True:
+                    if registry.enabled:
+                        started = time.perf_counter_ns()
+                        frame = ws.recv()
+                        registry.observe("recv", started)
+                    else:
+                        frame = ws.recv()
+                    if not frame:
+                        raise websocket.WebSocketConnectionClosedException("Connection closed by the server")
+                    connection.delay = 0.0
+                    self.queue.put((connection, frame))
+            except (websocket.WebSocketException, OSError) as error:
+                self.disconnect(connection, error)
+    def subscribe(self):
+        """
+        starts the thread of every connection, which connects and subscribes
+        """
+        for connection in self.connections:
+            if connection.thread is None:
+                connection.thread = threading.Thread(target=self.run, args=(connection,), name=f"connection-{connection.number}", daemon=True)
+                connection.thread.start()
+    def resubscribe(self, symbol: str, channel: str = "l3"):
+        """
+        see Exchange_Blockchain.resubscribe, over the connection of symbol
+        """
+        connection = self.connections[self.assignment[symbol]]
+        logger.info(f"Resubscribing {channel} {symbol} on connection {connection.number}")
+        connection.send(json.dumps({"action": "unsubscribe", "channel": channel, "symbol": symbol}))
+        connection.send(json.dumps({"action": "subscribe", "channel": channel, "symbol": symbol}))
+    def gap(self, symbol: str):
+        self.resubscribe(symbol)
+        if self.on_gap is not None:
+            self.on_gap(symbol)
+    def receive(self, timeout: Optional[float] = None) -> str:
+        """
+        blocks until the next frame of any connection in sequence arrives and returns it undecoded
+        """
+        while True:
+            connection, frame = self.queue.get(timeout=timeout)
+            if frame is None:
+                # the next connection starts a new sequence
+                connection.sequencer.reset()
+                if self.on_disconnect is not None:
+                    for symbol in connection.symbols:
+                        self.on_disconnect(symbol)
+                continue
+            if connection.sequencer.check(sequencing.frame_seqnum(frame)):
+                return frame
+    def frames(self):
+        """
+        connects and yields the frames of all connections undecoded, see decoder.Decoder
+        """
+        self.subscribe()
+        try:
+            while True:
+                yield self.receive()
+        except KeyboardInterrupt:
+            logger.debug("Cought Keyboard Interrupt, closing websockets.")
+            self.close()
+    def listen(self):
+        self.subscribe()
+        try:
+            while True:
+                result = self.receive()
+                if metrics.registry.enabled:
+                    started = time.perf_counter_ns()
+                    j = json.loads(result)
+                    metrics.registry.observe("decode", started)
+                    metrics.registry.count("messages", j.get("channel", ""))
+                else:
+                    j = json.loads(result)
+                yield j
+        except KeyboardInterrupt:
+            logger.debug("Cought Keyboard Interrupt, closing websockets.")
+            self.close()
+    def close(self):
+        self.stopping.set()
+        for connection in self.connections:
+            with connection.lock:
+                ws = connection.ws
+                connection.ws = None
+            if ws is not None:
+                try:
+                    ws.close(timeout=0)
+                except (websocket.WebSocketException, OSError):
+                    pass
+        for connection in self.connections:
+            if connection.thread is not None and connection.thread is not threading.current_thread():
+                connection.thread.join(timeout=1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# sharding.py
+
+"""
+Spreads the order books of an exchange over worker processes.
+Every worker owns a classes.Exchange with its share of the symbols. The main
+process routes level 3 messages, or undecoded frames which the workers then
+parse themselves, by symbol and collects compact liquidation summaries of
+the books for valuation:
+
+    with Sharded_Exchange(symbols, workers=4, collect_interval=0.1) as exchange:
+        for frame in server.frames():
+            exchange.process_frame(frame)
+            exchange.evaluate(wallet)
+
+Messages are sent to the workers in batches of batch_size. Collecting the
+summaries is a round trip to every worker, so evaluate only collects when
+collect_interval seconds passed since the last collect and otherwise values
+with the curves it has; with collect_interval 0 it collects every time,
+which costs the throughput of the workers. Call collect when the values
+must include everything routed so far. A summary holds the curve arrays of
+each side of a book which changed since the last summary, see
+Liquidation_Curve.arrays.
+"""
+
+import logging
+import multiprocessing
+import os
+import time
+from typing import Dict
+from typing import Mapping
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+from typing import Union
+
+#Own modules:
+import classes
+import decoder
+import liquidation
+
+
+logger = logging.getLogger(__name__)
+
+
+def summarize(exchange: classes.Exchange, known: Mapping[str, int], depth: Optional[int]) -> Tuple[dict, list]:
+    """
+    curve arrays of both sides of every book whose version differs from known,
+    and the stale symbols
+    """
+    books = dict()
+    for symbol, book in exchange.order_books.items():
+        if known.get(symbol) == book.version:
+            continue
+        books[symbol] = (book.version, book.curve_levels(True, depth).arrays(depth), book.curve_levels(False, depth).arrays(depth))
+    return books, list(exchange.sequencer.stale)
+
+
+def work(connection, symbols: Sequence[str], instruments: Optional[Mapping[str, classes.Instrument]], depth: Optional[int], depth_limit: Optional[int]):
+    """
+    runs in a worker process until it receives stop
+    """
+    exchange = classes.Exchange(symbols, instruments=instruments, depth_limit=depth_limit)
+    process = exchange.process
+    loads = decoder.loads
+    while True:
+        command, payload = connection.recv()
+        if command == "batch":
+            for item in payload:
+                process(loads(item) if isinstance(item, (str, bytes)) else item)
+        elif command == "stale":
+            exchange.sequencer.mark_stale(payload)
+        elif command == "disconnected":
+            exchange.sequencer.mark_disconnected(payload)
+        elif command == "summarize":
+            connection.send(summarize(exchange, payload, depth))
+        elif command == "stop":
+            break
+    connection.close()
+
+
+class Sharded_Exchange:
+    """
+    Routes messages to the worker owning their symbol and values wallets with
+    the curves the workers summarize.
+    `assignment` maps symbols to worker numbers, e.g. to give a hot pair a
+    worker of its own; the symbols it leaves out are dealt to the workers in turn.
+    Gaps in the sequence are found where the frames are received; mark_stale
+    drops the updates of a symbol in its worker until the next snapshot, e.g.
+    as on_gap of servers.Connection_Pool, and mark_disconnected as its
+    on_disconnect, see sequencing.py.
+    The summaries cover the best `depth` levels of each side, all without
+    it; with depth_limit the workers keep that many sorted, so give depth too.
+    """
+    def __init__(self,
+                 symbols: Sequence[str],
+                 workers: Optional[int] = None,
+                 instruments: Optional[Mapping[str, classes.Instrument]] = None,
+                 assignment: Optional[Mapping[str, int]] = None,
+                 batch_size: int = 256,
+                 depth: Optional[int] = None,
+                 depth_limit: Optional[int] = None,
+                 collect_interval: float = 0.1,
+                 ):
+        self.symbols = list(symbols)
+        workers = workers or min(len(self.symbols), os.cpu_count() or 1)
+        assignment = dict(assignment or dict())
+        for symbol, worker in assignment.items():
+            if symbol not in self.symbols:
+                raise ValueError(f"{symbol} is assigned to a worker but not one of the symbols")
+            if not 0 <= worker < workers:
+                raise ValueError(f"Worker {worker} of {symbol} is not one of the {workers} workers")
+        unassigned = [symbol for symbol in self.symbols if symbol not in assignment]
+        assignment.update((symbol, position % workers) for position, symbol in enumerate(unassigned))
+        self.assignment = assignment
+        self.batch_size = batch_size
+        self.collect_interval = collect_interval
+        self.collected = None
+        self.connections = list()
+        self.processes = list()
+        for worker in range(workers):
+            shard = [symbol for symbol in self.symbols if self.assignment[symbol] == worker]
+            parent, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=work, args=(child, shard, instruments, depth, depth_limit), name=f"shard-{worker}", daemon=True)
+            process.start()
+            child.close()
+            self.connections.append(parent)
+            self.processes.append(process)
+        self.pending = [list() for _ in range(workers)]
+        self.versions = dict()
+        self.curves: Dict[Tuple[str, bool], liquidation.Liquidation_Curve] = dict()
+        self.stale = set()
+        self.last_values = dict()
+        self.routed = 0
+        self.unrouted = 0
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        self.close()
+        return False
+    def route(self, symbol: Optional[str], item: Union[str, bytes, Mapping]):
+        worker = self.assignment.get(symbol)
+        if worker is None:
+            self.unrouted = self.unrouted + 1
+            return
+        self.routed = self.routed + 1
+        pending = self.pending[worker]
+        pending.append(item)
+        if len(pending) >= self.batch_size:
+            self.connections[worker].send(("batch", pending))
+            self.pending[worker] = list()
+    def process(self, message: Mapping):
+        self.route(message.get("symbol"), message)
+    def process_frame(self, frame: Union[str, bytes]):
+        """
+        routes an undecoded frame, the worker parses it
+        """
+        text = frame.decode("utf-8") if isinstance(frame, bytes) else frame
+        self.route(decoder.peek_symbol(text), frame)
+    def mark_stale(self, symbol: str, command: str = "stale"):
+        """
+        marks symbol stale in its worker, after the messages routed so far
+        """
+        worker = self.assignment.get(symbol)
+        if worker is None:
+            return
+        if self.pending[worker]:
+            self.connections[worker].send(("batch", self.pending[worker]))
+            self.pending[worker] = list()
+        self.connections[worker].send((command, symbol))
+        self.stale.add(symbol)
+    def mark_disconnected(self, symbol: str):
+        """
+        see sequencing.Sequence_Tracker.mark_disconnected
+        """
+        self.mark_stale(symbol, "disconnected")
+    def flush(self):
+        for worker, pending in enumerate(self.pending):
+            if pending:
+                self.connections[worker].send(("batch", pending))
+                self.pending[worker] = list()
+    def collect(self):
+        """
+        sends what is pending and gathers the summaries of the books which changed
+        """
+        self.collected = time.monotonic()
+        self.flush()
+        for worker, connection in enumerate(self.connections):
+            known = {symbol: version for symbol, version in self.versions.items() if self.assignment[symbol] == worker}
+            connection.send(("summarize", known))
+        stale = set()
+        for connection in self.connections:
+            books, worker_stale = connection.recv()
+            stale.update(worker_stale)
+            for symbol, (version, bids, asks) in books.items():
+                self.versions[symbol] = version
+                self.curves[(symbol, True)] = liquidation.Liquidation_Curve.from_arrays(*bids, True)
+                self.curves[(symbol, False)] = liquidation.Liquidation_Curve.from_arrays(*asks, False)
+        self.stale = stale
+    def find_curve(self, source: str, target: str) -> liquidation.Liquidation_Curve:
+        """
+        see Exchange.find_order_book
+        """
+        symbol = "-".join((source, target))
+        if symbol in self.assignment:
+            return self.curves.get((symbol, True))
+        symbol = "-".join((target, source))
+        if symbol in self.assignment:
+            return self.curves.get((symbol, False))
+        raise KeyError(f"No order book for {source} and {target}")
+    def values(self, amounts: Mapping[str, float], target: str = "EUR") -> Dict[str, float]:
+        """
+        values each currency amount in target with the curves of the last collect
+        """
+        values = dict()
+        for source, amount in amounts.items():
+            if source == target:
+                continue
+            try:
+                curve = self.find_curve(source, target)
+            except KeyError:
+                continue
+            values[source] = curve.trade(amount)[0] if curve is not None else 0.0
+        return values
+    def evaluate(self, wallet: classes.Wallet, target: str = "EUR") -> float:
+        """
+        Like Exchange.evaluate: values the wallet and logs it when the value
+        changed, with the summaries collected at most collect_interval ago
+        """
+        if self.collected is None or time.monotonic() - self.collected >= self.collect_interval:
+            self.collect()
+        values = self.values(wallet.amounts, target)
+        total_value = sum(values.values())
+        if self.last_values.get(wallet.name) == total_value:
+            return total_value
+        self.last_values[wallet.name] = total_value
+        wallet.log_value(total_value, target, sorted(self.stale))
+        return total_value
+    def close(self):
+        self.flush()
+        for connection in self.connections:
+            connection.send(("stop", None))
+        for process in self.processes:
+            process.join()
+        for connection in self.connections:
+            connection.close()
+
+
+if __name__ == "__main__":
+    pass
@@ -1,74 +1,116 @@
-#!/usr/bin/env python
-# simple.py
-
-import itertools
-import json
-import logging
-import logging.config
-import pathlib
-
-#Own modules:
-import classes
-import logging_conf
-import saver
-import servers
-
-
-# setup logging
-logging.config.dictConfig(logging_conf.create_dict_config(pathlib.Path(pathlib.Path.cwd()), "all.log", "errors.log"))
-logger = logging.getLogger(__name__)
-
-
-def wait_key() -> str:
-    """
-    Wait for a key press on the console and return it.
-    """
-    result = None
-    if os.name == 'nt':
-        import msvcrt
-        result = msvcrt.getch()
-    else:
-        import termios
-        fd = sys.stdin.fileno()
-        oldterm = termios.tcgetattr(fd)
-        newattr = termios.tcgetattr(fd)
-        newattr[3] = newattr[3] & ~termios.ICANON & ~termios.ECHO
-        termios.tcsetattr(fd, termios.TCSANOW, newattr)
-        try:
-            result = sys.stdin.read(1)
-        except IOError:
-            pass
-        finally:
-            termios.tcsetattr(fd, termios.TCSAFLUSH, oldterm)
-    return str(result, encoding="utf-8").upper()
-
-
-myWallet = classes.Wallet(name="Sven's wallet", 
-                          curr_amounts={"USD": 13.26,
-                                        "EUR": 3000.29,
-                                        "BTC": 4.06862207+0.0549664+0.094,
-                                        "ETH": 17.65 + 0.03,
-                                        "LTC": 104.11796365 + 0.1},
-                          investments={"EUR": 7000 + 22000 + 2500 + 3000 + 2000 + 1000 + 4000},
-                         )
-
-
-symbols = ("BTC-EUR", "ETH-EUR", "LTC-EUR")
-# symbols = ("BTC-EUR", "ETH-EUR", "LTC-EUR")
-subscriptions = [] + \
-                ['{"action": "subscribe", "channel": "l3", "symbol": "' + f"{symbol}" + '"}' for symbol in symbols]
-
-
-if __name__ == "__main__":
-    for sub in subscriptions:
-        logger.debug(sub)
-    exchange = classes.Exchange(symbols)
-    with saver.Saver(pathlib.Path("~/exchange_data")) as svr:
-        try:
-            server = servers.Exchange_Blockchain(subscriptions)
-            for message in server.listen():
-                svr.save(message)
-                exchange.process(message)
-                exchange.evaluate(myWallet)
-        except KeyboardInterrupt:
-            logger.debug("Cought Keyboard Interrupt, quitting.")
+#!/usr/bin/env python
+# simple.py
+
+import itertools
+import json
+import logging
+import logging.config
+import pathlib
+
+#Own modules:
+import checkpoint
+import classes
+import conflation
+import logging_conf
+import metrics
+import publication
+import saver
+import servers
+import timeseries
+
+
+# setup logging
+logging.config.dictConfig(logging_conf.create_dict_config(pathlib.Path(pathlib.Path.cwd()), "all.log", "errors.log"))
+logging_conf.queue_handlers()
+logger = logging.getLogger(__name__)
+
+
+def wait_key() -> str:
+    """
+    Wait for a key press on the console and return it.
+    """
+    result = None
+    if os.name == 'nt':
+        import msvcrt
+        result = msvcrt.getch()
+    else:
+        import termios
+        fd = sys.stdin.fileno()
+        oldterm = termios.tcgetattr(fd)
+        newattr = termios.tcgetattr(fd)
+        newattr[3] = newattr[3] & ~termios.ICANON & ~termios.ECHO
+        termios.tcsetattr(fd, termios.TCSANOW, newattr)
+        try:
+            result = sys.stdin.read(1)
+        except IOError:
+            pass
+        finally:
+            termios.tcsetattr(fd, termios.TCSAFLUSH, oldterm)
+    return str(result, encoding="utf-8").upper()
+
+
+myWallet = classes.Wallet(name="Sven's wallet", 
+                          curr_amounts={"USD": 13.26,
+                                        "EUR": 3000.29,
+                                        "BTC": 4.06862207+0.0549664+0.094,
+                                        "ETH": 17.65 + 0.03,
+                                        "LTC": 104.11796365 + 0.1},
+                          investments={"EUR": 7000 + 22000 + 2500 + 3000 + 2000 + 1000 + 4000},
+                         )
+
+
+symbols = ("BTC-EUR", "ETH-EUR", "LTC-EUR")
+# symbols = ("BTC-EUR", "ETH-EUR", "LTC-EUR")
+subscriptions = [] + \
+                ['{"action": "subscribe", "channel": "l3", "symbol": "' + f"{symbol}" + '"}' for symbol in symbols] + \
+                ['{"action": "subscribe", "channel": "' + f"{channel}" + '", "symbol": "' + f"{symbol}" + '"}' for channel in ("ticker", "trades") for symbol in symbols]
+# websockets the symbols are spread over, see servers.Connection_Pool
+connections = 2
+# apply whatever queued up in one batch and evaluate once per batch
+conflate = False
+data = pathlib.Path("~/exchange_data")
+checkpoints = data / "checkpoints"
+# name of the shared memory region other local processes read the books from, see publication.py
+publish = "cryptoworth"
+# latency histograms and message rates on http://127.0.0.1:9108/metrics and in the log, None to switch off
+metrics_port = 9108
+# wallet value, mid prices, ticker and trades of the last hours in memory, see timeseries.py
+history = timeseries.Time_Series_Store()
+
+
+if __name__ == "__main__":
+    for sub in subscriptions:
+        logger.debug(sub)
+    exchange = checkpoint.warm_start(symbols, checkpoints, recording=data)
+    exchange.evaluate(myWallet)
+    if metrics_port is not None:
+        metrics.registry.enable()
+        metrics.registry.gauge("book_size", metrics.book_sizes(exchange))
+        metrics.registry.serve(port=metrics_port)
+        metrics.registry.start_summary(60)
+    with saver.Saver(data, background=True) as svr, checkpoint.Checkpointer(exchange, checkpoints) as checkpointer, publication.Publisher(exchange, publish, min_interval=0.1) as publisher:
+        try:
+            server = servers.Connection_Pool(subscriptions, connections=connections, on_disconnect=exchange.sequencer.mark_disconnected, on_gap=exchange.sequencer.mark_stale, gap_metrics=exchange.sequencer.metrics)
+            if conflate:
+                def evaluate(changed):
+                    history.record_valuation(myWallet.name, exchange.evaluate(myWallet))
+                    history.record_mids(exchange)
+                conflator = conflation.Conflator(exchange, evaluate)
+                for batch in conflation.batches(server.listen()):
+                    for message in batch:
+                        svr.save(message)
+                    conflator.process_batch([message for message in batch if not history.process(message)])
+                    publisher.publish()
+                    checkpointer.maybe_checkpoint()
+            else:
+                for message in server.listen():
+                    svr.save(message)
+                    if history.process(message):
+                        continue
+                    exchange.process(message)
+                    history.record_valuation(myWallet.name, exchange.evaluate(myWallet))
+                    history.record_mids(exchange)
+                    publisher.publish()
+                    checkpointer.maybe_checkpoint()
+        except KeyboardInterrupt:
+            logger.debug("Cought Keyboard Interrupt, quitting.")
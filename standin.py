@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# standin.py
+
+"""
+A local stand-in for the exchange websocket server.
+It accepts websocket connections on localhost and replays recorded messages
+to every client, so that the clients in servers.py and streaming.py can be
+run without network access:
+
+    server = standin.Standin_Server(messages)
+    await server.start()
+    client = servers.Exchange_Blockchain(subscriptions, url=server.url)
+
+Blocking clients need the server on another thread:
+
+    server = standin.Standin_Server(messages).start_in_thread()
+    ...
+    server.stop_thread()
+
+To test failover, drop() aborts the connections of the clients and stall()
+keeps them open but stops sending for a while; both can be called from any
+thread.
+"""
+
+import asyncio
+import base64
+import functools
+import hashlib
+import json
+import logging
+import re
+import struct
+import threading
+from typing import Iterable
+from typing import Mapping
+from typing import Optional
+from typing import Tuple
+from typing import Union
+
+
+logger = logging.getLogger(__name__)
+
+GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+TEXT = 0x1
+CLOSE = 0x8
+PING = 0x9
+PONG = 0xA
+SEQNUM = re.compile(rb'"seqnum"\s*:\s*\d+')
+
+
+def encode_frame(payload: bytes, opcode: int = TEXT) -> bytes:
+    """
+    encodes an unmasked server frame
+    """
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+    return header + payload
+
+
+async def read_frame(reader: asyncio.StreamReader):
+    """
+    reads one client frame, returns its opcode and unmasked payload
+    """
+    first, second = await reader.readexactly(2)
+    opcode = first & 0x0F
+    length = second & 0x7F
+    if length == 126:
+        length, = struct.unpack("!H", await reader.readexactly(2))
+    elif length == 127:
+        length, = struct.unpack("!Q", await reader.readexactly(8))
+    mask = await reader.readexactly(4) if second & 0x80 else bytes(4)
+    payload = await reader.readexactly(length)
+    return opcode, bytes(byte ^ mask[index % 4] for index, byte in enumerate(payload))
+
+
+class Standin_Server:
+    """
+    Replays messages to each connecting client after its first subscription.
+    Messages can be dicts or already encoded frames.
+    `interval` is the pause in seconds between two replayed messages;
+    with `close_when_done` the connection is closed after the last one.
+    With `per_subscription` every subscription replays the messages of its
+    channel and symbol instead, from the start, like a resubscription gets a
+    new snapshot.
+    With `renumber` the seqnums of the messages are replaced by one sequence
+    per connection, as the exchange numbers the frames of a websocket.
+    """
+    def __init__(self, messages: Iterable[Union[Mapping, str, bytes]], host: str = "127.0.0.1", port: int = 0, interval: float = 0, close_when_done: bool = False, per_subscription: bool = False, renumber: bool = True):
+        self.messages = [self.encode(message) for message in messages]
+        self.host = host
+        self.port = port
+        self.interval = interval
+        self.close_when_done = close_when_done
+        self.per_subscription = per_subscription
+        self.renumber = renumber
+        self.subscriptions = list()
+        self.writers = set()
+        # symbols subscribed on each connection
+        self.symbols = dict()
+        # next seqnum of each connection
+        self.sequences = dict()
+        self.connections = 0
+        self.server = None
+        self.loop = None
+        self.flowing = None
+    @property
+    def url(self) -> str:
+        return f"ws://{self.host}:{self.port}/"
+    def encode(self, message: Union[Mapping, str, bytes]) -> bytes:
+        if isinstance(message, bytes):
+            return message
+        if isinstance(message, str):
+            return message.encode("utf-8")
+        return json.dumps(message, separators=(",", ":")).encode("utf-8")
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def subscription_of(message: bytes) -> Optional[Tuple[str, str]]:
+        """
+        channel and symbol of an encoded message
+        """
+        try:
+            decoded = json.loads(message)
+        except ValueError:
+            return None
+        return decoded.get("channel"), decoded.get("symbol")
+    def numbered(self, writer: asyncio.StreamWriter, message: bytes) -> bytes:
+        """
+        message with the next seqnum of the connection of writer
+        """
+        if not self.renumber:
+            return message
+        seqnum = self.sequences.get(writer, 0)
+        message, count = SEQNUM.subn(b'"seqnum":%d' % seqnum, message, count=1)
+        if count:
+            self.sequences[writer] = seqnum + 1
+        return message
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.flowing = asyncio.Event()
+        self.flowing.set()
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.debug(f"Stand-in server listening on {self.url}")
+    async def stop(self):
+        self.server.close()
+        for writer in list(self.writers):
+            writer.close()
+        await self.server.wait_closed()
+    def start_in_thread(self):
+        """
+        runs the server on its own event loop in a daemon thread
+        """
+        started = threading.Event()
+        def run():
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(self.start())
+            started.set()
+            loop.run_forever()
+        self.thread = threading.Thread(target=run, name="standin", daemon=True)
+        self.thread.start()
+        started.wait()
+        return self
+    def stop_thread(self):
+        asyncio.run_coroutine_threadsafe(self.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+    def abort(self, symbol: Optional[str] = None):
+        for writer in list(self.writers):
+            if symbol is None or symbol in self.symbols.get(writer, ()):
+                writer.transport.abort()
+    def drop(self, symbol: Optional[str] = None):
+        """
+        aborts the connections of all clients, or those subscribed to symbol, without a close frame
+        """
+        self.loop.call_soon_threadsafe(self.abort, symbol)
+    def pause(self, seconds: float):
+        self.flowing.clear()
+        self.loop.call_later(seconds, self.flowing.set)
+    def stall(self, seconds: float):
+        """
+        stops sending to all clients for seconds, the connections stay open
+        """
+        self.loop.call_soon_threadsafe(self.pause, seconds)
+    async def __aenter__(self):
+        await self.start()
+        return self
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.stop()
+        return False
+    async def handshake(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        request = await reader.readuntil(b"\r\n\r\n")
+        headers = dict()
+        for line in request.decode("latin-1").split("\r\n")[1:]:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+        accept = base64.b64encode(hashlib.sha1((headers["sec-websocket-key"] + GUID).encode()).digest()).decode()
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\n"
+                      "Upgrade: websocket\r\n"
+                      "Connection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode())
+        await writer.drain()
+    async def receive(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, subscribed: asyncio.Event, replays: list):
+        while True:
+            opcode, payload = await read_frame(reader)
+            if opcode == CLOSE:
+                writer.write(encode_frame(payload, CLOSE))
+                await writer.drain()
+                return
+            if opcode == PING:
+                writer.write(encode_frame(payload, PONG))
+            elif opcode == TEXT:
+                self.subscriptions.append(payload.decode("utf-8"))
+                subscribed.set()
+                if self.per_subscription:
+                    request = json.loads(payload)
+                    if request.get("action") == "subscribe" and request.get("symbol"):
+                        self.symbols.setdefault(writer, set()).add(request["symbol"])
+                        subscription = (request.get("channel"), request["symbol"])
+                        replays.append(asyncio.ensure_future(self.replay(writer, subscribed, subscription)))
+    async def replay(self, writer: asyncio.StreamWriter, subscribed: asyncio.Event, subscription: Optional[Tuple[str, str]] = None):
+        await subscribed.wait()
+        for message in self.messages:
+            if subscription is not None and self.subscription_of(message) != subscription:
+                continue
+            await self.flowing.wait()
+            writer.write(encode_frame(self.numbered(writer, message)))
+            await writer.drain()
+            if self.interval:
+                await asyncio.sleep(self.interval)
+        if self.close_when_done:
+            writer.write(encode_frame(struct.pack("!H", 1000), CLOSE))
+            await writer.drain()
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        subscribed = asyncio.Event()
+        self.writers.add(writer)
+        self.connections = self.connections + 1
+        replays = list()
+        try:
+            await self.handshake(reader, writer)
+            if not self.per_subscription:
+                replays.append(asyncio.ensure_future(self.replay(writer, subscribed)))
+            try:
+                await self.receive(reader, writer, subscribed, replays)
+            finally:
+                for replaying in replays:
+                    replaying.cancel()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.debug("Stand-in client disconnected")
+        finally:
+            self.writers.discard(writer)
+            self.symbols.pop(writer, None)
+            self.sequences.pop(writer, None)
+            writer.close()
+
+
+if __name__ == "__main__":
+    pass
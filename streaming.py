@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# streaming.py
+
+"""
+Asyncio client which decouples receiving from saving, book updates and
+valuation. A receive task reads frames off the websocket and pushes them into
+bounded queues, one per consumer:
+
+    receive ──> saver queue ──> saver.Saver.save            (own thread)
+            └─> book queue  ──> classes.Exchange.process ──> evaluation queue ──> evaluate
+
+A full saver or book queue makes the receive task wait (backpressure).
+The evaluation queue only signals that books changed: when it is full the
+signal is dropped, because the pending evaluation will see the newest books
+anyway.
+With a conflation.Conflator the book consumer takes everything queued up at
+once and applies it as one batch.
+"""
+
+import asyncio
+import concurrent.futures
+import dataclasses
+import json
+import logging
+import time
+from typing import Callable
+from typing import Optional
+from typing import Union
+
+#Own modules:
+import classes
+import conflation
+import metrics
+import saver
+import servers
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class Queue_Stats:
+    """
+    Depth of a consumer queue and the lag of its items,
+    measured from receiving a frame until the consumer picks it up
+    """
+    name: str
+    maxsize: int
+    depth: int = 0
+    consumed: int = 0
+    dropped: int = 0
+    last_lag: float = 0
+    max_lag: float = 0
+    def record(self, received: float):
+        lag = time.monotonic() - received
+        self.consumed = self.consumed + 1
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+
+
+class Stream_Client:
+    """
+    Runs receive, save, process and evaluate as independent asyncio tasks.
+    `evaluate` is called without arguments after book updates,
+    e.g. `lambda: exchange.evaluate(wallet)`.
+    """
+    def __init__(self,
+                 server: Union[servers.Exchange_Blockchain, servers.Connection_Pool],
+                 exchange: classes.Exchange,
+                 svr: Optional[saver.Saver] = None,
+                 evaluate: Optional[Callable[[], object]] = None,
+                 queue_size: int = 1024,
+                 conflator: Optional[conflation.Conflator] = None,
+                 ):
+        self.server = server
+        self.exchange = exchange
+        self.saver = svr
+        self.evaluate = evaluate
+        self.conflator = conflator
+        self.queues = dict()
+        self.stats = dict()
+        for name, maxsize in (("saver", queue_size), ("book", queue_size), ("evaluation", 1)):
+            self.queues[name] = asyncio.Queue(maxsize=maxsize)
+            self.stats[name] = Queue_Stats(name=name, maxsize=maxsize)
+        self.received = 0
+        metrics.registry.gauge("queue_depth", lambda: (({"queue": name}, queue.qsize()) for name, queue in self.queues.items()))
+        self.receiver = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="receive")
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="saver")
+    def queue_stats(self) -> dict:
+        """
+        returns the current depth and lag of every queue
+        """
+        for name, queue in self.queues.items():
+            self.stats[name].depth = queue.qsize()
+        return {name: dataclasses.asdict(stats) for name, stats in self.stats.items()}
+    async def receive(self):
+        loop = asyncio.get_running_loop()
+        targets = [self.queues["book"]]
+        if self.saver is not None:
+            targets.append(self.queues["saver"])
+        while True:
+            try:
+                frame = await loop.run_in_executor(self.receiver, self.server.receive)
+            except Exception as error:
+                logger.debug(f"Stopped receiving: {error!r}")
+                break
+            if not frame:
+                break
+            received = time.monotonic()
+            message = json.loads(frame)
+            self.received = self.received + 1
+            for queue in targets:
+                await queue.put((received, message))
+        for queue in targets:
+            await queue.put(None)
+    async def save(self):
+        loop = asyncio.get_running_loop()
+        queue = self.queues["saver"]
+        stats = self.stats["saver"]
+        while (item := await queue.get()) is not None:
+            received, message = item
+            stats.record(received)
+            await loop.run_in_executor(self.writer, self.saver.save, message)
+    async def process(self):
+        queue = self.queues["book"]
+        evaluation = self.queues["evaluation"]
+        stats = self.stats["book"]
+        running = True
+        while running:
+            items = [await queue.get()]
+            if self.conflator is not None:
+                while not queue.empty():
+                    items.append(queue.get_nowait())
+            if items[-1] is None:
+                running = False
+                items.pop()
+            if not items:
+                continue
+            for received, message in items:
+                stats.record(received)
+            if self.conflator is not None:
+                changed = self.conflator.process_batch(message for received, message in items)
+            else:
+                self.exchange.process(message)
+                changed = message.get("channel") == "l3" and message.get("event") in ("updated", "snapshot")
+            if changed:
+                try:
+                    evaluation.put_nowait(items[0][0])
+                except asyncio.QueueFull:
+                    self.stats["evaluation"].dropped = self.stats["evaluation"].dropped + 1
+            # let the other consumers run between two batches
+            await asyncio.sleep(0)
+        await evaluation.put(None)
+    async def evaluation(self):
+        queue = self.queues["evaluation"]
+        stats = self.stats["evaluation"]
+        while (received := await queue.get()) is not None:
+            stats.record(received)
+            if self.evaluate is not None:
+                self.evaluate()
+    async def run(self):
+        """
+        subscribes and runs until the websocket closes or the task is cancelled
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.receiver, self.server.subscribe)
+        tasks = [self.receive(), self.process(), self.evaluation()]
+        if self.saver is not None:
+            tasks.append(self.save())
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            self.server.close()
+            self.receiver.shutdown(wait=False)
+            self.writer.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    pass
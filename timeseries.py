@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# timeseries.py
+
+"""
+Bounded in-memory history of wallet values and of the prices, ticker and
+trades channels, so that a long running process can answer questions like
+"value over the last hour" without reading its recordings:
+
+    history = Time_Series_Store()
+    for message in server.listen():
+        if history.process(message):
+            continue
+        exchange.process(message)
+        history.record_valuation(wallet.name, exchange.evaluate(wallet))
+        history.record_mids(exchange)
+    history.bars(wallet.name, "value", 60, seconds=3600)
+
+Every (key, metric) pair, key a symbol or a wallet name, gets a Series: a
+ring buffer of the latest raw points and, per resolution, a ring buffer of
+OHLC bars. Appending costs the same however long the process runs and the
+memory of a series is fixed when it is created.
+"""
+
+import array
+import logging
+import time
+from typing import Dict
+from typing import Iterable
+from typing import Mapping
+from typing import Optional
+from typing import Tuple
+
+import numpy
+
+#Own modules:
+import classes
+
+
+logger = logging.getLogger(__name__)
+
+CHANNELS = ("prices", "ticker", "trades")
+# seconds per bar: an hour of seconds, over two days of minutes, five months of hours
+RESOLUTIONS = (1, 60, 3600)
+COLUMNS = ("start", "open", "high", "low", "close", "count")
+
+
+def ordered(column: array.array, count: int, capacity: int) -> numpy.ndarray:
+    """
+    copy of a ring buffer column of which count items were written, oldest first
+    """
+    data = numpy.frombuffer(column, dtype=numpy.float64)
+    if count <= capacity:
+        return data[:count].copy()
+    return numpy.roll(data, -(count % capacity))
+
+
+class Ring:
+    """
+    The latest `capacity` (time, value) points, appending overwrites the oldest
+    """
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.times = array.array("d", bytes(8 * capacity))
+        self.values = array.array("d", bytes(8 * capacity))
+        self.count = 0
+    def __len__(self) -> int:
+        return min(self.count, self.capacity)
+    def append(self, time: float, value: float):
+        position = self.count % self.capacity
+        self.times[position] = time
+        self.values[position] = value
+        self.count = self.count + 1
+    def last(self) -> Optional[Tuple[float, float]]:
+        if not self.count:
+            return None
+        position = (self.count - 1) % self.capacity
+        return self.times[position], self.values[position]
+    def ordered(self) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        copies of times and values, oldest first
+        """
+        return ordered(self.times, self.count, self.capacity), ordered(self.values, self.count, self.capacity)
+    def since(self, start: float) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        the points from time start on
+        """
+        times, values = self.ordered()
+        first = numpy.searchsorted(times, start, side="left")
+        return times[first:], values[first:]
+
+
+class Bars:
+    """
+    The latest `capacity` OHLC bars of `resolution` seconds, one array per column.
+    Points older than the current bar are counted in `late` and dropped.
+    """
+    def __init__(self, resolution: float, capacity: int):
+        self.resolution = resolution
+        self.capacity = capacity
+        self.columns = tuple(array.array("d", bytes(8 * capacity)) for name in COLUMNS)
+        self.starts, self.opens, self.highs, self.lows, self.closes, self.counts = self.columns
+        self.count = 0
+        self.late = 0
+        # start, high and low of the current bar
+        self.current = (None, 0.0, 0.0)
+    def __len__(self) -> int:
+        return min(self.count, self.capacity)
+    def add(self, time: float, value: float):
+        self.add_bar(time, value, value, value, value)
+    def add_bar(self, time: float, open: float, high: float, low: float, close: float, count: int = 1):
+        """
+        folds a bar of a finer resolution, starting at time, into the current bar or starts a new one
+        """
+        start = time - time % self.resolution
+        current, current_high, current_low = self.current
+        if start == current:
+            position = (self.count - 1) % self.capacity
+            if high > current_high:
+                current_high = self.highs[position] = high
+            if low < current_low:
+                current_low = self.lows[position] = low
+            self.closes[position] = close
+            self.counts[position] = self.counts[position] + count
+            self.current = (start, current_high, current_low)
+            return
+        if current is not None and start < current:
+            self.late = self.late + 1
+            return
+        position = self.count % self.capacity
+        self.starts[position] = start
+        self.opens[position] = open
+        self.highs[position] = high
+        self.lows[position] = low
+        self.closes[position] = close
+        self.counts[position] = count
+        self.count = self.count + 1
+        self.current = (start, high, low)
+    def oldest(self) -> float:
+        """
+        start of the oldest bar kept
+        """
+        return self.starts[self.count % self.capacity if self.count > self.capacity else 0]
+    def ordered(self) -> Dict[str, numpy.ndarray]:
+        """
+        copies of the columns, oldest bar first
+        """
+        return {name: ordered(column, self.count, self.capacity) for name, column in zip(COLUMNS, self.columns)}
+    def since(self, start: float) -> Dict[str, numpy.ndarray]:
+        """
+        columns start, open, high, low, close and count of the bars ending after start
+        """
+        columns = self.ordered()
+        first = numpy.searchsorted(columns["start"], start - self.resolution, side="right")
+        return {name: column[first:] for name, column in columns.items()}
+
+
+class Series:
+    """
+    Raw points of one metric and its bars at every resolution
+    """
+    def __init__(self, capacity: int, resolutions: Iterable[float], bar_capacity: int):
+        self.points = Ring(capacity)
+        self.bars = {resolution: Bars(resolution, bar_capacity) for resolution in resolutions}
+    def append(self, time: float, value: float):
+        self.points.append(time, value)
+        for bars in self.bars.values():
+            bars.add(time, value)
+    def append_bar(self, time: float, open: float, high: float, low: float, close: float):
+        """
+        records a candle as its close and folds it into the bars of coarser or equal resolution
+        """
+        self.points.append(time, close)
+        for bars in self.bars.values():
+            bars.add_bar(time, open, high, low, close)
+
+
+class Time_Series_Store:
+    """
+    Series per (key, metric), created on the first point.
+    The metrics filled by process and the record methods are
+      value: total value of a wallet, keyed by wallet name
+      mid: middle of best bid and best ask of an order book
+      last: last trade price from the ticker channel
+      trade: price of every trade from the trades channel
+      candle: close of the candles from the prices channel
+    """
+    def __init__(self, capacity: int = 65536, resolutions: Iterable[float] = RESOLUTIONS, bar_capacity: int = 3600):
+        self.capacity = capacity
+        self.resolutions = tuple(resolutions)
+        self.bar_capacity = bar_capacity
+        self.series: Dict[Tuple[str, str], Series] = dict()
+    def get(self, key: str, metric: str) -> Series:
+        try:
+            return self.series[(key, metric)]
+        except KeyError:
+            series = self.series[(key, metric)] = Series(self.capacity, self.resolutions, self.bar_capacity)
+            return series
+    def record(self, key: str, metric: str, value: float, received: Optional[float] = None):
+        self.get(key, metric).append(time.time() if received is None else received, value)
+    def record_valuation(self, name: str, value: float, received: Optional[float] = None):
+        self.record(name, "value", value, received)
+    def record_mids(self, exchange: classes.Exchange, received: Optional[float] = None):
+        """
+        records the mid price of every order book with bids and asks
+        """
+        received = time.time() if received is None else received
+        for symbol, book in exchange.order_books.items():
+            bid, ask = book.top_of_book()
+            if bid is not None and ask is not None:
+                self.get(symbol, "mid").append(received, (bid + ask) / 2)
+    def process(self, message: Mapping, received: Optional[float] = None) -> bool:
+        """
+        records a message of the prices, ticker or trades channel, tells whether it was one
+        """
+        channel = message.get("channel")
+        if channel not in CHANNELS:
+            return False
+        symbol = message.get("symbol")
+        received = time.time() if received is None else received
+        try:
+            if channel == "trades" and message.get("event") == "updated":
+                self.get(symbol, "trade").append(received, float(message["price"]))
+            elif channel == "ticker" and message.get("last_trade_price") is not None:
+                self.get(symbol, "last").append(received, float(message["last_trade_price"]))
+            elif channel == "prices" and message.get("price"):
+                timestamp, open, high, low, close = message["price"][:5]
+                self.get(symbol, "candle").append_bar(timestamp / 1000, open, high, low, close)
+        except (KeyError, TypeError, ValueError) as error:
+            logger.error(f"Cannot record {channel} message {message}: {error!r}")
+        return True
+    def window(self, key: str, metric: str, seconds: float, now: Optional[float] = None) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        times and values of the raw points of the last seconds
+        """
+        series = self.series.get((key, metric))
+        if series is None:
+            return numpy.zeros(0), numpy.zeros(0)
+        return series.points.since((time.time() if now is None else now) - seconds)
+    def bars(self, key: str, metric: str, resolution: float, seconds: Optional[float] = None, now: Optional[float] = None) -> Dict[str, numpy.ndarray]:
+        """
+        OHLC columns at resolution, of the last seconds or all that are kept
+        """
+        series = self.series.get((key, metric))
+        if series is None:
+            return {name: numpy.zeros(0) for name in COLUMNS}
+        bars = series.bars[resolution]
+        if seconds is None:
+            return bars.ordered()
+        return bars.since((time.time() if now is None else now) - seconds)
+    def last(self, key: str, metric: str) -> Optional[Tuple[float, float]]:
+        series = self.series.get((key, metric))
+        return series.points.last() if series is not None else None
+    def change(self, key: str, metric: str, seconds: float, now: Optional[float] = None) -> Optional[float]:
+        """
+        relative change over the last seconds, from the bars of the finest resolution covering them
+        """
+        series = self.series.get((key, metric))
+        if series is None:
+            return None
+        now = time.time() if now is None else now
+        for resolution in sorted(series.bars):
+            bars = series.bars[resolution]
+            if len(bars) < bars.capacity or bars.oldest() <= now - seconds:
+                break
+        columns = bars.since(now - seconds)
+        if not len(columns["open"]) or not columns["open"][0]:
+            return None
+        return columns["close"][-1] / columns["open"][0] - 1
+    def memory(self) -> int:
+        """
+        bytes held by all series
+        """
+        total = 0
+        for series in self.series.values():
+            total = total + 2 * 8 * series.points.capacity
+            total = total + sum(len(COLUMNS) * 8 * bars.capacity for bars in series.bars.values())
+        return total
+
+
+if __name__ == "__main__":
+    pass